@@ -10,16 +10,29 @@
 
 #include "minja.hpp"
 
+#include <algorithm>
+#include <atomic>
 #include <chrono>
 #include <cstddef>
+#include <cstdint>
 #include <cstdio>
 #include <ctime>
+#include <deque>
 #include <exception>
+#include <functional>
 #include <iomanip>
+#include <list>
+#include <map>
 #include <memory>
+#include <mutex>
 #include <sstream>
 #include <stdexcept>
 #include <string>
+#include <string_view>
+#include <system_error>
+#include <thread>
+#include <unordered_map>
+#include <utility>
 #include <vector>
 
 #include <nlohmann/json.hpp>
@@ -65,19 +78,168 @@ struct chat_template_options {
     bool polyfill_system_role = true;
     bool polyfill_object_arguments = true;
     bool polyfill_typed_content = true;
+
+    // Lets apply_incremental render only the last turns of templates that renders_locally() (see apply_incremental).
+    bool windowed_incremental = false;
+};
+
+// A conversation rendered turn by turn w/ chat_template::apply_incremental.
+struct chat_template_conversation {
+    nlohmann::ordered_json messages = nlohmann::ordered_json::array();
+    bool add_generation_prompt = false;
+    std::string prompt;
+
+    // The other inputs & the options the prompt was rendered with: only the messages may change for a windowed render.
+    nlohmann::ordered_json tools;
+    nlohmann::ordered_json extra_context;
+    std::chrono::system_clock::time_point now;
+    chat_template_options options;
+};
+
+// What changed in the prompt of a conversation: its first prefix_size characters were kept, and suffix was appended to them.
+struct chat_template_delta {
+    size_t prefix_size = 0;
+    std::string suffix;
 };
 
 class chat_template {
 
   private:
-    chat_template_caps caps_;
+    // The capabilities of the template, probed on first use (or imported, see export_caps).
+    struct probed_caps {
+        chat_template_caps caps;
+        std::string tool_call_example;
+    };
+    struct lazy_caps {
+        std::once_flag once;
+        probed_caps value;
+    };
+
     std::string source_;
     std::string bos_token_;
     std::string eos_token_;
     std::shared_ptr<minja::TemplateNode> template_root_;
-    std::string tool_call_example_;
+    // Whether the prompt may depend on inputs.now (conservatively, from the source).
+    bool uses_strftime_now_ = false;
+    std::shared_ptr<lazy_caps> caps_ = std::make_shared<lazy_caps>();
+
+    /*
+      Thread-safe LRU cache of values computed from JSON documents, keyed by the document (compared by value) and a
+      variant (e.g. the polyfills applied). Eviction is bounded by the approximate size of the documents & values.
+    */
+    template <class T>
+    class json_cache {
+      public:
+        explicit json_cache(size_t max_bytes) : max_bytes_(max_bytes) {}
+
+        template <class F>
+        std::shared_ptr<const T> get_or_compute(const json & key, int variant, F && compute) {
+            auto hash = std::hash<json>()(key) ^ (static_cast<size_t>(variant) * 0x9e3779b97f4a7c15ull);
+            {
+                std::lock_guard<std::mutex> lock(mutex_);
+                if (auto entry = find(hash, key, variant); entry != entries_.end()) {
+                    entries_.splice(entries_.begin(), entries_, entry);
+                    return entry->value;
+                }
+            }
+            auto value = std::make_shared<const T>(compute());
+            auto bytes = approximate_size(key) + approximate_size(*value);
+            if (bytes > max_bytes_) return value;
+
+            std::lock_guard<std::mutex> lock(mutex_);
+            if (auto entry = find(hash, key, variant); entry != entries_.end()) {
+                return entry->value;
+            }
+            entries_.push_front({hash, variant, key, value, bytes});
+            index_.emplace(hash, entries_.begin());
+            bytes_ += bytes;
+            while (bytes_ > max_bytes_) {
+                auto last = std::prev(entries_.end());
+                auto range = index_.equal_range(last->hash);
+                for (auto it = range.first; it != range.second; ++it) {
+                    if (it->second == last) {
+                        index_.erase(it);
+                        break;
+                    }
+                }
+                bytes_ -= last->bytes;
+                entries_.erase(last);
+            }
+            return value;
+        }
+
+      private:
+        struct Entry {
+            size_t hash;
+            int variant;
+            json key;
+            std::shared_ptr<const T> value;
+            size_t bytes;
+        };
+        using EntryList = std::list<Entry>;
+
+        std::mutex mutex_;
+        EntryList entries_;  // Most recently used first
+        std::unordered_multimap<size_t, typename EntryList::iterator> index_;
+        size_t max_bytes_;
+        size_t bytes_ = 0;
+
+        typename EntryList::iterator find(size_t hash, const json & key, int variant) {
+            auto range = index_.equal_range(hash);
+            for (auto it = range.first; it != range.second; ++it) {
+                if (it->second->variant == variant && it->second->key == key) {
+                    return it->second;
+                }
+            }
+            return entries_.end();
+        }
+
+        static size_t approximate_size(const std::string & value) { return sizeof(value) + value.size(); }
+        static size_t approximate_size(const json & value) {
+            size_t size = sizeof(json);
+            if (value.is_string()) {
+                size += value.get_ref<const std::string &>().size();
+            } else if (value.is_object()) {
+                for (const auto & item : value.items()) {
+                    size += item.key().size() + approximate_size(item.value());
+                }
+            } else if (value.is_array()) {
+                for (const auto & item : value) {
+                    size += approximate_size(item);
+                }
+            }
+            return size;
+        }
+    };
+    // Messages rewritten by the tool call / tool response polyfills, and dumps of the tools (for the tools polyfill).
+    std::shared_ptr<json_cache<json>> polyfilled_messages_ = std::make_shared<json_cache<json>>(16 * 1024 * 1024);
+    std::shared_ptr<json_cache<std::string>> tools_prompts_ = std::make_shared<json_cache<std::string>>(4 * 1024 * 1024);
+
+    // Bump whenever the probes change, so that previously exported caps aren't imported anymore.
+    static constexpr int caps_version = 1;
+
+    static const std::vector<std::pair<std::string, bool chat_template_caps::*>> & caps_fields() {
+        static const std::vector<std::pair<std::string, bool chat_template_caps::*>> fields {
+            {"supports_tools", &chat_template_caps::supports_tools},
+            {"supports_tool_calls", &chat_template_caps::supports_tool_calls},
+            {"supports_tool_responses", &chat_template_caps::supports_tool_responses},
+            {"supports_system_role", &chat_template_caps::supports_system_role},
+            {"supports_parallel_tool_calls", &chat_template_caps::supports_parallel_tool_calls},
+            {"supports_tool_call_id", &chat_template_caps::supports_tool_call_id},
+            {"requires_object_arguments", &chat_template_caps::requires_object_arguments},
+            {"requires_non_null_content", &chat_template_caps::requires_non_null_content},
+            {"requires_typed_content", &chat_template_caps::requires_typed_content},
+        };
+        return fields;
+    }
+
+    const probed_caps & probed() const {
+        std::call_once(caps_->once, [&]() { caps_->value = probe_caps(); });
+        return caps_->value;
+    }
 
     std::string try_raw_render(
+        const probed_caps & probed,
         const nlohmann::ordered_json & messages,
         const nlohmann::ordered_json & tools,
         bool add_generation_prompt,
@@ -95,7 +257,8 @@ class chat_template {
             chat_template_options opts;
             opts.apply_polyfills = false;
 
-            auto prompt = apply(inputs, opts);
+            std::string prompt;
+            render(inputs, inputs.messages, inputs.add_generation_prompt, [&](std::string_view chunk) { prompt.append(chunk.data(), chunk.size()); }, opts, probed);
             // fprintf(stderr, "try_raw_render: %s\n", prompt.c_str());
             return prompt;
         } catch (const std::exception & e) {
@@ -104,16 +267,15 @@ class chat_template {
         }
     }
 
-  public:
-
-    chat_template(const std::string & source, const std::string & bos_token, const std::string & eos_token)
-        : source_(source), bos_token_(bos_token), eos_token_(eos_token)
-    {
-        template_root_ = minja::Parser::parse(source_, {
-            /* .trim_blocks = */ true,
-            /* .lstrip_blocks = */ true,
-            /* .keep_trailing_newline = */ false,
-        });
+    // Renders probe conversations to find out what the template supports (the probes render w/ the caps found so far).
+    probed_caps probe_caps() const {
+        probed_caps result;
+        auto & caps = result.caps;
+        auto render_prompt = [&](const chat_template_inputs & inputs) {
+            std::string prompt;
+            render(inputs, inputs.messages, inputs.add_generation_prompt, [&](std::string_view chunk) { prompt.append(chunk.data(), chunk.size()); }, chat_template_options(), result);
+            return prompt;
+        };
 
         auto contains = [](const std::string & haystack, const std::string & needle) {
             return haystack.find(needle) != std::string::npos;
@@ -124,21 +286,21 @@ class chat_template {
         const json dummy_str_user_msg = {{"role", "user"}, {"content", user_needle}};
         const json dummy_typed_user_msg = {{"role", "user"}, {"content", json::array({{{"type", "text"}, {"text", user_needle}}})}};
 
-        caps_.requires_typed_content =
-            !contains(try_raw_render(json::array({dummy_str_user_msg}), {}, false), user_needle)
-            && contains(try_raw_render(json::array({dummy_typed_user_msg}), {}, false), user_needle);
+        caps.requires_typed_content =
+            !contains(try_raw_render(result, json::array({dummy_str_user_msg}), {}, false), user_needle)
+            && contains(try_raw_render(result, json::array({dummy_typed_user_msg}), {}, false), user_needle);
 
-        const auto dummy_user_msg = caps_.requires_typed_content
+        const auto dummy_user_msg = caps.requires_typed_content
             ? dummy_typed_user_msg
             : dummy_str_user_msg;
         const json needle_system_msg = {
             {"role", "system"},
-            {"content", caps_.requires_typed_content ? json::array({{{"type", "text"}, {"text", sys_needle}}}) : json(sys_needle)},
+            {"content", caps.requires_typed_content ? json::array({{{"type", "text"}, {"text", sys_needle}}}) : json(sys_needle)},
         };
 
-        caps_.supports_system_role = contains(try_raw_render({needle_system_msg, dummy_user_msg,}, {}, false), sys_needle);
+        caps.supports_system_role = contains(try_raw_render(result, {needle_system_msg, dummy_user_msg,}, {}, false), sys_needle);
 
-        auto out = try_raw_render(json::array({
+        auto out = try_raw_render(result, json::array({
             dummy_user_msg
         }), json::array({
             {
@@ -160,24 +322,24 @@ class chat_template {
                 }},
             },
         }), false);
-        caps_.supports_tools = contains(out, "some_tool");
+        caps.supports_tools = contains(out, "some_tool");
 
         const auto render_with_content = [&](const json & content) {
             const json assistant_msg {{"role", "assistant"}, {"content", content}};
             // Render two assistant messages as some templates like QwQ-32B are handling
             // the content differently depending on whether it's the last message or not
             // (to remove the <think> tag in all but the last message).
-            return try_raw_render(json::array({dummy_user_msg, assistant_msg, dummy_user_msg, assistant_msg}), {}, false);
+            return try_raw_render(result, json::array({dummy_user_msg, assistant_msg, dummy_user_msg, assistant_msg}), {}, false);
         };
         auto out_empty = render_with_content("");
         auto out_null = render_with_content(json());
-        caps_.requires_non_null_content = contains(out_empty, user_needle) && !contains(out_null, user_needle);
+        caps.requires_non_null_content = contains(out_empty, user_needle) && !contains(out_null, user_needle);
         
         json j_null;
         auto make_tool_calls_msg = [&](const json & tool_calls) {
             return json {
                 {"role", "assistant"},
-                {"content", caps_.requires_non_null_content? "" : j_null},
+                {"content", caps.requires_non_null_content? "" : j_null},
                 {"tool_calls", tool_calls},
             };
         };
@@ -200,31 +362,31 @@ class chat_template {
         };
 
         // Note: the arguments are rendered in both cases, but may be double-escaped, which we don't want.
-        out = try_raw_render(json::array({
+        out = try_raw_render(result, json::array({
             dummy_user_msg,
             make_tool_calls_msg(json::array({make_tool_call("ipython", dummy_args_obj.dump())})),
         }), {}, false);
         auto tool_call_renders_str_arguments = contains_arg_needle(out);
-        out = try_raw_render(json::array({
+        out = try_raw_render(result, json::array({
             dummy_user_msg,
             make_tool_calls_msg(json::array({make_tool_call("ipython", dummy_args_obj)})),
         }), {}, false);
         auto tool_call_renders_obj_arguments = contains_arg_needle(out);
 
-        caps_.supports_tool_calls = tool_call_renders_str_arguments || tool_call_renders_obj_arguments;
-        caps_.requires_object_arguments = !tool_call_renders_str_arguments && tool_call_renders_obj_arguments;
+        caps.supports_tool_calls = tool_call_renders_str_arguments || tool_call_renders_obj_arguments;
+        caps.requires_object_arguments = !tool_call_renders_str_arguments && tool_call_renders_obj_arguments;
 
-        if (caps_.supports_tool_calls) {
-            auto dummy_args = caps_.requires_object_arguments ? dummy_args_obj : json(dummy_args_obj.dump());
+        if (caps.supports_tool_calls) {
+            auto dummy_args = caps.requires_object_arguments ? dummy_args_obj : json(dummy_args_obj.dump());
             auto tc1 = make_tool_call("test_tool1", dummy_args);
             auto tc2 = make_tool_call("test_tool2", dummy_args);
-            auto out = try_raw_render(json::array({
+            auto out = try_raw_render(result, json::array({
                 dummy_user_msg,
                 make_tool_calls_msg(json::array({tc1, tc2})),
             }), {}, false);
-            caps_.supports_parallel_tool_calls = contains(out, "test_tool1") && contains(out, "test_tool2");
+            caps.supports_parallel_tool_calls = contains(out, "test_tool1") && contains(out, "test_tool2");
 
-            out = try_raw_render(json::array({
+            out = try_raw_render(result, json::array({
                 dummy_user_msg,
                 make_tool_calls_msg(json::array({tc1})),
                 {
@@ -234,12 +396,12 @@ class chat_template {
                     {"tool_call_id", "call_911_"},
                 }
             }), {}, false);
-            caps_.supports_tool_responses = contains(out, "Some response!");
-            caps_.supports_tool_call_id = contains(out, "call_911_");
+            caps.supports_tool_responses = contains(out, "Some response!");
+            caps.supports_tool_call_id = contains(out, "call_911_");
         }
 
         try {
-            if (!caps_.supports_tools) {
+            if (!caps.supports_tools) {
                 const json user_msg {
                     {"role", "user"},
                     {"content", "Hey"},
@@ -249,7 +411,7 @@ class chat_template {
                 };
                 const json tool_call_msg {
                     {"role", "assistant"},
-                    {"content", caps_.requires_non_null_content ? "" : j_null},
+                    {"content", caps.requires_non_null_content ? "" : j_null},
                     {"tool_calls", json::array({
                         {
                             // TODO: detect if requires numerical id or fixed length == 6 like Nemo
@@ -257,7 +419,7 @@ class chat_template {
                             {"type", "function"},
                             {"function", {
                                 {"name", "tool_name"},
-                                {"arguments", (caps_.requires_object_arguments ? args : json(minja::Value(args).dump(-1, /* to_json= */ true)))},
+                                {"arguments", (caps.requires_object_arguments ? args : json(minja::Value(args).dump(-1, /* to_json= */ true)))},
                             }},
                         },
                     })},
@@ -267,13 +429,13 @@ class chat_template {
                     chat_template_inputs inputs;
                     inputs.messages = json::array({user_msg});
                     inputs.add_generation_prompt = true;
-                    prefix = apply(inputs);
+                    prefix = render_prompt(inputs);
                 }
                 {
                     chat_template_inputs inputs;
                     inputs.messages = json::array({user_msg, tool_call_msg});
                     inputs.add_generation_prompt = false;
-                    full = apply(inputs);
+                    full = render_prompt(inputs);
                 }
                 auto eos_pos_last = full.rfind(eos_token_);
                 if (eos_pos_last == prefix.size() - eos_token_.size() ||
@@ -297,18 +459,87 @@ class chat_template {
                 if (example.find("tool_name") == std::string::npos && example.find("some_value") == std::string::npos) {
                     fprintf(stderr, "Failed to infer a tool call example (possible template bug)\n");
                 } else {
-                    tool_call_example_ = example;
+                    result.tool_call_example = example;
                 }
             }
         } catch (const std::exception & e) {
             fprintf(stderr, "Failed to generate tool call example: %s\n", e.what());
         }
+        return result;
+    }
+
+  public:
+
+    chat_template(const std::string & source, const std::string & bos_token, const std::string & eos_token)
+        : source_(source), bos_token_(bos_token), eos_token_(eos_token)
+    {
+        template_root_ = minja::TemplateCache::global().get_or_parse(source_, {
+            /* .trim_blocks = */ true,
+            /* .lstrip_blocks = */ true,
+            /* .keep_trailing_newline = */ false,
+        });
+        uses_strftime_now_ = source_.find("strftime_now") != std::string::npos;
     }
 
     const std::string & source() const { return source_; }
     const std::string & bos_token() const { return bos_token_; }
     const std::string & eos_token() const { return eos_token_; }
-    const chat_template_caps & original_caps() const { return caps_; }
+    // Probed on first call (unless imported, see import_caps).
+    const chat_template_caps & original_caps() const { return probed().caps; }
+
+    // Identifies the source, special tokens & version of the probes of the template in its exported caps.
+    std::string caps_key() const {
+        uint64_t hash = 14695981039346656037ull;  // FNV-1a
+        for (const auto & part : {std::to_string(caps_version), source_, bos_token_, eos_token_}) {
+            for (unsigned char c : part) {
+                hash = (hash ^ c) * 1099511628211ull;
+            }
+            hash = (hash ^ 0xff) * 1099511628211ull;
+        }
+        char key[32];
+        snprintf(key, sizeof(key), "v%d-%016llx", caps_version, static_cast<unsigned long long>(hash));
+        return key;
+    }
+
+    /*
+      The probed caps (and tool call example) as JSON, keyed by caps_key(): servers that load many models can save them,
+      and import_caps them in later runs to skip probing altogether.
+    */
+    nlohmann::ordered_json export_caps() const {
+        const auto & probed = this->probed();
+        auto caps = json::object();
+        for (const auto & field : caps_fields()) {
+            caps[field.first] = probed.caps.*field.second;
+        }
+        return {
+            {"key", caps_key()},
+            {"caps", caps},
+            {"tool_call_example", probed.tool_call_example},
+        };
+    }
+
+    // Uses caps exported by a template w/ the same caps_key() instead of probing them. Returns false (leaving the caps to be
+    // probed) if they were exported by another template or are malformed, or if the caps were already probed or imported.
+    bool import_caps(const nlohmann::ordered_json & exported) {
+        probed_caps value;
+        try {
+            if (exported.at("key") != caps_key()) {
+                return false;
+            }
+            for (const auto & field : caps_fields()) {
+                value.caps.*field.second = exported.at("caps").at(field.first).get<bool>();
+            }
+            value.tool_call_example = exported.at("tool_call_example").get<std::string>();
+        } catch (const json::exception &) {
+            return false;
+        }
+        auto imported = false;
+        std::call_once(caps_->once, [&]() {
+            caps_->value = std::move(value);
+            imported = true;
+        });
+        return imported;
+    }
 
     // Deprecated, please use the form with chat_template_inputs and chat_template_options
     std::string apply(
@@ -336,13 +567,376 @@ class chat_template {
         const chat_template_inputs & inputs,
         const chat_template_options & opts = chat_template_options()) const
     {
-        json actual_messages;
+        std::string out;
+        apply(inputs, [&](std::string_view chunk) { out.append(chunk.data(), chunk.size()); }, opts);
+        return out;
+    }
+
+    // Streams the prompt to sink as it's rendered (e.g. to a tokenizer or a socket), instead of returning it.
+    void apply(
+        const chat_template_inputs & inputs,
+        const minja::RenderSink & sink,
+        const chat_template_options & opts = chat_template_options()) const
+    {
+        render(inputs, inputs.messages, inputs.add_generation_prompt, sink, opts, probed());
+    }
+
+    /*
+      Renders each of the inputs (e.g. the prompts of concurrent requests) on up to n_threads threads
+      (0: std::thread::hardware_concurrency()), the calling thread included.
+
+      Like apply, this is thread-safe: parsed templates are immutable, the builtins are shared read-only, and each render gets
+      its own context. If some renders fail, the first exception (in the order of inputs) is rethrown once all are done.
+    */
+    std::vector<std::string> apply_batch(
+        const std::vector<chat_template_inputs> & inputs,
+        const chat_template_options & opts = chat_template_options(),
+        size_t n_threads = 0) const
+    {
+        std::vector<std::string> prompts(inputs.size());
+        std::vector<std::exception_ptr> errors(inputs.size());
+        std::atomic<size_t> next(0);
+        auto worker = [&]() {
+            for (auto i = next++; i < inputs.size(); i = next++) {
+                try {
+                    prompts[i] = apply(inputs[i], opts);
+                } catch (...) {
+                    errors[i] = std::current_exception();
+                }
+            }
+        };
+
+        if (n_threads == 0) {
+            n_threads = std::max(1u, std::thread::hardware_concurrency());
+        }
+        std::vector<std::thread> threads;
+        threads.reserve(std::min(n_threads, inputs.size()));
+        for (size_t i = 1; i < std::min(n_threads, inputs.size()); i++) {
+            try {
+                threads.emplace_back(worker);
+            } catch (const std::system_error &) {
+                // Couldn't start more threads: the ones that did (and this one) share the whole batch.
+                break;
+            }
+        }
+        worker();
+        for (auto & thread : threads) {
+            thread.join();
+        }
+
+        for (const auto & error : errors) {
+            if (error) {
+                std::rethrow_exception(error);
+            }
+        }
+        return prompts;
+    }
+
+    /*
+      Renders inputs, whose messages extend those of a conversation previously rendered w/ this method
+      (start with a default-constructed chat_template_conversation), and returns what changed in its prompt.
+
+      By default, the whole prompt is rendered and compared to the previous one: the delta is exact, even for templates that
+      rewrite earlier turns.
+
+      W/ opts.windowed_incremental, if the template renders locally w/ these options (see renders_locally()), only the first
+      message and the last few turns are rendered, so the cost of a turn doesn't grow with the length of the conversation
+      (unless the messages don't extend the conversation's, the tools, extra context, options or - for templates calling
+      strftime_now - date changed, or the windowed render isn't an extension of the previous one). The earlier turns aren't
+      rendered again, so this is only exact if the template's locality holds beyond the probe conversation: e.g. a template
+      whose output changes once the conversation gets longer than the probe gets wrong deltas.
+    */
+    chat_template_delta apply_incremental(
+        const chat_template_inputs & inputs,
+        chat_template_conversation & conversation,
+        const chat_template_options & opts = chat_template_options()) const
+    {
+        chat_template_delta delta;
+        auto extends = !conversation.messages.empty()
+            && inputs.messages.size() > conversation.messages.size()
+            && std::equal(conversation.messages.begin(), conversation.messages.end(), inputs.messages.begin());
+        auto same_inputs = options_key(conversation.options) == options_key(opts)
+            && conversation.tools == inputs.tools
+            && conversation.extra_context == inputs.extra_context
+            && (conversation.now == inputs.now || !opts.define_strftime_now || !uses_strftime_now_);
+        auto has_tools = inputs.tools.is_array() && !inputs.tools.empty();
+        if (!opts.windowed_incremental || !extends || !same_inputs || !renders_locally(opts, has_tools)
+                || !windowed_delta(inputs, conversation, opts, delta)) {
+            delta = full_delta(inputs, conversation, opts);
+        }
+
+        conversation.prompt.resize(delta.prefix_size);
+        conversation.prompt += delta.suffix;
+        if (extends) {
+            for (size_t i = conversation.messages.size(); i < inputs.messages.size(); i++) {
+                conversation.messages.push_back(inputs.messages[i]);
+            }
+        } else {
+            conversation.messages = inputs.messages;
+        }
+        conversation.add_generation_prompt = inputs.add_generation_prompt;
+        if (!same_inputs) {
+            conversation.tools = inputs.tools;
+            conversation.extra_context = inputs.extra_context;
+            conversation.options = opts;
+        }
+        conversation.now = inputs.now;
+        return delta;
+    }
+
+    /*
+      Whether each turn renders the same regardless of how many turns precede it, and never changes the rendering of earlier turns,
+      w/ the given options and w/ or w/o tools (the polyfills change what gets rendered). Checked (once per options & presence of
+      tools, on first use) by comparing windowed and full renders of a probe conversation of 8 turns, so it's a heuristic: it
+      can't tell templates that only change their output for longer conversations.
+    */
+    bool renders_locally(const chat_template_options & opts = chat_template_options(), bool with_tools = false) const {
+        auto key = options_key(opts) << 1 | (with_tools ? 1 : 0);
+        {
+            std::lock_guard<std::mutex> lock(renders_locally_->mutex);
+            auto it = renders_locally_->values.find(key);
+            if (it != renders_locally_->values.end()) return it->second;
+        }
+        // Probed w/o holding the lock (it renders the probe conversation many times): concurrent callers may probe
+        // the same key too, which is harmless as they get the same result.
+        auto locally = probe_locality(opts, with_tools);
+        std::lock_guard<std::mutex> lock(renders_locally_->mutex);
+        return renders_locally_->values.emplace(key, locally).first->second;
+    }
+
+  private:
+    struct locality_probes {
+        std::mutex mutex;
+        std::map<int, bool> values;
+    };
+    std::shared_ptr<locality_probes> renders_locally_ = std::make_shared<locality_probes>();
+
+    static int options_key(const chat_template_options & opts) {
+        auto key = 0;
+        for (auto flag : {
+            opts.apply_polyfills, opts.use_bos_token, opts.use_eos_token, opts.define_strftime_now,
+            opts.polyfill_tools, opts.polyfill_tool_call_examples, opts.polyfill_tool_calls, opts.polyfill_tool_responses,
+            opts.polyfill_system_role, opts.polyfill_object_arguments, opts.polyfill_typed_content,
+        }) {
+            key = key << 1 | (flag ? 1 : 0);
+        }
+        return key;
+    }
+
+    // Number of previous messages apply_incremental renders (besides the first one) before the new ones.
+    static constexpr size_t incremental_context = 4;
+
+    chat_template_delta full_delta(
+        const chat_template_inputs & inputs,
+        const chat_template_conversation & conversation,
+        const chat_template_options & opts) const
+    {
+        auto prompt = apply(inputs, opts);
+        const auto & previous = conversation.prompt;
+        auto mismatch = std::mismatch(previous.begin(), previous.end(), prompt.begin(), prompt.end());
+
+        chat_template_delta delta;
+        delta.prefix_size = mismatch.first - previous.begin();
+        delta.suffix = prompt.substr(delta.prefix_size);
+        return delta;
+    }
+
+    // Renders the first message and the last turns of the conversation, w/o and w/ the new messages, and returns false
+    // if the latter doesn't extend the former. An even number of messages is skipped, to keep the alternation of roles.
+    bool windowed_delta(
+        const chat_template_inputs & inputs,
+        const chat_template_conversation & conversation,
+        const chat_template_options & opts,
+        chat_template_delta & delta) const
+    {
+        auto previous_size = conversation.messages.size();
+        size_t start = 1;
+        if (previous_size > 1 + incremental_context) {
+            start = previous_size - incremental_context;
+            start -= (start - 1) % 2;
+        }
+        auto window = json::array({inputs.messages[0]});
+        for (size_t i = start; i < previous_size; i++) {
+            window.push_back(inputs.messages[i]);
+        }
+
+        std::string before, after;
+        try {
+            render(inputs, window, conversation.add_generation_prompt, [&](std::string_view chunk) { before.append(chunk.data(), chunk.size()); }, opts, probed());
+            for (size_t i = previous_size; i < inputs.messages.size(); i++) {
+                window.push_back(inputs.messages[i]);
+            }
+            render(inputs, window, inputs.add_generation_prompt, [&](std::string_view chunk) { after.append(chunk.data(), chunk.size()); }, opts, probed());
+        } catch (const std::exception &) {
+            return false;
+        }
+        if (after.compare(0, before.size(), before) != 0) {
+            return false;
+        }
+        delta.prefix_size = conversation.prompt.size();
+        delta.suffix = after.substr(before.size());
+        return true;
+    }
+
+    bool probe_locality(const chat_template_options & opts, bool with_tools) const {
+        try {
+            const auto & caps = probed().caps;
+            const auto content = [&](const std::string & text) {
+                return caps.requires_typed_content ? json::array({{{"type", "text"}, {"text", text}}}) : json(text);
+            };
+            auto probe = json::array({
+                {{"role", "system"}, {"content", content("System prompt")}},
+                {{"role", "user"}, {"content", content("Question 1")}},
+            });
+            for (int turn = 2; turn <= 8; turn++) {
+                if (turn == 4 && caps.supports_tool_calls && caps.supports_tool_responses) {
+                    json arguments {{"code", "print(1)"}};
+                    probe.push_back({
+                        {"role", "assistant"},
+                        {"content", caps.requires_non_null_content ? json("") : json()},
+                        {"tool_calls", json::array({{
+                            {"id", "call_1___"},
+                            {"type", "function"},
+                            {"function", {
+                                {"name", "ipython"},
+                                {"arguments", caps.requires_object_arguments ? arguments : json(arguments.dump())},
+                            }},
+                        }})},
+                    });
+                    probe.push_back({{"role", "tool"}, {"name", "ipython"}, {"tool_call_id", "call_1___"}, {"content", "1"}});
+                }
+                probe.push_back({{"role", "assistant"}, {"content", content("Answer " + std::to_string(turn - 1))}});
+                probe.push_back({{"role", "user"}, {"content", content("Question " + std::to_string(turn))}});
+            }
+
+            chat_template_inputs inputs;
+            inputs.now = std::chrono::system_clock::from_time_t(0);
+            inputs.messages = json::array();
+            if (with_tools) {
+                inputs.tools = json::array({{
+                    {"type", "function"},
+                    {"function", {
+                        {"name", "ipython"},
+                        {"description", "Runs code."},
+                        {"parameters", {
+                            {"type", "object"},
+                            {"properties", {{"code", {{"type", "string"}}}}},
+                            {"required", json::array({"code"})},
+                        }},
+                    }},
+                }});
+            }
+            chat_template_conversation conversation;
+            for (const auto & message : probe) {
+                inputs.messages.push_back(message);
+                if (message.at("role") != "user") {
+                    continue;
+                }
+                auto full = full_delta(inputs, conversation, opts);
+                if (!conversation.messages.empty()) {
+                    chat_template_delta windowed;
+                    if (full.prefix_size != conversation.prompt.size()
+                            || !windowed_delta(inputs, conversation, opts, windowed)
+                            || windowed.suffix != full.suffix) {
+                        return false;
+                    }
+                }
+                conversation.prompt.resize(full.prefix_size);
+                conversation.prompt += full.suffix;
+                conversation.messages = inputs.messages;
+                conversation.add_generation_prompt = inputs.add_generation_prompt;
+            }
+            return true;
+        } catch (const std::exception &) {
+            return false;
+        }
+    }
 
+    // The rewrites of a message by the tool call / tool response polyfills (which don't depend on the other messages).
+    static json polyfill_message(const json & original, bool polyfill_object_arguments, bool polyfill_tool_calls, bool polyfill_tool_responses) {
+        auto message = original;
+        std::string role = message.at("role");
+
+        if (message.contains("tool_calls")) {
+            if (polyfill_object_arguments || polyfill_tool_calls) {
+                for (auto & tool_call : message.at("tool_calls")) {
+                    if (tool_call["type"] == "function") {
+                        auto & function = tool_call.at("function");
+                        auto & arguments = function.at("arguments");
+                        if (arguments.is_string()) {
+                            try {
+                                arguments = json::parse(arguments.get<std::string>());
+                            } catch (const std::exception & ecvt) {
+                                fprintf(stderr, "Failed to parse arguments: %s\n", ecvt.what());
+                            }
+                        }
+                    }
+                }
+            }
+            if (polyfill_tool_calls) {
+                auto tool_calls = json::array();
+                for (const auto & tool_call : message.at("tool_calls")) {
+                    if (tool_call.at("type") != "function") {
+                        continue;
+                    }
+                    const auto & function = tool_call.at("function");
+                    auto tc = json {
+                        {"name", function.at("name")},
+                        {"arguments", function.at("arguments")},
+                    };
+                    if (tool_call.contains("id")) {
+                        tc["id"] = tool_call["id"];
+                    }
+                    tool_calls.push_back(tc);
+                }
+                auto obj = json {
+                    {"tool_calls", tool_calls},
+                };
+                if (message.contains("content")) {
+                    auto content = message.at("content");
+                    if (!content.is_null() && !content.empty()) {
+                        obj["content"] = content;
+                    }
+                }
+                message["content"] = obj.dump(2);
+                message.erase("tool_calls");
+            }
+        }
+        if (polyfill_tool_responses && role == "tool") {
+            message["role"] = "user";
+            auto obj = json {
+                {"tool_response", json::object()},
+            };
+            if (message.contains("name")) {
+                obj["tool_response"]["tool"] = message.at("name");
+            }
+            obj["tool_response"]["content"] = message.at("content");
+            if (message.contains("tool_call_id")) {
+                obj["tool_response"]["tool_call_id"] = message.at("tool_call_id");
+            }
+            message["content"] = obj.dump(2);
+            message.erase("name");
+        }
+        if (!message.contains("content")) {
+            message["content"] = nullptr;
+        }
+        return message;
+    }
+
+    // Renders inputs w/ the given messages and add_generation_prompt (instead of those of inputs), and the given caps.
+    void render(
+        const chat_template_inputs & inputs,
+        const nlohmann::ordered_json & messages,
+        bool add_generation_prompt,
+        const minja::RenderSink & sink,
+        const chat_template_options & opts,
+        const probed_caps & probed) const
+    {
         auto has_tools = inputs.tools.is_array() && !inputs.tools.empty();
         auto has_tool_calls = false;
         auto has_tool_responses = false;
         auto has_string_content = false;
-        for (const auto & message : inputs.messages) {
+        for (const auto & message : messages) {
             if (message.contains("tool_calls") && !message["tool_calls"].is_null()) {
                 has_tool_calls = true;
             }
@@ -354,13 +948,13 @@ class chat_template {
             }
         }
 
-        auto polyfill_system_role = opts.polyfill_system_role && !caps_.supports_system_role;
-        auto polyfill_tools = opts.polyfill_tools && has_tools && !caps_.supports_tools;
+        auto polyfill_system_role = opts.polyfill_system_role && !probed.caps.supports_system_role;
+        auto polyfill_tools = opts.polyfill_tools && has_tools && !probed.caps.supports_tools;
         auto polyfill_tool_call_example = polyfill_tools && opts.polyfill_tool_call_examples;
-        auto polyfill_tool_calls = opts.polyfill_tool_calls && has_tool_calls && !caps_.supports_tool_calls;
-        auto polyfill_tool_responses = opts.polyfill_tool_responses && has_tool_responses && !caps_.supports_tool_responses;
-        auto polyfill_object_arguments = opts.polyfill_object_arguments && has_tool_calls && caps_.requires_object_arguments;
-        auto polyfill_typed_content = opts.polyfill_typed_content && has_string_content && caps_.requires_typed_content;
+        auto polyfill_tool_calls = opts.polyfill_tool_calls && has_tool_calls && !probed.caps.supports_tool_calls;
+        auto polyfill_tool_responses = opts.polyfill_tool_responses && has_tool_responses && !probed.caps.supports_tool_responses;
+        auto polyfill_object_arguments = opts.polyfill_object_arguments && has_tool_calls && probed.caps.requires_object_arguments;
+        auto polyfill_typed_content = opts.polyfill_typed_content && has_string_content && probed.caps.requires_typed_content;
 
         auto needs_polyfills = opts.apply_polyfills && (false
             || polyfill_system_role
@@ -371,121 +965,68 @@ class chat_template {
             || polyfill_typed_content
         );
 
+        // Messages the polyfills don't change are borrowed as they are. The others are rewritten once (and their
+        // rewrites cached, as conversations send the same tool calls & responses again on every turn).
+        auto actual_messages = minja::Value::array();
+        std::deque<json> owned_messages;
+        std::vector<std::shared_ptr<const json>> cached_messages;
         if (needs_polyfills) {
-            actual_messages = json::array();
-
             auto add_message = [&](const json & msg) {
                 if (polyfill_typed_content && msg.contains("content") && !msg.at("content").is_null() && msg.at("content").is_string()) {
-                    actual_messages.push_back({
+                    owned_messages.push_back({
                         {"role", msg.at("role")},
                         {"content", {{
                             {"type", "text"},
                             {"text", msg.at("content")},
                         }}},
                     });
+                    actual_messages.push_back(minja::Value::borrowed(owned_messages.back()));
                 } else {
-                    actual_messages.push_back(msg);
+                    actual_messages.push_back(minja::Value::borrowed(msg));
                 }
             };
 
             std::string pending_system;
             auto flush_sys = [&]() {
                 if (!pending_system.empty()) {
-                    add_message({
+                    owned_messages.push_back({
                         {"role", "user"},
                         {"content", pending_system},
                     });
+                    add_message(owned_messages.back());
                     pending_system.clear();
                 }
             };
 
-            json adjusted_messages;
-            if (polyfill_tools) {
-                adjusted_messages = add_system(inputs.messages,
-                    "You can call any of the following tools to satisfy the user's requests: " + minja::Value(inputs.tools).dump(2, /* to_json= */ true) +
-                    (!polyfill_tool_call_example || tool_call_example_.empty() ? "" : "\n\nExample tool call syntax:\n\n" + tool_call_example_ + "\n\n"));
-            } else {
-                adjusted_messages = inputs.messages;
-            }
-
-            for (const auto & message_ : adjusted_messages) {
-                auto message = message_;
-                if (!message.contains("role") || (!message.contains("content") && !message.contains("tool_calls"))) {
-                    throw std::runtime_error("message must have 'role' and one of 'content' or 'tool_calls' fields: " + message.dump());
-                }
-                std::string role = message.at("role");
-
-                if (message.contains("tool_calls")) {
-                    if (polyfill_object_arguments || polyfill_tool_calls) {
-                        for (auto & tool_call : message.at("tool_calls")) {
-                            if (tool_call["type"] == "function") {
-                                auto & function = tool_call.at("function");
-                                auto & arguments = function.at("arguments");
-                                if (arguments.is_string()) {
-                                    try {
-                                        arguments = json::parse(arguments.get<std::string>());
-                                    } catch (const std::exception & ecvt) {
-                                        fprintf(stderr, "Failed to parse arguments: %s\n", ecvt.what());
-                                    }
-                                }
-                            }
-                        }
-                    }
-                    if (polyfill_tool_calls) {
-                        auto tool_calls = json::array();
-                        for (const auto & tool_call : message.at("tool_calls")) {
-                            if (tool_call.at("type") != "function") {
-                                continue;
-                            }
-                            const auto & function = tool_call.at("function");
-                            auto tc = json {
-                                {"name", function.at("name")},
-                                {"arguments", function.at("arguments")},
-                            };
-                            if (tool_call.contains("id")) {
-                                tc["id"] = tool_call["id"];
-                            }
-                            tool_calls.push_back(tc);
-                        }
-                        auto obj = json {
-                            {"tool_calls", tool_calls},
-                        };
-                        if (message.contains("content")) {
-                            auto content = message.at("content");
-                            if (!content.is_null() && !content.empty()) {
-                                obj["content"] = content;
-                            }
-                        }
-                        message["content"] = obj.dump(2);
-                        message.erase("tool_calls");
-                    }
+            auto rewrites = (polyfill_object_arguments ? 1 : 0) | (polyfill_tool_calls ? 2 : 0) | (polyfill_tool_responses ? 4 : 0);
+            auto add_polyfilled = [&](const json & original) {
+                if (!original.contains("role") || (!original.contains("content") && !original.contains("tool_calls"))) {
+                    throw std::runtime_error("message must have 'role' and one of 'content' or 'tool_calls' fields: " + original.dump());
                 }
-                if (polyfill_tool_responses && role == "tool") {
-                    message["role"] = "user";
-                    auto obj = json {
-                        {"tool_response", json::object()},
-                    };
-                    if (message.contains("name")) {
-                        obj["tool_response"]["tool"] = message.at("name");
-                    }
-                    obj["tool_response"]["content"] = message.at("content");
-                    if (message.contains("tool_call_id")) {
-                        obj["tool_response"]["tool_call_id"] = message.at("tool_call_id");
-                    }
-                    message["content"] = obj.dump(2);
-                    message.erase("name");
+                std::string role = original.at("role");
+
+                const json * message = &original;
+                if (!original.contains("content")
+                        || ((polyfill_object_arguments || polyfill_tool_calls) && original.contains("tool_calls"))
+                        || (polyfill_tool_responses && role == "tool")) {
+                    cached_messages.push_back(polyfilled_messages_->get_or_compute(original, rewrites, [&]() {
+                        return polyfill_message(original, polyfill_object_arguments, polyfill_tool_calls, polyfill_tool_responses);
+                    }));
+                    message = cached_messages.back().get();
                 }
 
-                if (!message["content"].is_null() && polyfill_system_role) {
-                    std::string content = message.at("content");
+                if (!message->at("content").is_null() && polyfill_system_role) {
+                    std::string content = message->at("content");
                     if (role == "system") {
                         if (!pending_system.empty()) pending_system += "\n";
                         pending_system += content;
-                        continue;
+                        return;
                     } else {
                         if (role == "user") {
                             if (!pending_system.empty()) {
-                                message["content"] = pending_system + (content.empty() ? "" : "\n" + content);
+                                owned_messages.push_back(*message);
+                                owned_messages.back()["content"] = pending_system + (content.empty() ? "" : "\n" + content);
+                                message = &owned_messages.back();
                                 pending_system.clear();
                             }
                         } else {
@@ -493,17 +1034,39 @@ class chat_template {
                         }
                     }
                 }
-                add_message(message);
+                add_message(*message);
+            };
+
+            size_t first = 0;
+            if (polyfill_tools) {
+                // Same as add_system, but w/o copying the messages.
+                auto tools_prompt = tools_prompts_->get_or_compute(inputs.tools, 0, [&]() {
+                    return minja::Value::borrowed(inputs.tools).dump(2, /* to_json= */ true);
+                });
+                auto system_prompt = "You can call any of the following tools to satisfy the user's requests: " + *tools_prompt +
+                    (!polyfill_tool_call_example || probed.tool_call_example.empty() ? "" : "\n\nExample tool call syntax:\n\n" + probed.tool_call_example + "\n\n");
+                if (!messages.empty() && messages[0].at("role") == "system") {
+                    std::string existing_system = messages.at(0).at("content");
+                    system_prompt = existing_system + "\n\n" + system_prompt;
+                    first = 1;
+                }
+                owned_messages.push_back({
+                    {"role", "system"},
+                    {"content", std::move(system_prompt)},
+                });
+                add_polyfilled(owned_messages.back());
+            }
+            for (size_t i = first; i < messages.size(); i++) {
+                add_polyfilled(messages[i]);
             }
             flush_sys();
-        } else {
-            actual_messages = inputs.messages;
         }
 
-        auto context = minja::Context::make(json({
-            {"messages", actual_messages},
-            {"add_generation_prompt", inputs.add_generation_prompt},
-        }));
+        // The inputs are borrowed (not copied) for the duration of the render: only what the template reads gets converted.
+        auto values = minja::Value::object();
+        values.set("messages", needs_polyfills ? actual_messages : minja::Value::borrowed(messages));
+        values.set("add_generation_prompt", add_generation_prompt);
+        auto context = minja::Context::make(std::move(values));
         context->set("bos_token", opts.use_bos_token ? bos_token_ : "");
         context->set("eos_token", opts.use_eos_token ? eos_token_ : "");
         if (opts.define_strftime_now) {
@@ -513,27 +1076,30 @@ class chat_template {
                 auto format = args.args[0].get<std::string>();
 
                 auto time = std::chrono::system_clock::to_time_t(now);
-                auto local_time = *std::localtime(&time);
+                std::tm local_time;
+#ifdef _WIN32
+                localtime_s(&local_time, &time);
+#else
+                localtime_r(&time, &local_time);
+#endif
                 std::ostringstream ss;
                 ss << std::put_time(&local_time, format.c_str());
                 return ss.str();
             }));
         }
         if (!inputs.tools.is_null()) {
-            context->set("tools", minja::Value(inputs.tools));
+            context->set("tools", minja::Value::borrowed(inputs.tools));
         }
         if (!inputs.extra_context.is_null()) {
             for (auto & kv : inputs.extra_context.items()) {
-                context->set(kv.key(), minja::Value(kv.value()));
+                context->set(kv.key(), minja::Value::borrowed(kv.value()));
             }
         }
 
-        auto ret = template_root_->render(context);
-        // fprintf(stderr, "actual_messages: %s\n", actual_messages.dump(2).c_str());
-        // fprintf(stderr, "apply: %s\n\n", ret.c_str());
-        return ret;
+        template_root_->render(sink, context);
     }
 
+  public:
     static nlohmann::ordered_json add_system(const nlohmann::ordered_json & messages, const std::string & system_prompt) {
         json messages_with_system = messages;
 
@@ -13,20 +13,27 @@
 #include <cstddef>
 #include <cstdint>
 #include <cmath>
+#include <cstdio>
+#include <cstring>
 #include <exception>
 #include <functional>
 #include <iostream>
 #include <iterator>
 #include <limits>
+#include <list>
 #include <map>
 #include <memory>
-#include <regex>
+#include <mutex>
+#include <optional>
 #include <sstream>
 #include <string>
+#include <string_view>
 #include <stdexcept>
+#include <type_traits>
 #include <unordered_map>
 #include <unordered_set>
 #include <utility>
+#include <variant>
 #include <vector>
 
 #include <nlohmann/json.hpp>
@@ -47,8 +54,13 @@ struct ArgumentsValue;
 
 inline std::string normalize_newlines(const std::string & s) {
 #ifdef _WIN32
-  static const std::regex nl_regex("\r\n");
-  return std::regex_replace(s, nl_regex, "\n");
+  std::string result;
+  result.reserve(s.size());
+  for (size_t i = 0, n = s.size(); i < n; ++i) {
+    if (s[i] == '\r' && i + 1 < n && s[i + 1] == '\n') continue;
+    result += s[i];
+  }
+  return result;
 #else
   return s;
 #endif
@@ -61,22 +73,169 @@ public:
   using FilterType = std::function<Value(const std::shared_ptr<Context> &, ArgumentsValue &)>;
 
 private:
-  using ObjectType = nlohmann::ordered_map<json, Value>;  // Only contains primitive keys
+  using ObjectType = nlohmann::ordered_map<Value, Value>;  // Only contains primitive keys
   using ArrayType = std::vector<Value>;
 
-  std::shared_ptr<ArrayType> array_;
-  std::shared_ptr<ObjectType> object_;
-  std::shared_ptr<CallableType> callable_;
-  json primitive_;
+  // Strings that fit are stored inline (no allocation), longer ones are shared (strings are never mutated in place).
+  struct ShortString {
+    static constexpr size_t capacity = 22;
+    char data[capacity];
+    uint8_t size;
+  };
+  // Callables are also objects (they can carry attributes).
+  struct CallableObject {
+    CallableType callable;
+    ObjectType object;
+  };
+  // A borrowed json array or object (see borrowed()), converted one level at a time when its items are first accessed.
+  // Copies share the conversion, so they see each other's updates as for other arrays & objects.
+  struct JsonNode {
+    const json * node;
+    std::shared_ptr<ArrayType> array;
+    std::shared_ptr<ObjectType> object;
+  };
+
+  std::variant<
+    std::monostate,
+    bool,
+    int64_t,
+    uint64_t, // Only for integers beyond int64_t's range (as nlohmann::json's unsigned numbers).
+    double,
+    ShortString,
+    std::shared_ptr<const std::string>,
+    std::shared_ptr<ArrayType>,
+    std::shared_ptr<ObjectType>,
+    std::shared_ptr<CallableObject>,
+    std::shared_ptr<JsonNode>
+  > storage_;
+
+  Value(const std::shared_ptr<ArrayType> & array) { if (array) storage_ = array; }
+  Value(const std::shared_ptr<ObjectType> & object) { if (object) storage_ = object; }
+  Value(const std::shared_ptr<CallableObject> & callable) : storage_(callable) {}
+  Value(const std::shared_ptr<JsonNode> & node) : storage_(node) {}
+
+  JsonNode * json_node() const {
+    auto node = std::get_if<std::shared_ptr<JsonNode>>(&storage_);
+    return node ? node->get() : nullptr;
+  }
+  // The borrowed json, as long as it's unconverted (its items can't have been accessed, let alone updated).
+  const json * pristine_json() const {
+    auto node = json_node();
+    return node && !node->array && !node->object ? node->node : nullptr;
+  }
+  static void convert(JsonNode & node) {
+    if (node.node->is_array()) {
+      node.array = std::make_shared<ArrayType>();
+      node.array->reserve(node.node->size());
+      for (const auto & item : *node.node) node.array->push_back(borrowed(item));
+    } else {
+      node.object = std::make_shared<ObjectType>();
+      node.object->reserve(node.node->size());
+      for (auto it = node.node->begin(); it != node.node->end(); ++it) node.object->emplace_back(it.key(), borrowed(it.value()));
+    }
+  }
+
+  ArrayType * array_ptr() const {
+    if (auto array = std::get_if<std::shared_ptr<ArrayType>>(&storage_)) return array->get();
+    if (auto node = json_node(); node && node->node->is_array()) {
+      if (!node->array) convert(*node);
+      return node->array.get();
+    }
+    return nullptr;
+  }
+  ObjectType * object_ptr() const {
+    if (auto object = std::get_if<std::shared_ptr<ObjectType>>(&storage_)) return object->get();
+    if (auto callable = std::get_if<std::shared_ptr<CallableObject>>(&storage_)) return &(*callable)->object;
+    if (auto node = json_node(); node && node->node->is_object()) {
+      if (!node->object) convert(*node);
+      return node->object.get();
+    }
+    return nullptr;
+  }
+  const CallableType * callable_ptr() const {
+    auto callable = std::get_if<std::shared_ptr<CallableObject>>(&storage_);
+    return callable ? &(*callable)->callable : nullptr;
+  }
+
+  void set_string(const char * data, size_t size) {
+    if (size <= ShortString::capacity) {
+      ShortString s {};
+      std::memcpy(s.data, data, size);
+      s.size = static_cast<uint8_t>(size);
+      storage_ = s;
+    } else {
+      storage_ = std::make_shared<const std::string>(data, size);
+    }
+  }
+  std::string_view string_view() const {
+    if (auto s = std::get_if<ShortString>(&storage_)) return std::string_view(s->data, s->size);
+    return *std::get<std::shared_ptr<const std::string>>(storage_);
+  }
 
-  Value(const std::shared_ptr<ArrayType> & array) : array_(array) {}
-  Value(const std::shared_ptr<ObjectType> & object) : object_(object) {}
-  Value(const std::shared_ptr<CallableType> & callable) : object_(std::make_shared<ObjectType>()), callable_(callable) {}
+  json primitive_json() const {
+    if (auto b = std::get_if<bool>(&storage_)) return *b;
+    if (auto i = std::get_if<int64_t>(&storage_)) return *i;
+    if (auto u = std::get_if<uint64_t>(&storage_)) return *u;
+    if (auto d = std::get_if<double>(&storage_)) return *d;
+    if (is_string()) return std::string(string_view());
+    return json();
+  }
+  // Same semantics as nlohmann::json's operator== on primitives (numbers compare by value, bools are not numbers).
+  bool primitive_equals(const Value & other) const {
+    if (is_number() && other.is_number()) {
+      if (is_number_integer() && other.is_number_integer()) return get<int64_t>() == other.get<int64_t>();
+      return get<double>() == other.get<double>();
+    }
+    if (is_string() && other.is_string()) return string_view() == other.string_view();
+    if (auto b = std::get_if<bool>(&storage_)) {
+      auto other_b = std::get_if<bool>(&other.storage_);
+      return other_b && *b == *other_b;
+    }
+    return is_null() && other.storage_.index() == 0;
+  }
+
+  /* JSON string literal, as nlohmann::json would dump it (non-ASCII strings are validated by json itself). */
+  static std::string json_string(std::string_view s) {
+    for (unsigned char c : s) {
+      if (c >= 0x80) return json(std::string(s)).dump();
+    }
+    std::string out;
+    out.reserve(s.size() + 2);
+    out += '"';
+    for (char c : s) {
+      switch (c) {
+        case '"': out += "\\\""; break;
+        case '\\': out += "\\\\"; break;
+        case '\b': out += "\\b"; break;
+        case '\f': out += "\\f"; break;
+        case '\n': out += "\\n"; break;
+        case '\r': out += "\\r"; break;
+        case '\t': out += "\\t"; break;
+        default:
+          if (static_cast<unsigned char>(c) < 0x20) {
+            char buf[7];
+            std::snprintf(buf, sizeof(buf), "\\u%04x", static_cast<unsigned int>(c));
+            out += buf;
+          } else {
+            out += c;
+          }
+      }
+    }
+    out += '"';
+    return out;
+  }
+  void dump_json_primitive(std::ostringstream & out) const {
+    if (auto b = std::get_if<bool>(&storage_)) out << (*b ? "true" : "false");
+    else if (auto i = std::get_if<int64_t>(&storage_)) out << *i;
+    else if (auto u = std::get_if<uint64_t>(&storage_)) out << *u;
+    else if (auto d = std::get_if<double>(&storage_)) out << json(*d).dump();
+    else if (is_string()) out << json_string(string_view());
+    else out << "null";
+  }
 
   /* Python-style string repr */
-  static void dump_string(const json & primitive, std::ostringstream & out, char string_quote = '\'') {
-    if (!primitive.is_string()) throw std::runtime_error("Value is not a string: " + primitive.dump());
-    auto s = primitive.dump();
+  static void dump_string(std::string_view str, std::ostringstream & out, char string_quote = '\'') {
+    auto s = json_string(str);
     if (string_quote == '"' || s.find('\'') != std::string::npos) {
       out << s;
       return;
@@ -95,65 +254,95 @@ private:
     }
     out << string_quote;
   }
-  void dump(std::ostringstream & out, int indent = -1, int level = 0, bool to_json = false) const {
-    auto print_indent = [&](int level) {
-      if (indent > 0) {
-          out << "\n";
-          for (int i = 0, n = level * indent; i < n; ++i) out << ' ';
+  static void print_indent(std::ostringstream & out, int indent, int level) {
+    if (indent > 0) {
+        out << "\n";
+        for (int i = 0, n = level * indent; i < n; ++i) out << ' ';
+    }
+  }
+  static void print_sub_sep(std::ostringstream & out, int indent, int level) {
+    out << ',';
+    if (indent < 0) out << ' ';
+    else print_indent(out, indent, level + 1);
+  }
+  /* Same output as dump() on the conversion of a json value, without converting it. */
+  static void dump(const json & j, std::ostringstream & out, int indent, int level, bool to_json) {
+    auto string_quote = to_json ? '"' : '\'';
+    if (j.is_array() || j.is_object()) {
+      auto is_array = j.is_array();
+      out << (is_array ? "[" : "{");
+      print_indent(out, indent, level + 1);
+      for (auto begin = j.begin(), it = begin; it != j.end(); ++it) {
+        if (it != begin) print_sub_sep(out, indent, level);
+        if (!is_array) {
+          dump_string(it.key(), out, string_quote);
+          out << ": ";
+        }
+        dump(it.value(), out, indent, level + 1, to_json);
       }
-    };
-    auto print_sub_sep = [&]() {
-      out << ',';
-      if (indent < 0) out << ' ';
-      else print_indent(level + 1);
-    };
+      print_indent(out, indent, level);
+      out << (is_array ? "]" : "}");
+    } else if (j.is_string()) {
+      const auto & s = j.get_ref<const std::string &>();
+      if (to_json) out << json_string(s);
+      else dump_string(s, out, string_quote);
+    } else {
+      Value(j).dump(out, indent, level, to_json);
+    }
+  }
+  void dump(std::ostringstream & out, int indent = -1, int level = 0, bool to_json = false) const {
+    auto print_indent = [&](int level) { Value::print_indent(out, indent, level); };
+    auto print_sub_sep = [&]() { Value::print_sub_sep(out, indent, level); };
 
     auto string_quote = to_json ? '"' : '\'';
 
     if (is_null()) out << "null";
-    else if (array_) {
+    else if (auto j = pristine_json()) dump(*j, out, indent, level, to_json);
+    else if (auto array = array_ptr()) {
       out << "[";
       print_indent(level + 1);
-      for (size_t i = 0; i < array_->size(); ++i) {
+      for (size_t i = 0; i < array->size(); ++i) {
         if (i) print_sub_sep();
-        (*array_)[i].dump(out, indent, level + 1, to_json);
+        (*array)[i].dump(out, indent, level + 1, to_json);
       }
       print_indent(level);
       out << "]";
-    } else if (object_) {
+    } else if (auto object = object_ptr()) {
       out << "{";
       print_indent(level + 1);
-      for (auto begin = object_->begin(), it = begin; it != object_->end(); ++it) {
+      for (auto begin = object->begin(), it = begin; it != object->end(); ++it) {
         if (it != begin) print_sub_sep();
         if (it->first.is_string()) {
-          dump_string(it->first, out, string_quote);
+          dump_string(it->first.string_view(), out, string_quote);
         } else {
-          out << string_quote << it->first.dump() << string_quote;
+          out << string_quote;
+          it->first.dump_json_primitive(out);
+          out << string_quote;
         }
         out << ": ";
         it->second.dump(out, indent, level + 1, to_json);
       }
       print_indent(level);
       out << "}";
-    } else if (callable_) {
+    } else if (is_callable()) {
       throw std::runtime_error("Cannot dump callable to JSON");
     } else if (is_boolean() && !to_json) {
       out << (this->to_bool() ? "True" : "False");
     } else if (is_string() && !to_json) {
-      dump_string(primitive_, out, string_quote);
+      dump_string(string_view(), out, string_quote);
     } else {
-      out << primitive_.dump();
+      dump_json_primitive(out);
     }
   }
 
 public:
   Value() {}
-  Value(const bool& v) : primitive_(v) {}
-  Value(const int64_t & v) : primitive_(v) {}
-  Value(const double& v) : primitive_(v) {}
+  Value(const bool& v) : storage_(v) {}
+  Value(const int64_t & v) : storage_(v) {}
+  Value(const double& v) : storage_(v) {}
   Value(const std::nullptr_t &) {}
-  Value(const std::string & v) : primitive_(v) {}
-  Value(const char * v) : primitive_(std::string(v)) {}
+  Value(const std::string & v) { set_string(v.data(), v.size()); }
+  Value(const char * v) { set_string(v, std::strlen(v)); }
 
   Value(const json & v) {
     if (v.is_object()) {
@@ -162,32 +351,65 @@ public:
       for (auto it = v.begin(); it != v.end(); ++it) {
         object->emplace_back(it.key(), Value(it.value()));
       }
-      object_ = std::move(object);
+      storage_ = std::move(object);
     } else if (v.is_array()) {
       auto array = std::make_shared<ArrayType>();
       array->reserve(v.size());
       for (const auto& item : v) {
         array->push_back(Value(item));
       }
-      array_ = array;
-    } else {
-      primitive_ = v;
+      storage_ = std::move(array);
+    } else if (v.is_boolean()) {
+      storage_ = v.get<bool>();
+    } else if (v.is_number_unsigned()) {
+      auto u = v.get<uint64_t>();
+      if (u <= static_cast<uint64_t>(std::numeric_limits<int64_t>::max())) storage_ = static_cast<int64_t>(u);
+      else storage_ = u;
+    } else if (v.is_number_integer()) {
+      storage_ = v.get<int64_t>();
+    } else if (v.is_number_float()) {
+      storage_ = v.get<double>();
+    } else if (v.is_string()) {
+      const auto & s = v.get_ref<const std::string &>();
+      set_string(s.data(), s.size());
+    } else if (!v.is_null()) {
+      throw std::runtime_error("Unsupported JSON value type: " + std::string(v.type_name()));
+    }
+  }
+
+  /**
+    Like Value(v), but arrays & objects are only converted as their items get accessed, and long strings aren't copied.
+    v must outlive the value and its copies (e.g. the inputs of a render). As with other values, they're not thread-safe.
+  */
+  static Value borrowed(const json & v) {
+    if (v.is_array() || v.is_object()) return Value(std::make_shared<JsonNode>(JsonNode {&v, nullptr, nullptr}));
+    if (v.is_string()) {
+      const auto & s = v.get_ref<const std::string &>();
+      if (s.size() > ShortString::capacity) {
+        Value value;
+        // Aliasing constructor w/o an owner: points to v's string.
+        value.storage_ = std::shared_ptr<const std::string>(std::shared_ptr<const std::string>(), &s);
+        return value;
+      }
     }
+    return Value(v);
   }
 
   std::vector<Value> keys() {
-    if (!object_) throw std::runtime_error("Value is not an object: " + dump());
+    auto object = object_ptr();
+    if (!object) throw std::runtime_error("Value is not an object: " + dump());
     std::vector<Value> res;
-    for (const auto& item : *object_) {
+    for (const auto& item : *object) {
       res.push_back(item.first);
     }
     return res;
   }
 
   size_t size() const {
-    if (is_object()) return object_->size();
-    if (is_array()) return array_->size();
-    if (is_string()) return primitive_.get<std::string>().length();
+    if (auto j = pristine_json()) return j->size();
+    if (auto object = object_ptr()) return object->size();
+    if (auto array = array_ptr()) return array->size();
+    if (is_string()) return string_view().size();
     throw std::runtime_error("Value is not an array or object: " + dump());
   }
 
@@ -202,113 +424,132 @@ public:
     return Value(object);
   }
   static Value callable(const CallableType & callable) {
-    return Value(std::make_shared<CallableType>(callable));
+    return Value(std::make_shared<CallableObject>(CallableObject {callable, {}}));
   }
 
   void insert(size_t index, const Value& v) {
-    if (!array_)
+    auto array = array_ptr();
+    if (!array)
       throw std::runtime_error("Value is not an array: " + dump());
-    array_->insert(array_->begin() + index, v);
+    array->insert(array->begin() + index, v);
   }
   void push_back(const Value& v) {
-    if (!array_)
+    auto array = array_ptr();
+    if (!array)
       throw std::runtime_error("Value is not an array: " + dump());
-    array_->push_back(v);
+    array->push_back(v);
   }
   Value pop(const Value& index) {
-    if (is_array()) {
-      if (array_->empty())
+    if (auto array = array_ptr()) {
+      if (array->empty())
         throw std::runtime_error("pop from empty list");
       if (index.is_null()) {
-        auto ret = array_->back();
-        array_->pop_back();
+        auto ret = array->back();
+        array->pop_back();
         return ret;
       } else if (!index.is_number_integer()) {
         throw std::runtime_error("pop index must be an integer: " + index.dump());
       } else {
         auto i = index.get<int>();
-        if (i < 0 || i >= static_cast<int>(array_->size()))
+        if (i < 0 || i >= static_cast<int>(array->size()))
           throw std::runtime_error("pop index out of range: " + index.dump());
-        auto it = array_->begin() + (i < 0 ? array_->size() + i : i);
+        auto it = array->begin() + (i < 0 ? array->size() + i : i);
         auto ret = *it;
-        array_->erase(it);
+        array->erase(it);
         return ret;
       }
-    } else if (is_object()) {
+    } else if (auto object = object_ptr()) {
       if (!index.is_hashable())
         throw std::runtime_error("Unhashable type: " + index.dump());
-      auto it = object_->find(index.primitive_);
-      if (it == object_->end())
+      auto it = object->find(index);
+      if (it == object->end())
         throw std::runtime_error("Key not found: " + index.dump());
       auto ret = it->second;
-      object_->erase(it);
+      object->erase(it);
       return ret;
     } else {
       throw std::runtime_error("Value is not an array or object: " + dump());
     }
   }
   Value get(const Value& key) {
-    if (array_) {
+    if (auto array = array_ptr()) {
       if (!key.is_number_integer()) {
         return Value();
       }
       auto index = key.get<int>();
-      return array_->at(index < 0 ? array_->size() + index : index);
-    } else if (object_) {
+      return array->at(index < 0 ? array->size() + index : index);
+    } else if (auto object = object_ptr()) {
       if (!key.is_hashable()) throw std::runtime_error("Unhashable type: " + dump());
-      auto it = object_->find(key.primitive_);
-      if (it == object_->end()) return Value();
+      auto it = object->find(key);
+      if (it == object->end()) return Value();
       return it->second;
     }
     return Value();
   }
   void set(const Value& key, const Value& value) {
-    if (!object_) throw std::runtime_error("Value is not an object: " + dump());
+    auto object = object_ptr();
+    if (!object) throw std::runtime_error("Value is not an object: " + dump());
     if (!key.is_hashable()) throw std::runtime_error("Unhashable type: " + dump());
-    (*object_)[key.primitive_] = value;
+    (*object)[key] = value;
+  }
+  /** Pointer to the value of an object's key (nullptr if absent), in a single lookup. */
+  Value * find(const Value& key) {
+    auto object = object_ptr();
+    if (!object) throw std::runtime_error("Value is not an object: " + dump());
+    if (!key.is_hashable()) throw std::runtime_error("Unhashable type: " + dump());
+    auto it = object->find(key);
+    return it == object->end() ? nullptr : &it->second;
   }
   Value call(const std::shared_ptr<Context> & context, ArgumentsValue & args) const {
-    if (!callable_) throw std::runtime_error("Value is not callable: " + dump());
-    return (*callable_)(context, args);
-  }
-
-  bool is_object() const { return !!object_; }
-  bool is_array() const { return !!array_; }
-  bool is_callable() const { return !!callable_; }
-  bool is_null() const { return !object_ && !array_ && primitive_.is_null() && !callable_; }
-  bool is_boolean() const { return primitive_.is_boolean(); }
-  bool is_number_integer() const { return primitive_.is_number_integer(); }
-  bool is_number_float() const { return primitive_.is_number_float(); }
-  bool is_number() const { return primitive_.is_number(); }
-  bool is_string() const { return primitive_.is_string(); }
+    auto callable = callable_ptr();
+    if (!callable) throw std::runtime_error("Value is not callable: " + dump());
+    return (*callable)(context, args);
+  }
+
+  bool is_object() const {
+    if (auto node = json_node()) return node->node->is_object();
+    return object_ptr() != nullptr;
+  }
+  bool is_array() const {
+    if (auto node = json_node()) return node->node->is_array();
+    return std::holds_alternative<std::shared_ptr<ArrayType>>(storage_);
+  }
+  bool is_callable() const { return std::holds_alternative<std::shared_ptr<CallableObject>>(storage_); }
+  bool is_null() const { return std::holds_alternative<std::monostate>(storage_); }
+  bool is_boolean() const { return std::holds_alternative<bool>(storage_); }
+  bool is_number_integer() const { return std::holds_alternative<int64_t>(storage_) || std::holds_alternative<uint64_t>(storage_); }
+  bool is_number_float() const { return std::holds_alternative<double>(storage_); }
+  bool is_number() const { return is_number_integer() || is_number_float(); }
+  bool is_string() const { return std::holds_alternative<ShortString>(storage_) || std::holds_alternative<std::shared_ptr<const std::string>>(storage_); }
   bool is_iterable() const { return is_array() || is_object() || is_string(); }
 
-  bool is_primitive() const { return !array_ && !object_ && !callable_; }
+  bool is_primitive() const { return !is_array() && !is_object(); }
   bool is_hashable() const { return is_primitive(); }
 
   bool empty() const {
     if (is_null())
       throw std::runtime_error("Undefined value or reference");
-    if (is_string()) return primitive_.empty();
-    if (is_array()) return array_->empty();
-    if (is_object()) return object_->empty();
+    if (is_string()) return string_view().empty();
+    if (auto j = pristine_json()) return j->empty();
+    if (auto array = array_ptr()) return array->empty();
+    if (auto object = object_ptr()) return object->empty();
     return false;
   }
 
   void for_each(const std::function<void(Value &)> & callback) const {
     if (is_null())
       throw std::runtime_error("Undefined value or reference");
-    if (array_) {
-      for (auto& item : *array_) {
+    if (auto array = array_ptr()) {
+      for (auto& item : *array) {
         callback(item);
       }
-    } else if (object_) {
-      for (auto & item : *object_) {
+    } else if (auto object = object_ptr()) {
+      for (auto & item : *object) {
         Value key(item.first);
         callback(key);
       }
     } else if (is_string()) {
-      for (char c : primitive_.get<std::string>()) {
+      for (char c : string_view()) {
         auto val = Value(std::string(1, c));
         callback(val);
       }
@@ -321,7 +562,7 @@ public:
     if (is_null()) return false;
     if (is_boolean()) return get<bool>();
     if (is_number()) return get<double>() != 0;
-    if (is_string()) return !get<std::string>().empty();
+    if (is_string()) return !string_view().empty();
     if (is_array()) return !empty();
     return true;
   }
@@ -344,7 +585,7 @@ public:
     if (is_null())
       throw std::runtime_error("Undefined value or reference");
     if (is_number() && other.is_number()) return get<double>() < other.get<double>();
-    if (is_string() && other.is_string()) return get<std::string>() < other.get<std::string>();
+    if (is_string() && other.is_string()) return string_view() < other.string_view();
     throw std::runtime_error("Cannot compare values: " + dump() + " < " + other.dump());
   }
   bool operator>=(const Value & other) const { return !(*this < other); }
@@ -353,41 +594,48 @@ public:
     if (is_null())
       throw std::runtime_error("Undefined value or reference");
     if (is_number() && other.is_number()) return get<double>() > other.get<double>();
-    if (is_string() && other.is_string()) return get<std::string>() > other.get<std::string>();
+    if (is_string() && other.is_string()) return string_view() > other.string_view();
     throw std::runtime_error("Cannot compare values: " + dump() + " > " + other.dump());
   }
   bool operator<=(const Value & other) const { return !(*this > other); }
 
   bool operator==(const Value & other) const {
-    if (callable_ || other.callable_) {
-      if (callable_.get() != other.callable_.get()) return false;
+    if (is_primitive() && other.is_primitive()) return primitive_equals(other);
+    auto callable = callable_ptr(), other_callable = other.callable_ptr();
+    if (callable || other_callable) {
+      if (callable != other_callable) return false;
     }
-    if (array_) {
-      if (!other.array_) return false;
-      if (array_->size() != other.array_->size()) return false;
-      for (size_t i = 0; i < array_->size(); ++i) {
-        if (!(*array_)[i].to_bool() || !(*other.array_)[i].to_bool() || (*array_)[i] != (*other.array_)[i]) return false;
+    if (auto array = array_ptr()) {
+      auto other_array = other.array_ptr();
+      if (!other_array) return false;
+      if (array->size() != other_array->size()) return false;
+      for (size_t i = 0; i < array->size(); ++i) {
+        if (!(*array)[i].to_bool() || !(*other_array)[i].to_bool() || (*array)[i] != (*other_array)[i]) return false;
       }
       return true;
-    } else if (object_) {
-      if (!other.object_) return false;
-      if (object_->size() != other.object_->size()) return false;
-      for (const auto& item : *object_) {
-        if (!item.second.to_bool() || !other.object_->count(item.first) || item.second != other.object_->at(item.first)) return false;
+    } else if (auto object = object_ptr()) {
+      auto other_object = other.object_ptr();
+      if (!other_object) return false;
+      if (object->size() != other_object->size()) return false;
+      for (const auto& item : *object) {
+        if (!item.second.to_bool() || !other_object->count(item.first) || item.second != other_object->at(item.first)) return false;
       }
       return true;
     } else {
-      return primitive_ == other.primitive_;
+      // Primitive vs. container: only None compares equal (as before the compact representation).
+      return is_null();
     }
   }
   bool operator!=(const Value & other) const { return !(*this == other); }
 
   bool contains(const char * key) const { return contains(std::string(key)); }
   bool contains(const std::string & key) const {
-    if (array_) {
+    if (is_array()) {
       return false;
-    } else if (object_) {
-      return object_->find(key) != object_->end();
+    } else if (auto j = pristine_json()) {
+      return j->contains(key);
+    } else if (auto object = object_ptr()) {
+      return object->find(Value(key)) != object->end();
     } else {
       throw std::runtime_error("contains can only be called on arrays and objects: " + dump());
     }
@@ -395,33 +643,35 @@ public:
   bool contains(const Value & value) const {
     if (is_null())
       throw std::runtime_error("Undefined value or reference");
-    if (array_) {
-      for (const auto& item : *array_) {
+    if (auto array = array_ptr()) {
+      for (const auto& item : *array) {
         if (item.to_bool() && item == value) return true;
       }
       return false;
-    } else if (object_) {
+    } else if (auto object = object_ptr()) {
       if (!value.is_hashable()) throw std::runtime_error("Unhashable type: " + value.dump());
-      return object_->find(value.primitive_) != object_->end();
+      return object->find(value) != object->end();
     } else {
       throw std::runtime_error("contains can only be called on arrays and objects: " + dump());
     }
   }
   void erase(size_t index) {
-    if (!array_) throw std::runtime_error("Value is not an array: " + dump());
-    array_->erase(array_->begin() + index);
+    auto array = array_ptr();
+    if (!array) throw std::runtime_error("Value is not an array: " + dump());
+    array->erase(array->begin() + index);
   }
   void erase(const std::string & key) {
-    if (!object_) throw std::runtime_error("Value is not an object: " + dump());
-    object_->erase(key);
+    auto object = object_ptr();
+    if (!object) throw std::runtime_error("Value is not an object: " + dump());
+    object->erase(Value(key));
   }
   const Value& at(const Value & index) const {
     return const_cast<Value*>(this)->at(index);
   }
   Value& at(const Value & index) {
     if (!index.is_hashable()) throw std::runtime_error("Unhashable type: " + dump());
-    if (is_array()) return array_->at(index.get<int>());
-    if (is_object()) return object_->at(index.primitive_);
+    if (auto array = array_ptr()) return array->at(index.get<int>());
+    if (auto object = object_ptr()) return object->at(index);
     throw std::runtime_error("Value is not an array or object: " + dump());
   }
   const Value& at(size_t index) const {
@@ -430,8 +680,8 @@ public:
   Value& at(size_t index) {
     if (is_null())
       throw std::runtime_error("Undefined value or reference");
-    if (is_array()) return array_->at(index);
-    if (is_object()) return object_->at(index);
+    if (auto array = array_ptr()) return array->at(index);
+    if (auto object = object_ptr()) return object->at(Value(static_cast<int64_t>(index)));
     throw std::runtime_error("Value is not an array or object: " + dump());
   }
 
@@ -443,7 +693,17 @@ public:
 
   template <typename T>
   T get() const {
-    if (is_primitive()) return primitive_.get<T>();
+    if constexpr (std::is_same_v<T, bool>) {
+      if (auto b = std::get_if<bool>(&storage_)) return *b;
+    } else if constexpr (std::is_arithmetic_v<T>) {
+      if (auto i = std::get_if<int64_t>(&storage_)) return static_cast<T>(*i);
+      if (auto u = std::get_if<uint64_t>(&storage_)) return static_cast<T>(*u);
+      if (auto d = std::get_if<double>(&storage_)) return static_cast<T>(*d);
+    } else if constexpr (std::is_same_v<T, std::string>) {
+      if (is_string()) return std::string(string_view());
+    }
+    // Other conversions (and their errors) are nlohmann::json's.
+    if (is_primitive()) return primitive_json().get<T>();
     throw std::runtime_error("get<T> not defined for this value type: " + dump());
   }
 
@@ -460,7 +720,7 @@ public:
         return -get<double>();
   }
   std::string to_str() const {
-    if (is_string()) return get<std::string>();
+    if (is_string()) return std::string(string_view());
     if (is_number_integer()) return std::to_string(get<int64_t>());
     if (is_number_float()) return std::to_string(get<double>());
     if (is_boolean()) return get<bool>() ? "True" : "False";
@@ -474,8 +734,8 @@ public:
         return get<int64_t>() + rhs.get<int64_t>();
       } else if (is_array() && rhs.is_array()) {
         auto res = Value::array();
-        for (const auto& item : *array_) res.push_back(item);
-        for (const auto& item : *rhs.array_) res.push_back(item);
+        for (const auto& item : *array_ptr()) res.push_back(item);
+        for (const auto& item : *rhs.array_ptr()) res.push_back(item);
         return res;
       } else {
         return get<double>() + rhs.get<double>();
@@ -544,22 +804,22 @@ struct ArgumentsValue {
 
 template <>
 inline json Value::get<json>() const {
-  if (is_primitive()) return primitive_;
-  if (is_null()) return json();
-  if (array_) {
+  if (is_primitive()) return primitive_json();
+  if (auto j = pristine_json()) return *j;
+  if (auto array = array_ptr()) {
     std::vector<json> res;
-    for (const auto& item : *array_) {
+    for (const auto& item : *array) {
       res.push_back(item.get<json>());
     }
     return res;
   }
-  if (object_) {
+  if (auto object = object_ptr()) {
     json res = json::object();
-    for (const auto& [key, value] : *object_) {
+    for (const auto& [key, value] : *object) {
       if (key.is_string()) {
         res[key.get<std::string>()] = value.get<json>();
       } else if (key.is_primitive()) {
-        res[key.dump()] = value.get<json>();
+        res[key.primitive_json().dump()] = value.get<json>();
       } else {
         throw std::runtime_error("Invalid key type for conversion to JSON: " + key.dump());
       }
@@ -588,64 +848,138 @@ namespace std {
 namespace minja {
 
 static std::string error_location_suffix(const std::string & source, size_t pos) {
-  auto get_line = [&](size_t line) {
-    auto start = source.begin();
-    for (size_t i = 1; i < line; ++i) {
-      start = std::find(start, source.end(), '\n') + 1;
-    }
-    auto end = std::find(start, source.end(), '\n');
-    return std::string(start, end);
+  // Only scans the source up to the line after pos.
+  auto line_start = [&](size_t p) {
+    auto nl = p == 0 ? std::string::npos : source.rfind('\n', p - 1);
+    return nl == std::string::npos ? 0 : nl + 1;
   };
-  auto start = source.begin();
-  auto end = source.end();
-  auto it = start + pos;
-  auto line = std::count(start, it, '\n') + 1;
-  auto max_line = std::count(start, end, '\n') + 1;
-  auto col = pos - std::string(start, it).rfind('\n');
+  auto line_end = [&](size_t p) {
+    auto nl = source.find('\n', p);
+    return nl == std::string::npos ? source.size() : nl;
+  };
+  auto start = line_start(pos);
+  auto end = line_end(start);
+  auto line = std::count(source.begin(), source.begin() + start, '\n') + 1;
+  auto col = pos - start + 1;
   std::ostringstream out;
   out << " at row " << line << ", column " << col << ":\n";
-  if (line > 1) out << get_line(line - 1) << "\n";
-  out << get_line(line) << "\n";
+  if (line > 1) {
+    auto prev_start = line_start(start - 1);
+    out.write(source.data() + prev_start, start - 1 - prev_start) << "\n";
+  }
+  out.write(source.data() + start, end - start) << "\n";
   out << std::string(col - 1, ' ') << "^\n";
-  if (line < max_line) out << get_line(line + 1) << "\n";
+  if (end < source.size()) {
+    out.write(source.data() + end + 1, line_end(end + 1) - end - 1) << "\n";
+  }
 
   return out.str();
 }
 
+/** Names of the variables bound in the body of a for loop or macro, which get a slot in the contexts rendering it (see VariableExpr). */
+class VariableScope {
+    std::vector<std::string> names_;
+    std::unordered_map<std::string, size_t> indices_;
+  public:
+    static constexpr size_t npos = std::numeric_limits<size_t>::max();
+
+    size_t size() const { return names_.size(); }
+    const std::string & name(size_t index) const { return names_.at(index); }
+    size_t index_of(const std::string & name) const {
+        auto it = indices_.find(name);
+        return it == indices_.end() ? npos : it->second;
+    }
+    size_t declare(const std::string & name) {
+        auto [it, inserted] = indices_.emplace(name, names_.size());
+        if (inserted) names_.push_back(name);
+        return it->second;
+    }
+};
+
 class Context {
   protected:
     Value values_;
     std::shared_ptr<Context> parent_;
+    std::shared_ptr<const VariableScope> scope_;
+    // Values of the variables of scope_ (unset until assigned, in which case lookups fall through to the parent).
+    std::vector<std::optional<Value>> slots_;
+
+    Value * find_local(const Value & key) {
+        if (scope_ && key.is_string()) {
+            auto index = scope_->index_of(key.get<std::string>());
+            if (index != VariableScope::npos) return slots_[index] ? &*slots_[index] : nullptr;
+        }
+        return values_.find(key);
+    }
+
   public:
-    Context(Value && values, const std::shared_ptr<Context> & parent = nullptr) : values_(std::move(values)), parent_(parent) {
+    Context(Value && values, const std::shared_ptr<Context> & parent = nullptr, const std::shared_ptr<const VariableScope> & scope = nullptr)
+        : values_(std::move(values)), parent_(parent), scope_(scope), slots_(scope ? scope->size() : 0) {
         if (!values_.is_object()) throw std::runtime_error("Context values must be an object: " + values_.dump());
     }
     virtual ~Context() {}
 
+    /** Builtin functions & filters: built once, immutable and shared by all contexts (across threads). */
+    static const std::shared_ptr<Context> & shared_builtins();
+    /** A fresh (mutable) context layered on top of the shared builtins. */
     static std::shared_ptr<Context> builtins();
-    static std::shared_ptr<Context> make(Value && values, const std::shared_ptr<Context> & parent = builtins());
+    static std::shared_ptr<Context> make(Value && values, const std::shared_ptr<Context> & parent = shared_builtins());
 
     std::vector<Value> keys() {
-        return values_.keys();
+        auto keys = values_.keys();
+        for (size_t i = 0; i < slots_.size(); i++) {
+            if (slots_[i]) keys.push_back(scope_->name(i));
+        }
+        return keys;
     }
     virtual Value get(const Value & key) {
-        if (values_.contains(key)) return values_.at(key);
+        if (auto value = find_local(key)) return *value;
         if (parent_) return parent_->get(key);
         return Value();
     }
     virtual Value & at(const Value & key) {
-        if (values_.contains(key)) return values_.at(key);
+        if (auto value = find_local(key)) return *value;
         if (parent_) return parent_->at(key);
         throw std::runtime_error("Undefined variable: " + key.dump());
     }
     virtual bool contains(const Value & key) {
-        if (values_.contains(key)) return true;
+        if (find_local(key)) return true;
         if (parent_) return parent_->contains(key);
         return false;
     }
     virtual void set(const Value & key, const Value & value) {
+        if (scope_ && key.is_string()) {
+            auto index = scope_->index_of(key.get<std::string>());
+            if (index != VariableScope::npos) {
+                slots_[index] = value;
+                return;
+            }
+        }
         values_.set(key, value);
     }
+    /**
+      Value of the variable in the given slot of the context `hops` levels up (as resolved at parse time), or nullptr
+      if it isn't set there or if that context doesn't have the expected scope (callers then look the variable up by name).
+    */
+    const Value * find_slot(size_t hops, const VariableScope * scope, size_t index) const {
+        auto context = this;
+        for (; hops > 0 && context; hops--) context = context->parent_.get();
+        if (!context || context->scope_.get() != scope) return nullptr;
+        auto & slot = context->slots_[index];
+        return slot ? &*slot : nullptr;
+    }
+
+  private:
+    static std::shared_ptr<Context> make_builtins();
+};
+
+/* A context whose variables can't be reassigned (used for the shared builtins). */
+class ImmutableContext : public Context {
+  public:
+    using Context::Context;
+    void set(const Value & key, const Value &) override {
+        throw std::runtime_error("Cannot assign " + key.dump() + " in an immutable context");
+    }
 };
 
 struct Location {
@@ -653,6 +987,303 @@ struct Location {
     size_t pos;
 };
 
+/**
+ * Error raised while rendering a template. Carries the original message and the locations of the nodes & expressions
+ * it unwound through (innermost first), which are appended as it propagates rather than baked into new messages.
+ * The location suffix of what() (for the innermost location) is only formatted when it's first called.
+ */
+class TemplateRuntimeError : public std::runtime_error {
+    std::vector<Location> stack_;
+    mutable std::string what_;
+public:
+    TemplateRuntimeError(const std::string & message) : std::runtime_error(message) {}
+    TemplateRuntimeError(const std::string & message, const Location & location) : std::runtime_error(message), stack_ {location} {}
+
+    std::string message() const { return std::runtime_error::what(); }
+    const std::vector<Location> & stack() const { return stack_; }
+    void push(const Location & location) { stack_.push_back(location); }
+
+    const char * what() const noexcept override {
+        if (what_.empty()) {
+            try {
+                what_ = std::runtime_error::what();
+                for (const auto & location : stack_) {
+                    if (location.source) {
+                        what_ += error_location_suffix(*location.source, location.pos);
+                        break;
+                    }
+                }
+            } catch (...) {
+                return std::runtime_error::what();
+            }
+        }
+        return what_.c_str();
+    }
+};
+
+/** Type tags of the binary AST format (see TemplateSerializer). Never renumber: append instead, and bump the format version. */
+enum class AstTag : uint8_t {
+    Null = 0,
+
+    VariableExpr = 1,
+    IfExpr = 2,
+    LiteralExpr = 3,
+    ArrayExpr = 4,
+    DictExpr = 5,
+    SliceExpr = 6,
+    SubscriptExpr = 7,
+    UnaryOpExpr = 8,
+    BinaryOpExpr = 9,
+    MethodCallExpr = 10,
+    CallExpr = 11,
+    FilterExpr = 12,
+
+    SequenceNode = 32,
+    TextNode = 33,
+    ExpressionNode = 34,
+    IfNode = 35,
+    LoopControlNode = 36,
+    ForNode = 37,
+    MacroNode = 38,
+    FilterNode = 39,
+    SetNode = 40,
+    SetTemplateNode = 41,
+    CallNode = 42,
+};
+
+enum class AstValueTag : uint8_t { Null, False, True, Integer, Float, String, Json };
+
+/** Appends the binary encoding of AST nodes: LEB128 varints, length-prefixed strings, little-endian doubles. */
+class AstWriter {
+    std::string out_;
+    // Whether the source is saved too: otherwise all locations are written as 0.
+    bool locations_;
+
+    void write_value_tag(AstValueTag tag) { write_u8(static_cast<uint8_t>(tag)); }
+
+  public:
+    AstWriter(bool locations = true) : locations_(locations) {}
+
+    const std::string & str() const { return out_; }
+
+    void write_u8(uint8_t v) { out_.push_back(static_cast<char>(v)); }
+    void write_tag(AstTag tag) { write_u8(static_cast<uint8_t>(tag)); }
+    void write_bool(bool v) { write_u8(v ? 1 : 0); }
+    void write_varint(uint64_t v) {
+        while (v >= 0x80) {
+            write_u8(static_cast<uint8_t>(v) | 0x80);
+            v >>= 7;
+        }
+        write_u8(static_cast<uint8_t>(v));
+    }
+    void write_bytes(const std::string & bytes) { out_ += bytes; }
+    void write_string(const std::string & s) {
+        write_varint(s.size());
+        write_bytes(s);
+    }
+    void write_strings(const std::vector<std::string> & strings) {
+        write_varint(strings.size());
+        for (const auto & s : strings) write_string(s);
+    }
+    void write_location(const Location & location) { write_varint(locations_ ? location.pos : 0); }
+
+    void write_value(const Value & v) {
+        if (v.is_callable()) throw std::runtime_error("Cannot serialize a callable value");
+        if (v.is_null()) {
+            write_value_tag(AstValueTag::Null);
+        } else if (v.is_boolean()) {
+            write_value_tag(v.get<bool>() ? AstValueTag::True : AstValueTag::False);
+        } else if (v.is_number_integer() && !v.get<json>().is_number_unsigned()) {
+            // Zigzag encoding keeps small negative numbers short (integers beyond int64_t are written as json).
+            auto i = v.get<int64_t>();
+            write_value_tag(AstValueTag::Integer);
+            write_varint((static_cast<uint64_t>(i) << 1) ^ static_cast<uint64_t>(i >> 63));
+        } else if (v.is_number_float()) {
+            auto d = v.get<double>();
+            uint64_t bits;
+            std::memcpy(&bits, &d, sizeof(bits));
+            write_value_tag(AstValueTag::Float);
+            for (int i = 0; i < 8; i++) write_u8(static_cast<uint8_t>(bits >> (8 * i)));
+        } else if (v.is_string()) {
+            write_value_tag(AstValueTag::String);
+            write_string(v.get<std::string>());
+        } else {
+            write_value_tag(AstValueTag::Json);
+            write_string(v.get<json>().dump());
+        }
+    }
+
+    template <typename T>
+    void write_node(const std::shared_ptr<T> & node) {
+        if (node) {
+            node->serialize(*this);
+        } else {
+            write_tag(AstTag::Null);
+        }
+    }
+    template <typename T>
+    void write_nodes(const std::vector<std::shared_ptr<T>> & nodes) {
+        write_varint(nodes.size());
+        for (const auto & node : nodes) write_node(node);
+    }
+    template <typename T>
+    void write_named_nodes(const std::vector<std::pair<std::string, std::shared_ptr<T>>> & nodes) {
+        write_varint(nodes.size());
+        for (const auto & [name, node] : nodes) {
+            write_string(name);
+            write_node(node);
+        }
+    }
+};
+
+/** Decodes what AstWriter wrote, throwing on truncated or malformed input. */
+class AstReader {
+    const std::string & data_;
+    size_t pos_ = 0;
+
+  public:
+    /** Source attached to the locations of the loaded nodes (null if the blob was saved without it). */
+    std::shared_ptr<std::string> source;
+
+    AstReader(const std::string & data) : data_(data) {}
+
+    bool at_end() const { return pos_ == data_.size(); }
+
+    uint8_t read_u8() {
+        if (pos_ >= data_.size()) throw std::runtime_error("Truncated template blob");
+        return static_cast<uint8_t>(data_[pos_++]);
+    }
+    AstTag read_tag() { return static_cast<AstTag>(read_u8()); }
+    bool read_bool() { return read_u8() != 0; }
+    uint64_t read_varint() {
+        uint64_t v = 0;
+        for (int shift = 0; shift < 64; shift += 7) {
+            auto byte = read_u8();
+            v |= static_cast<uint64_t>(byte & 0x7f) << shift;
+            if (!(byte & 0x80)) return v;
+        }
+        throw std::runtime_error("Malformed varint in template blob");
+    }
+    size_t read_size() {
+        auto size = read_varint();
+        if (size > data_.size() - pos_) throw std::runtime_error("Truncated template blob");
+        return static_cast<size_t>(size);
+    }
+    std::string read_bytes(size_t size) {
+        if (size > data_.size() - pos_) throw std::runtime_error("Truncated template blob");
+        auto s = data_.substr(pos_, size);
+        pos_ += size;
+        return s;
+    }
+    std::string read_string() { return read_bytes(read_size()); }
+    std::vector<std::string> read_strings() {
+        std::vector<std::string> strings(read_size());
+        for (auto & s : strings) s = read_string();
+        return strings;
+    }
+    Location read_location() {
+        auto pos = read_varint();
+        if (source ? pos > source->size() : pos != 0) throw std::runtime_error("Invalid location in template blob");
+        return {source, static_cast<size_t>(pos)};
+    }
+
+    Value read_value() {
+        switch (static_cast<AstValueTag>(read_u8())) {
+            case AstValueTag::Null: return Value();
+            case AstValueTag::False: return Value(false);
+            case AstValueTag::True: return Value(true);
+            case AstValueTag::Integer: {
+                auto zigzag = read_varint();
+                return Value(static_cast<int64_t>((zigzag >> 1) ^ (0 - (zigzag & 1))));
+            }
+            case AstValueTag::Float: {
+                uint64_t bits = 0;
+                for (int i = 0; i < 8; i++) bits |= static_cast<uint64_t>(read_u8()) << (8 * i);
+                double d;
+                std::memcpy(&d, &bits, sizeof(d));
+                return Value(d);
+            }
+            case AstValueTag::String: return Value(read_string());
+            case AstValueTag::Json: {
+                try {
+                    return Value(json::parse(read_string()));
+                } catch (const json::exception &) {
+                    throw std::runtime_error("Malformed JSON value in template blob");
+                }
+            }
+        }
+        throw std::runtime_error("Unknown value tag in template blob");
+    }
+};
+
+/*
+  Resolves variables to the slots of the enclosing for loop / macro bodies after parsing, so they can be read w/o
+  walking the contexts by name. Scopes are pushed innermost last, mirroring the contexts created at render time.
+  Variables not bound in any enclosing body (globals, or set at the top level) are left unresolved & looked up by name.
+*/
+class VariableResolver {
+    std::vector<std::shared_ptr<const VariableScope>> scopes_;
+  public:
+    void push(const std::shared_ptr<const VariableScope> & scope) { scopes_.push_back(scope); }
+    void pop() { scopes_.pop_back(); }
+
+    bool resolve(const std::string & name, std::shared_ptr<const VariableScope> & scope, size_t & hops, size_t & index) const {
+        for (size_t i = scopes_.size(); i-- > 0;) {
+            auto slot = scopes_[i]->index_of(name);
+            if (slot != VariableScope::npos) {
+                scope = scopes_[i];
+                hops = scopes_.size() - 1 - i;
+                index = slot;
+                return true;
+            }
+        }
+        return false;
+    }
+
+    template <typename T>
+    void resolve_node(const std::shared_ptr<T> & node) {
+        if (node) node->resolve_variables(*this);
+    }
+    template <typename T>
+    void resolve_nodes(const std::vector<std::shared_ptr<T>> & nodes) {
+        for (const auto & node : nodes) resolve_node(node);
+    }
+};
+
+class Expression;
+
+/*
+  Folds the constant parts of a parsed template (before VariableResolver runs): literal-only operations, builtin
+  filters & methods applied to literals, if / elif branches that can never be taken, and the text nodes they leave
+  next to each other. Folded results must be immutable values (arrays & dicts built by literals are fresh on each
+  render, so only their primitive results are folded), and anything that fails to evaluate is left for render time.
+  Filter names bound by the template itself (set, for, macros) may shadow the builtins and aren't folded; folded filters
+  are still applied at render time if the context overrides their names (see FoldedFilterExpr).
+*/
+class ConstantFolder {
+    std::unordered_set<std::string> bound_names_;
+    std::shared_ptr<Context> context_;
+  public:
+    ConstantFolder(std::unordered_set<std::string> && bound_names);
+
+    /** Evaluates a constant expression, returning false if it fails. */
+    bool evaluate(const Expression & expr, Value & result) const;
+    /** A literal w/ the value of a constant expression, or nullptr if it fails or isn't an immutable value. */
+    std::shared_ptr<Expression> literal(const Expression & expr) const;
+    /** Whether a filter expression part is a pure builtin filter (w/ constant arguments). */
+    bool is_pure_filter(const Expression & part) const;
+
+    template <typename T>
+    void fold_node(std::shared_ptr<T> & node) {
+        if (!node) return;
+        if (auto folded = node->fold_constants(*this)) node = std::move(folded);
+    }
+    template <typename T>
+    void fold_nodes(std::vector<std::shared_ptr<T>> & nodes) {
+        for (auto & node : nodes) fold_node(node);
+    }
+};
+
 class Expression {
 protected:
     virtual Value do_evaluate(const std::shared_ptr<Context> & context) const = 0;
@@ -664,29 +1295,52 @@ public:
     Expression(const Location & location) : location(location) {}
     virtual ~Expression() = default;
 
+    /** Writes the tag, location & fields of this expression (read back by TemplateSerializer). */
+    virtual void serialize(AstWriter & out) const = 0;
+    /** Resolves the variables of this expression & its children (see VariableResolver). */
+    virtual void resolve_variables(VariableResolver & resolver) = 0;
+    /** Folds the constant children of this expression, returning its own replacement if it's constant too (or nullptr). */
+    virtual std::shared_ptr<Expression> fold_constants(ConstantFolder & folder) = 0;
+    /** Whether this expression always evaluates to the same value (w/o side effects), once folded. */
+    virtual bool is_constant() const { return false; }
+
     Value evaluate(const std::shared_ptr<Context> & context) const {
         try {
             return do_evaluate(context);
+        } catch (TemplateRuntimeError & e) {
+            e.push(location);
+            throw;
         } catch (const std::exception & e) {
-            std::ostringstream out;
-            out << e.what();
-            if (location.source) out << error_location_suffix(*location.source, location.pos);
-            throw std::runtime_error(out.str());
+            throw TemplateRuntimeError(e.what(), location);
         }
     }
 };
 
 class VariableExpr : public Expression {
     std::string name;
+    Value name_value;
+    // Slot resolved by resolve_variables, if the variable is bound in an enclosing for loop / macro.
+    std::shared_ptr<const VariableScope> scope;
+    size_t hops = 0;
+    size_t slot = 0;
 public:
     VariableExpr(const Location & loc, const std::string& n)
-      : Expression(loc), name(n) {}
+      : Expression(loc), name(n), name_value(n) {}
     std::string get_name() const { return name; }
+    void resolve_variables(VariableResolver & resolver) override {
+        if (!resolver.resolve(name, scope, hops, slot)) scope = nullptr;
+    }
+    std::shared_ptr<Expression> fold_constants(ConstantFolder &) override { return nullptr; }
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::VariableExpr);
+        out.write_location(location);
+        out.write_string(name);
+    }
     Value do_evaluate(const std::shared_ptr<Context> & context) const override {
-        if (!context->contains(name)) {
-            return Value();
+        if (scope) {
+            if (auto value = context->find_slot(hops, scope.get(), slot)) return *value;
         }
-        return context->at(name);
+        return context->get(name_value);
     }
 };
 
@@ -836,12 +1490,12 @@ struct CommentTemplateToken : public TemplateToken {
 
 enum class LoopControlType { Break, Continue };
 
-class LoopControlException : public std::runtime_error {
+class LoopControlException : public TemplateRuntimeError {
 public:
     LoopControlType control_type;
-    LoopControlException(const std::string & message, LoopControlType control_type) : std::runtime_error(message), control_type(control_type) {}
+    LoopControlException(const std::string & message, LoopControlType control_type) : TemplateRuntimeError(message), control_type(control_type) {}
     LoopControlException(LoopControlType control_type)
-      : std::runtime_error((control_type == LoopControlType::Continue ? "continue" : "break") + std::string(" outside of a loop")),
+      : TemplateRuntimeError((control_type == LoopControlType::Continue ? "continue" : "break") + std::string(" outside of a loop")),
         control_type(control_type) {}
 };
 
@@ -861,36 +1515,91 @@ struct EndCallTemplateToken : public TemplateToken {
         : TemplateToken(Type::EndCall, loc, pre, post) {}
 };
 
+/** Receives rendered output as it's produced, in chunks that are only valid for the duration of the call. */
+using RenderSink = std::function<void(std::string_view)>;
+
+/** Stream buffer that forwards its output to a RenderSink: small writes are coalesced, large ones are passed through without copies. */
+class SinkStreamBuf : public std::streambuf {
+    const RenderSink & sink_;
+    char buffer_[4096];
+
+    void flush_buffer() {
+        if (pptr() != pbase()) {
+            sink_(std::string_view(pbase(), pptr() - pbase()));
+            setp(buffer_, buffer_ + sizeof(buffer_));
+        }
+    }
+protected:
+    int_type overflow(int_type ch) override {
+        flush_buffer();
+        if (!traits_type::eq_int_type(ch, traits_type::eof())) {
+            *pptr() = traits_type::to_char_type(ch);
+            pbump(1);
+        }
+        return traits_type::not_eof(ch);
+    }
+    std::streamsize xsputn(const char * s, std::streamsize n) override {
+        if (n < epptr() - pptr()) {
+            std::memcpy(pptr(), s, n);
+            pbump(static_cast<int>(n));
+        } else {
+            flush_buffer();
+            sink_(std::string_view(s, n));
+        }
+        return n;
+    }
+    int sync() override {
+        flush_buffer();
+        return 0;
+    }
+public:
+    SinkStreamBuf(const RenderSink & sink) : sink_(sink) {
+        setp(buffer_, buffer_ + sizeof(buffer_));
+    }
+};
+
 class TemplateNode {
     Location location_;
 protected:
-    virtual void do_render(std::ostringstream & out, const std::shared_ptr<Context> & context) const = 0;
+    virtual void do_render(std::ostream & out, const std::shared_ptr<Context> & context) const = 0;
 
 public:
     TemplateNode(const Location & location) : location_(location) {}
-    void render(std::ostringstream & out, const std::shared_ptr<Context> & context) const {
+    void render(std::ostream & out, const std::shared_ptr<Context> & context) const {
         try {
             do_render(out, context);
-        } catch (const LoopControlException & e) {
-            // TODO: make stack creation lazy. Only needed if it was thrown outside of a loop.
-            std::ostringstream err;
-            err << e.what();
-            if (location_.source) err << error_location_suffix(*location_.source, location_.pos);
-            throw LoopControlException(err.str(), e.control_type);
+        } catch (TemplateRuntimeError & e) {
+            // Also keeps LoopControlExceptions' type, for the enclosing loop to catch.
+            e.push(location_);
+            throw;
         } catch (const std::exception & e) {
-            std::ostringstream err;
-            err << e.what();
-            if (location_.source) err << error_location_suffix(*location_.source, location_.pos);
-            throw std::runtime_error(err.str());
+            throw TemplateRuntimeError(e.what(), location_);
         }
     }
     const Location & location() const { return location_; }
     virtual ~TemplateNode() = default;
+
+    /** Writes the tag, location & fields of this node (read back by TemplateSerializer). */
+    virtual void serialize(AstWriter & out) const = 0;
+    /** Declares the variables this node assigns in the context it's rendered in (incl. from nested nodes rendered in the same context). */
+    virtual void declare_variables(VariableScope & scope) const = 0;
+    /** Resolves the variables of this node's expressions & children (see VariableResolver). */
+    virtual void resolve_variables(VariableResolver & resolver) = 0;
+    /** Folds the constants of this node's expressions & children, returning its own replacement if it can be simplified (or nullptr). */
+    virtual std::shared_ptr<TemplateNode> fold_constants(ConstantFolder & folder) = 0;
     std::string render(const std::shared_ptr<Context> & context) const {
         std::ostringstream out;
         render(out, context);
         return out.str();
     }
+    /** Renders to sink as the output is produced (if rendering fails, the output that already reached the sink stays there). */
+    void render(const RenderSink & sink, const std::shared_ptr<Context> & context) const {
+        SinkStreamBuf buf(sink);
+        std::ostream out(&buf);
+        out.exceptions(std::ios::badbit);  // Propagate the sink's exceptions
+        render(out, context);
+        out.flush();
+    }
 };
 
 class SequenceNode : public TemplateNode {
@@ -898,7 +1607,21 @@ class SequenceNode : public TemplateNode {
 public:
     SequenceNode(const Location & loc, std::vector<std::shared_ptr<TemplateNode>> && c)
       : TemplateNode(loc), children(std::move(c)) {}
-    void do_render(std::ostringstream & out, const std::shared_ptr<Context> & context) const override {
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::SequenceNode);
+        out.write_location(location());
+        out.write_nodes(children);
+    }
+    void declare_variables(VariableScope & scope) const override {
+        for (const auto & child : children) {
+            if (child) child->declare_variables(scope);
+        }
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_nodes(children);
+    }
+    std::shared_ptr<TemplateNode> fold_constants(ConstantFolder & folder) override;
+    void do_render(std::ostream & out, const std::shared_ptr<Context> & context) const override {
         for (const auto& child : children) child->render(out, context);
     }
 };
@@ -907,7 +1630,16 @@ class TextNode : public TemplateNode {
     std::string text;
 public:
     TextNode(const Location & loc, const std::string& t) : TemplateNode(loc), text(t) {}
-    void do_render(std::ostringstream & out, const std::shared_ptr<Context> &) const override {
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::TextNode);
+        out.write_location(location());
+        out.write_string(text);
+    }
+    const std::string & get_text() const { return text; }
+    void declare_variables(VariableScope &) const override {}
+    void resolve_variables(VariableResolver &) override {}
+    std::shared_ptr<TemplateNode> fold_constants(ConstantFolder &) override { return nullptr; }
+    void do_render(std::ostream & out, const std::shared_ptr<Context> &) const override {
       out << text;
     }
 };
@@ -916,9 +1648,29 @@ class ExpressionNode : public TemplateNode {
     std::shared_ptr<Expression> expr;
 public:
     ExpressionNode(const Location & loc, std::shared_ptr<Expression> && e) : TemplateNode(loc), expr(std::move(e)) {}
-    void do_render(std::ostringstream & out, const std::shared_ptr<Context> & context) const override {
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::ExpressionNode);
+        out.write_location(location());
+        out.write_node(expr);
+    }
+    void declare_variables(VariableScope &) const override {}
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_node(expr);
+    }
+    std::shared_ptr<TemplateNode> fold_constants(ConstantFolder & folder) override {
+        folder.fold_node(expr);
+        Value result;
+        if (!expr || !expr->is_constant() || !folder.evaluate(*expr, result)) return nullptr;
+        std::ostringstream text;
+        write_value(text, result);
+        return std::make_shared<TextNode>(location(), text.str());
+    }
+    void do_render(std::ostream & out, const std::shared_ptr<Context> & context) const override {
       if (!expr) throw std::runtime_error("ExpressionNode.expr is null");
-      auto result = expr->evaluate(context);
+      write_value(out, expr->evaluate(context));
+    }
+private:
+    static void write_value(std::ostream & out, const Value & result) {
       if (result.is_string()) {
           out << result.get<std::string>();
       } else if (result.is_boolean()) {
@@ -934,7 +1686,46 @@ class IfNode : public TemplateNode {
 public:
     IfNode(const Location & loc, std::vector<std::pair<std::shared_ptr<Expression>, std::shared_ptr<TemplateNode>>> && c)
         : TemplateNode(loc), cascade(std::move(c)) {}
-    void do_render(std::ostringstream & out, const std::shared_ptr<Context> & context) const override {
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::IfNode);
+        out.write_location(location());
+        out.write_varint(cascade.size());
+        for (const auto & branch : cascade) {
+            out.write_node(branch.first);
+            out.write_node(branch.second);
+        }
+    }
+    void declare_variables(VariableScope & scope) const override {
+        for (const auto & branch : cascade) {
+            if (branch.second) branch.second->declare_variables(scope);
+        }
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        for (const auto & branch : cascade) {
+            resolver.resolve_node(branch.first);
+            resolver.resolve_node(branch.second);
+        }
+    }
+    std::shared_ptr<TemplateNode> fold_constants(ConstantFolder & folder) override {
+        std::vector<std::pair<std::shared_ptr<Expression>, std::shared_ptr<TemplateNode>>> taken;
+        for (auto & branch : cascade) {
+            folder.fold_node(branch.first);
+            folder.fold_node(branch.second);
+            Value condition;
+            if (branch.first && branch.first->is_constant() && folder.evaluate(*branch.first, condition)) {
+                if (!condition.to_bool()) continue;
+                // Always taken: the following branches never are.
+                taken.emplace_back(nullptr, std::move(branch.second));
+                break;
+            }
+            taken.push_back(std::move(branch));
+        }
+        cascade = std::move(taken);
+        if (cascade.empty()) return std::make_shared<TextNode>(location(), std::string());
+        if (!cascade[0].first && cascade[0].second) return cascade[0].second;
+        return nullptr;
+    }
+    void do_render(std::ostream & out, const std::shared_ptr<Context> & context) const override {
       for (const auto& branch : cascade) {
           auto enter_branch = true;
           if (branch.first) {
@@ -953,7 +1744,15 @@ class LoopControlNode : public TemplateNode {
     LoopControlType control_type_;
   public:
     LoopControlNode(const Location & loc, LoopControlType control_type) : TemplateNode(loc), control_type_(control_type) {}
-    void do_render(std::ostringstream &, const std::shared_ptr<Context> &) const override {
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::LoopControlNode);
+        out.write_location(location());
+        out.write_u8(static_cast<uint8_t>(control_type_));
+    }
+    void declare_variables(VariableScope &) const override {}
+    void resolve_variables(VariableResolver &) override {}
+    std::shared_ptr<TemplateNode> fold_constants(ConstantFolder &) override { return nullptr; }
+    void do_render(std::ostream &, const std::shared_ptr<Context> &) const override {
       throw LoopControlException(control_type_);
     }
 };
@@ -965,12 +1764,50 @@ class ForNode : public TemplateNode {
     std::shared_ptr<TemplateNode> body;
     bool recursive;
     std::shared_ptr<TemplateNode> else_body;
+    std::shared_ptr<const VariableScope> body_scope;
 public:
     ForNode(const Location & loc, std::vector<std::string> && var_names, std::shared_ptr<Expression> && iterable,
       std::shared_ptr<Expression> && condition, std::shared_ptr<TemplateNode> && body, bool recursive, std::shared_ptr<TemplateNode> && else_body)
             : TemplateNode(loc), var_names(var_names), iterable(std::move(iterable)), condition(std::move(condition)), body(std::move(body)), recursive(recursive), else_body(std::move(else_body)) {}
 
-    void do_render(std::ostringstream & out, const std::shared_ptr<Context> & context) const override {
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::ForNode);
+        out.write_location(location());
+        out.write_strings(var_names);
+        out.write_node(iterable);
+        out.write_node(condition);
+        out.write_node(body);
+        out.write_bool(recursive);
+        out.write_node(else_body);
+    }
+    void declare_variables(VariableScope & scope) const override {
+        // The loop variables are also assigned in the outer context (to evaluate the loop condition).
+        for (const auto & var_name : var_names) scope.declare(var_name);
+        if (else_body) else_body->declare_variables(scope);
+    }
+    std::shared_ptr<TemplateNode> fold_constants(ConstantFolder & folder) override {
+        folder.fold_node(iterable);
+        folder.fold_node(condition);
+        folder.fold_node(body);
+        folder.fold_node(else_body);
+        return nullptr;
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_node(iterable);
+        resolver.resolve_node(condition);
+        resolver.resolve_node(else_body);
+
+        auto scope = std::make_shared<VariableScope>();
+        for (const auto & var_name : var_names) scope->declare(var_name);
+        scope->declare("loop");
+        if (body) body->declare_variables(*scope);
+        body_scope = scope;
+        resolver.push(scope);
+        resolver.resolve_node(body);
+        resolver.pop();
+    }
+
+    void do_render(std::ostream & out, const std::shared_ptr<Context> & context) const override {
       // https://jinja.palletsprojects.com/en/3.0.x/templates/#for
       if (!iterable) throw std::runtime_error("ForNode.iterable is null");
       if (!body) throw std::runtime_error("ForNode.body is null");
@@ -979,55 +1816,65 @@ public:
       Value::CallableType loop_function;
 
       std::function<void(Value&)> visit = [&](Value& iter) {
-          auto filtered_items = Value::array();
+          // Lists are iterated in place, other iterables (or filtered lists) are materialized first.
+          auto in_place = !condition && iter.is_array();
+          std::vector<Value> filtered_items;
           if (!iter.is_null()) {
-            if (!iterable_value.is_iterable()) {
-              throw std::runtime_error("For loop iterable must be iterable: " + iterable_value.dump());
+            if (!iter.is_iterable()) {
+              throw std::runtime_error("For loop iterable must be iterable: " + iter.dump());
+            }
+            if (in_place) {
+              // The loop variables are also assigned in the outer context (as if to evaluate a condition).
+              if (!iter.empty()) destructuring_assign(var_names, context, iter.at(iter.size() - 1));
+            } else {
+              iter.for_each([&](Value & item) {
+                  destructuring_assign(var_names, context, item);
+                  if (!condition || condition->evaluate(context).to_bool()) {
+                    filtered_items.push_back(item);
+                  }
+              });
             }
-            iterable_value.for_each([&](Value & item) {
-                destructuring_assign(var_names, context, item);
-                if (!condition || condition->evaluate(context).to_bool()) {
-                  filtered_items.push_back(item);
-                }
-            });
           }
-          if (filtered_items.empty()) {
+          auto n = in_place ? iter.size() : filtered_items.size();
+          if (n == 0) {
             if (else_body) {
               else_body->render(out, context);
             }
-          } else {
-              auto loop = recursive ? Value::callable(loop_function) : Value::object();
-              loop.set("length", (int64_t) filtered_items.size());
+            return;
+          }
+          auto item_at = [&](size_t i) -> Value {
+              return in_place ? iter.at(i) : filtered_items[i];
+          };
 
-              size_t cycle_index = 0;
-              loop.set("cycle", Value::callable([&](const std::shared_ptr<Context> &, ArgumentsValue & args) {
-                  if (args.args.empty() || !args.kwargs.empty()) {
-                      throw std::runtime_error("cycle() expects at least 1 positional argument and no named arg");
-                  }
-                  auto item = args.args[cycle_index];
-                  cycle_index = (cycle_index + 1) % args.args.size();
-                  return item;
-              }));
-              auto loop_context = Context::make(Value::object(), context);
-              loop_context->set("loop", loop);
-              for (size_t i = 0, n = filtered_items.size(); i < n; ++i) {
-                  auto & item = filtered_items.at(i);
-                  destructuring_assign(var_names, loop_context, item);
-                  loop.set("index", (int64_t) i + 1);
-                  loop.set("index0", (int64_t) i);
-                  loop.set("revindex", (int64_t) (n - i));
-                  loop.set("revindex0", (int64_t) (n - i - 1));
-                  loop.set("length", (int64_t) n);
-                  loop.set("first", i == 0);
-                  loop.set("last", i == (n - 1));
-                  loop.set("previtem", i > 0 ? filtered_items.at(i - 1) : Value());
-                  loop.set("nextitem", i < n - 1 ? filtered_items.at(i + 1) : Value());
-                  try {
-                      body->render(out, loop_context);
-                  } catch (const LoopControlException & e) {
-                      if (e.control_type == LoopControlType::Break) break;
-                      if (e.control_type == LoopControlType::Continue) continue;
-                  }
+          auto loop = recursive ? Value::callable(loop_function) : Value::object();
+          loop.set("length", (int64_t) n);
+
+          size_t cycle_index = 0;
+          loop.set("cycle", Value::callable([&](const std::shared_ptr<Context> &, ArgumentsValue & args) {
+              if (args.args.empty() || !args.kwargs.empty()) {
+                  throw std::runtime_error("cycle() expects at least 1 positional argument and no named arg");
+              }
+              auto item = args.args[cycle_index];
+              cycle_index = (cycle_index + 1) % args.args.size();
+              return item;
+          }));
+          LoopAttributes attributes(loop);
+          auto loop_context = std::make_shared<Context>(Value::object(), context, body_scope);
+          loop_context->set("loop", loop);
+          Value previtem;
+          for (size_t i = 0; i < n; ++i) {
+              // If the body shrank the list it iterates over, the loop ends early & its last items are those of the shrunk list.
+              auto m = in_place ? std::min(n, iter.size()) : n;
+              if (i >= m) break;
+              auto item = item_at(i);
+              destructuring_assign(var_names, loop_context, item);
+              attributes.update(i, m, std::move(previtem), i < m - 1 ? item_at(i + 1) : Value());
+              previtem = item;
+              try {
+                  body->render(out, loop_context);
+              } catch (const LoopControlException & e) {
+                  if (e.control_type == LoopControlType::Break) break;
+                  if (e.control_type == LoopControlType::Continue) continue;
               }
           }
       };
@@ -1045,6 +1892,51 @@ public:
 
       visit(iterable_value);
   }
+
+private:
+    /**
+     * The attributes of a loop object that change at every iteration, updated in place through pointers
+     * to their values rather than by name.
+     * Templates can add or remove keys of the loop object (which moves its entries): the pointers are
+     * re-bound whenever its size or the address of its last-bound entry changed.
+     */
+    class LoopAttributes {
+        static constexpr size_t count = 8;
+        static const char * name(size_t i) {
+            static const char * names[count] = {"index", "index0", "revindex", "revindex0", "first", "last", "previtem", "nextitem"};
+            return names[i];
+        }
+        Value & loop_;
+        Value * values_[count] = {};
+        size_t last_ = 0;
+        size_t size_ = 0;
+
+        void bind() {
+            for (size_t i = 0; i < count; ++i) {
+                if (!loop_.contains(name(i))) loop_.set(name(i), Value());
+            }
+            last_ = 0;
+            for (size_t i = 0; i < count; ++i) {
+                values_[i] = loop_.find(name(i));
+                if (values_[i] > values_[last_]) last_ = i;
+            }
+            size_ = loop_.size();
+        }
+    public:
+        LoopAttributes(Value & loop) : loop_(loop) { bind(); }
+
+        void update(size_t i, size_t n, Value && previtem, Value && nextitem) {
+            if (loop_.size() != size_ || loop_.find(name(last_)) != values_[last_]) bind();
+            *values_[0] = (int64_t) i + 1;
+            *values_[1] = (int64_t) i;
+            *values_[2] = (int64_t) (n - i);
+            *values_[3] = (int64_t) (n - i - 1);
+            *values_[4] = i == 0;
+            *values_[5] = i == (n - 1);
+            *values_[6] = std::move(previtem);
+            *values_[7] = std::move(nextitem);
+        }
+    };
 };
 
 class MacroNode : public TemplateNode {
@@ -1052,6 +1944,7 @@ class MacroNode : public TemplateNode {
     Expression::Parameters params;
     std::shared_ptr<TemplateNode> body;
     std::unordered_map<std::string, size_t> named_param_positions;
+    std::shared_ptr<const VariableScope> body_scope;
 public:
     MacroNode(const Location & loc, std::shared_ptr<VariableExpr> && n, Expression::Parameters && p, std::shared_ptr<TemplateNode> && b)
         : TemplateNode(loc), name(std::move(n)), params(std::move(p)), body(std::move(b)) {
@@ -1062,18 +1955,44 @@ public:
           }
         }
     }
-    void do_render(std::ostringstream &, const std::shared_ptr<Context> & context) const override {
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::MacroNode);
+        out.write_location(location());
+        out.write_node(name);
+        out.write_named_nodes(params);
+        out.write_node(body);
+    }
+    void declare_variables(VariableScope & scope) const override {
+        if (name) scope.declare(name->get_name());
+    }
+    std::shared_ptr<TemplateNode> fold_constants(ConstantFolder & folder) override {
+        for (auto & param : params) folder.fold_node(param.second);
+        folder.fold_node(body);
+        return nullptr;
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        // Default values are evaluated in the caller's context, so their variables are left to be looked up by name.
+        auto scope = std::make_shared<VariableScope>();
+        for (const auto & param : params) scope->declare(param.first);
+        scope->declare("caller");
+        if (body) body->declare_variables(*scope);
+        body_scope = scope;
+        resolver.push(scope);
+        resolver.resolve_node(body);
+        resolver.pop();
+    }
+    void do_render(std::ostream &, const std::shared_ptr<Context> & context) const override {
         if (!name) throw std::runtime_error("MacroNode.name is null");
         if (!body) throw std::runtime_error("MacroNode.body is null");
 
         // Use init-capture to avoid dangling 'this' pointer and circular references
         auto callable = Value::callable([weak_context = std::weak_ptr<Context>(context),
-                                         name = name, params = params, body = body,
+                                         name = name, params = params, body = body, body_scope = body_scope,
                                          named_param_positions = named_param_positions]
                                         (const std::shared_ptr<Context> & call_context, ArgumentsValue & args) {
             auto context_locked = weak_context.lock();
             if (!context_locked) throw std::runtime_error("Macro context no longer valid");
-            auto execution_context = Context::make(Value::object(), context_locked);
+            auto execution_context = std::make_shared<Context>(Value::object(), context_locked, body_scope);
 
             if (call_context->contains("caller")) {
                 execution_context->set("caller", call_context->get("caller"));
@@ -1114,8 +2033,26 @@ class FilterNode : public TemplateNode {
 public:
     FilterNode(const Location & loc, std::shared_ptr<Expression> && f, std::shared_ptr<TemplateNode> && b)
         : TemplateNode(loc), filter(std::move(f)), body(std::move(b)) {}
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::FilterNode);
+        out.write_location(location());
+        out.write_node(filter);
+        out.write_node(body);
+    }
+    void declare_variables(VariableScope & scope) const override {
+        if (body) body->declare_variables(scope);
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_node(filter);
+        resolver.resolve_node(body);
+    }
+    std::shared_ptr<TemplateNode> fold_constants(ConstantFolder & folder) override {
+        folder.fold_node(filter);
+        folder.fold_node(body);
+        return nullptr;
+    }
 
-    void do_render(std::ostringstream & out, const std::shared_ptr<Context> & context) const override {
+    void do_render(std::ostream & out, const std::shared_ptr<Context> & context) const override {
         if (!filter) throw std::runtime_error("FilterNode.filter is null");
         if (!body) throw std::runtime_error("FilterNode.body is null");
         auto filter_value = filter->evaluate(context);
@@ -1137,7 +2074,26 @@ class SetNode : public TemplateNode {
 public:
     SetNode(const Location & loc, const std::string & ns, const std::vector<std::string> & vns, std::shared_ptr<Expression> && v)
         : TemplateNode(loc), ns(ns), var_names(vns), value(std::move(v)) {}
-    void do_render(std::ostringstream &, const std::shared_ptr<Context> & context) const override {
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::SetNode);
+        out.write_location(location());
+        out.write_string(ns);
+        out.write_strings(var_names);
+        out.write_node(value);
+    }
+    void declare_variables(VariableScope & scope) const override {
+        if (ns.empty()) {
+            for (const auto & var_name : var_names) scope.declare(var_name);
+        }
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_node(value);
+    }
+    std::shared_ptr<TemplateNode> fold_constants(ConstantFolder & folder) override {
+        folder.fold_node(value);
+        return nullptr;
+    }
+    void do_render(std::ostream &, const std::shared_ptr<Context> & context) const override {
       if (!value) throw std::runtime_error("SetNode.value is null");
       if (!ns.empty()) {
         if (var_names.size() != 1) {
@@ -1145,7 +2101,7 @@ public:
         }
         auto & name = var_names[0];
         auto ns_value = context->get(ns);
-        if (!ns_value.is_object()) throw std::runtime_error("Namespace '" + ns + "' is not an object");
+        if (!ns_value.is_object() || ns_value.is_callable()) throw std::runtime_error("Namespace '" + ns + "' is not an object");
         ns_value.set(name, this->value->evaluate(context));
       } else {
         auto val = value->evaluate(context);
@@ -1160,7 +2116,24 @@ class SetTemplateNode : public TemplateNode {
 public:
     SetTemplateNode(const Location & loc, const std::string & name, std::shared_ptr<TemplateNode> && tv)
         : TemplateNode(loc), name(name), template_value(std::move(tv)) {}
-    void do_render(std::ostringstream &, const std::shared_ptr<Context> & context) const override {
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::SetTemplateNode);
+        out.write_location(location());
+        out.write_string(name);
+        out.write_node(template_value);
+    }
+    void declare_variables(VariableScope & scope) const override {
+        scope.declare(name);
+        if (template_value) template_value->declare_variables(scope);
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_node(template_value);
+    }
+    std::shared_ptr<TemplateNode> fold_constants(ConstantFolder & folder) override {
+        folder.fold_node(template_value);
+        return nullptr;
+    }
+    void do_render(std::ostream &, const std::shared_ptr<Context> & context) const override {
       if (!template_value) throw std::runtime_error("SetTemplateNode.template_value is null");
       Value value { template_value->render(context) };
       context->set(name, value);
@@ -1174,6 +2147,29 @@ class IfExpr : public Expression {
 public:
     IfExpr(const Location & loc, std::shared_ptr<Expression> && c, std::shared_ptr<Expression> && t, std::shared_ptr<Expression> && e)
         : Expression(loc), condition(std::move(c)), then_expr(std::move(t)), else_expr(std::move(e)) {}
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::IfExpr);
+        out.write_location(location);
+        out.write_node(condition);
+        out.write_node(then_expr);
+        out.write_node(else_expr);
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_node(condition);
+        resolver.resolve_node(then_expr);
+        resolver.resolve_node(else_expr);
+    }
+    std::shared_ptr<Expression> fold_constants(ConstantFolder & folder) override {
+        folder.fold_node(condition);
+        folder.fold_node(then_expr);
+        folder.fold_node(else_expr);
+        Value c;
+        if (!condition || !then_expr || !condition->is_constant() || !folder.evaluate(*condition, c)) return nullptr;
+        // Only constant branches replace the whole expression (others keep their context, e.g. for error messages).
+        auto & taken = c.to_bool() ? then_expr : else_expr;
+        if (!taken) return folder.literal(*this);
+        return taken->is_constant() ? taken : nullptr;
+    }
     Value do_evaluate(const std::shared_ptr<Context> & context) const override {
       if (!condition) throw std::runtime_error("IfExpr.condition is null");
       if (!then_expr) throw std::runtime_error("IfExpr.then_expr is null");
@@ -1192,6 +2188,14 @@ class LiteralExpr : public Expression {
 public:
     LiteralExpr(const Location & loc, const Value& v)
       : Expression(loc), value(v) {}
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::LiteralExpr);
+        out.write_location(location);
+        out.write_value(value);
+    }
+    void resolve_variables(VariableResolver &) override {}
+    std::shared_ptr<Expression> fold_constants(ConstantFolder &) override { return nullptr; }
+    bool is_constant() const override { return true; }
     Value do_evaluate(const std::shared_ptr<Context> &) const override { return value; }
 };
 
@@ -1200,6 +2204,22 @@ class ArrayExpr : public Expression {
 public:
     ArrayExpr(const Location & loc, std::vector<std::shared_ptr<Expression>> && e)
       : Expression(loc), elements(std::move(e)) {}
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::ArrayExpr);
+        out.write_location(location);
+        out.write_nodes(elements);
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_nodes(elements);
+    }
+    std::shared_ptr<Expression> fold_constants(ConstantFolder & folder) override {
+        // Never replaced by a literal: each evaluation must return a new (mutable) array.
+        folder.fold_nodes(elements);
+        return nullptr;
+    }
+    bool is_constant() const override {
+        return std::all_of(elements.begin(), elements.end(), [](const auto & e) { return e && e->is_constant(); });
+    }
     Value do_evaluate(const std::shared_ptr<Context> & context) const override {
         auto result = Value::array();
         for (const auto& e : elements) {
@@ -1215,6 +2235,34 @@ class DictExpr : public Expression {
 public:
     DictExpr(const Location & loc, std::vector<std::pair<std::shared_ptr<Expression>, std::shared_ptr<Expression>>> && e)
       : Expression(loc), elements(std::move(e)) {}
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::DictExpr);
+        out.write_location(location);
+        out.write_varint(elements.size());
+        for (const auto & [key, value] : elements) {
+            out.write_node(key);
+            out.write_node(value);
+        }
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        for (const auto & [key, value] : elements) {
+            resolver.resolve_node(key);
+            resolver.resolve_node(value);
+        }
+    }
+    std::shared_ptr<Expression> fold_constants(ConstantFolder & folder) override {
+        // Never replaced by a literal: each evaluation must return a new (mutable) dict.
+        for (auto & [key, value] : elements) {
+            folder.fold_node(key);
+            folder.fold_node(value);
+        }
+        return nullptr;
+    }
+    bool is_constant() const override {
+        return std::all_of(elements.begin(), elements.end(), [](const auto & e) {
+            return e.first && e.first->is_constant() && e.second && e.second->is_constant();
+        });
+    }
     Value do_evaluate(const std::shared_ptr<Context> & context) const override {
         auto result = Value::object();
         for (const auto& [key, value] : elements) {
@@ -1231,6 +2279,24 @@ public:
     std::shared_ptr<Expression> start, end, step;
     SliceExpr(const Location & loc, std::shared_ptr<Expression> && s, std::shared_ptr<Expression> && e, std::shared_ptr<Expression> && st = nullptr)
       : Expression(loc), start(std::move(s)), end(std::move(e)), step(std::move(st)) {}
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::SliceExpr);
+        out.write_location(location);
+        out.write_node(start);
+        out.write_node(end);
+        out.write_node(step);
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_node(start);
+        resolver.resolve_node(end);
+        resolver.resolve_node(step);
+    }
+    std::shared_ptr<Expression> fold_constants(ConstantFolder & folder) override {
+        folder.fold_node(start);
+        folder.fold_node(end);
+        folder.fold_node(step);
+        return nullptr;
+    }
     Value do_evaluate(const std::shared_ptr<Context> &) const override {
         throw std::runtime_error("SliceExpr not implemented");
     }
@@ -1242,6 +2308,22 @@ class SubscriptExpr : public Expression {
 public:
     SubscriptExpr(const Location & loc, std::shared_ptr<Expression> && b, std::shared_ptr<Expression> && i)
         : Expression(loc), base(std::move(b)), index(std::move(i)) {}
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::SubscriptExpr);
+        out.write_location(location);
+        out.write_node(base);
+        out.write_node(index);
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_node(base);
+        resolver.resolve_node(index);
+    }
+    std::shared_ptr<Expression> fold_constants(ConstantFolder & folder) override {
+        folder.fold_node(base);
+        folder.fold_node(index);
+        if (!base || !index || !base->is_constant() || !index->is_constant()) return nullptr;
+        return folder.literal(*this);
+    }
     Value do_evaluate(const std::shared_ptr<Context> & context) const override {
         if (!base) throw std::runtime_error("SubscriptExpr.base is null");
         if (!index) throw std::runtime_error("SubscriptExpr.index is null");
@@ -1302,6 +2384,21 @@ public:
     Op op;
     UnaryOpExpr(const Location & loc, std::shared_ptr<Expression> && e, Op o)
       : Expression(loc), expr(std::move(e)), op(o) {}
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::UnaryOpExpr);
+        out.write_location(location);
+        out.write_node(expr);
+        out.write_u8(static_cast<uint8_t>(op));
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_node(expr);
+    }
+    std::shared_ptr<Expression> fold_constants(ConstantFolder & folder) override {
+        folder.fold_node(expr);
+        // Expansions are handled by their enclosing call / collection.
+        if (!expr || !expr->is_constant() || op == Op::Expansion || op == Op::ExpansionDict) return nullptr;
+        return folder.literal(*this);
+    }
     Value do_evaluate(const std::shared_ptr<Context> & context) const override {
         if (!expr) throw std::runtime_error("UnaryOpExpr.expr is null");
         auto e = expr->evaluate(context);
@@ -1334,6 +2431,32 @@ private:
 public:
     BinaryOpExpr(const Location & loc, std::shared_ptr<Expression> && l, std::shared_ptr<Expression> && r, Op o)
         : Expression(loc), left(std::move(l)), right(std::move(r)), op(o) {}
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::BinaryOpExpr);
+        out.write_location(location);
+        out.write_node(left);
+        out.write_node(right);
+        out.write_u8(static_cast<uint8_t>(op));
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_node(left);
+        resolver.resolve_node(right);
+    }
+    std::shared_ptr<Expression> fold_constants(ConstantFolder & folder) override {
+        folder.fold_node(left);
+        folder.fold_node(right);
+        Value l;
+        if (!left || !right || !left->is_constant() || !folder.evaluate(*left, l)) return nullptr;
+        // The right side of tests is the test name, and is skipped by short-circuiting and / or.
+        auto right_needed = !(op == Op::Is || op == Op::IsNot || (op == Op::And && !l.to_bool()) || (op == Op::Or && l.to_bool()));
+        if (right_needed && !right->is_constant()) return nullptr;
+        if (op == Op::Div || op == Op::DivDiv || op == Op::Mod) {
+            // Integer division by 0 (or overflowing by -1) traps: leave it to render time, if ever reached.
+            Value r;
+            if (!folder.evaluate(*right, r) || (r.is_number_integer() && (r.get<int64_t>() == 0 || r.get<int64_t>() == -1))) return nullptr;
+        }
+        return folder.literal(*this);
+    }
     Value do_evaluate(const std::shared_ptr<Context> & context) const override {
         if (!left) throw std::runtime_error("BinaryOpExpr.left is null");
         if (!right) throw std::runtime_error("BinaryOpExpr.right is null");
@@ -1410,6 +2533,23 @@ struct ArgumentsExpression {
     std::vector<std::shared_ptr<Expression>> args;
     std::vector<std::pair<std::string, std::shared_ptr<Expression>>> kwargs;
 
+    void serialize(AstWriter & out) const {
+        out.write_nodes(args);
+        out.write_named_nodes(kwargs);
+    }
+    void resolve_variables(VariableResolver & resolver) {
+        resolver.resolve_nodes(args);
+        for (const auto & kwarg : kwargs) resolver.resolve_node(kwarg.second);
+    }
+    void fold_constants(ConstantFolder & folder) {
+        folder.fold_nodes(args);
+        for (auto & kwarg : kwargs) folder.fold_node(kwarg.second);
+    }
+    bool is_constant() const {
+        return std::all_of(args.begin(), args.end(), [](const auto & arg) { return arg && arg->is_constant(); })
+            && std::all_of(kwargs.begin(), kwargs.end(), [](const auto & kwarg) { return kwarg.second && kwarg.second->is_constant(); });
+    }
+
     ArgumentsValue evaluate(const std::shared_ptr<Context> & context) const {
         ArgumentsValue vargs;
         for (const auto& arg : this->args) {
@@ -1495,6 +2635,23 @@ class MethodCallExpr : public Expression {
 public:
     MethodCallExpr(const Location & loc, std::shared_ptr<Expression> && obj, std::shared_ptr<VariableExpr> && m, ArgumentsExpression && a)
         : Expression(loc), object(std::move(obj)), method(std::move(m)), args(std::move(a)) {}
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::MethodCallExpr);
+        out.write_location(location);
+        out.write_node(object);
+        out.write_node(method);
+        args.serialize(out);
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_node(object);
+        args.resolve_variables(resolver);
+    }
+    std::shared_ptr<Expression> fold_constants(ConstantFolder & folder) override {
+        folder.fold_node(object);
+        args.fold_constants(folder);
+        if (!object || !method || !object->is_constant() || !args.is_constant()) return nullptr;
+        return folder.literal(*this);
+    }
     Value do_evaluate(const std::shared_ptr<Context> & context) const override {
         if (!object) throw std::runtime_error("MethodCallExpr.object is null");
         if (!method) throw std::runtime_error("MethodCallExpr.method is null");
@@ -1628,6 +2785,21 @@ public:
     ArgumentsExpression args;
     CallExpr(const Location & loc, std::shared_ptr<Expression> && obj, ArgumentsExpression && a)
         : Expression(loc), object(std::move(obj)), args(std::move(a)) {}
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::CallExpr);
+        out.write_location(location);
+        out.write_node(object);
+        args.serialize(out);
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_node(object);
+        args.resolve_variables(resolver);
+    }
+    std::shared_ptr<Expression> fold_constants(ConstantFolder & folder) override {
+        folder.fold_node(object);
+        args.fold_constants(folder);
+        return nullptr;
+    }
     Value do_evaluate(const std::shared_ptr<Context> & context) const override {
         if (!object) throw std::runtime_error("CallExpr.object is null");
         auto obj = object->evaluate(context);
@@ -1647,7 +2819,27 @@ public:
     CallNode(const Location & loc, std::shared_ptr<Expression> && e, std::shared_ptr<TemplateNode> && b)
         : TemplateNode(loc), expr(std::move(e)), body(std::move(b)) {}
 
-    void do_render(std::ostringstream & out, const std::shared_ptr<Context> & context) const override {
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::CallNode);
+        out.write_location(location());
+        out.write_node(expr);
+        out.write_node(body);
+    }
+    void declare_variables(VariableScope & scope) const override {
+        scope.declare("caller");
+        if (body) body->declare_variables(scope);
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_node(expr);
+        resolver.resolve_node(body);
+    }
+    std::shared_ptr<TemplateNode> fold_constants(ConstantFolder & folder) override {
+        folder.fold_node(expr);
+        folder.fold_node(body);
+        return nullptr;
+    }
+
+    void do_render(std::ostream & out, const std::shared_ptr<Context> & context) const override {
         if (!expr) throw std::runtime_error("CallNode.expr is null");
         if (!body) throw std::runtime_error("CallNode.body is null");
 
@@ -1682,6 +2874,15 @@ class FilterExpr : public Expression {
 public:
     FilterExpr(const Location & loc, std::vector<std::shared_ptr<Expression>> && p)
       : Expression(loc), parts(std::move(p)) {}
+    void serialize(AstWriter & out) const override {
+        out.write_tag(AstTag::FilterExpr);
+        out.write_location(location);
+        out.write_nodes(parts);
+    }
+    void resolve_variables(VariableResolver & resolver) override {
+        resolver.resolve_nodes(parts);
+    }
+    std::shared_ptr<Expression> fold_constants(ConstantFolder & folder) override;
     Value do_evaluate(const std::shared_ptr<Context> & context) const override {
         Value result;
         bool first = true;
@@ -1710,8 +2911,119 @@ public:
     void prepend(std::shared_ptr<Expression> && e) {
         parts.insert(parts.begin(), std::move(e));
     }
+
+    /** The name of the filter applied by a part (after the first), if it's a plain variable. */
+    static const VariableExpr * filter_name(const Expression & part) {
+        if (auto call = dynamic_cast<const CallExpr *>(&part)) return dynamic_cast<const VariableExpr *>(call->object.get());
+        return dynamic_cast<const VariableExpr *>(&part);
+    }
+    const std::vector<std::shared_ptr<Expression>> & get_parts() const { return parts; }
+};
+
+/*
+  The value of builtin filters applied to constants (see ConstantFolder), used as long as the context resolves their
+  names to the shared builtins. If the context overrides any of them, the original filters are applied instead.
+  Serialized as the original filters (blobs aren't folded on load).
+*/
+class FoldedFilterExpr : public Expression {
+    std::shared_ptr<FilterExpr> original;
+    std::shared_ptr<Expression> literal;
+    // The filter names & the builtins they must resolve to.
+    std::vector<std::pair<Value, Value>> builtins;
+public:
+    FoldedFilterExpr(std::shared_ptr<FilterExpr> && o, std::shared_ptr<Expression> && l)
+      : Expression(o->location), original(std::move(o)), literal(std::move(l)) {
+        const auto & parts = original->get_parts();
+        for (size_t i = 1; i < parts.size(); i++) {
+            Value name(FilterExpr::filter_name(*parts[i])->get_name());
+            auto builtin = Context::shared_builtins()->get(name);
+            builtins.emplace_back(std::move(name), std::move(builtin));
+        }
+    }
+    void serialize(AstWriter & out) const override { original->serialize(out); }
+    void resolve_variables(VariableResolver & resolver) override { original->resolve_variables(resolver); }
+    std::shared_ptr<Expression> fold_constants(ConstantFolder &) override { return nullptr; }
+    Value do_evaluate(const std::shared_ptr<Context> & context) const override {
+        for (const auto & [name, builtin] : builtins) {
+            if (!(context->get(name) == builtin)) return original->evaluate(context);
+        }
+        return literal->evaluate(context);
+    }
 };
 
+inline std::shared_ptr<Expression> FilterExpr::fold_constants(ConstantFolder & folder) {
+    folder.fold_nodes(parts);
+    if (parts.empty() || !parts[0] || !parts[0]->is_constant()) return nullptr;
+    size_t pure = 1;
+    while (pure < parts.size() && parts[pure] && folder.is_pure_filter(*parts[pure])) pure++;
+    if (pure == 1) return nullptr;
+    auto original = std::make_shared<FilterExpr>(location, std::vector<std::shared_ptr<Expression>>(parts.begin(), parts.begin() + pure));
+    auto literal = folder.literal(*original);
+    if (!literal) return nullptr;
+    std::shared_ptr<Expression> folded = std::make_shared<FoldedFilterExpr>(std::move(original), std::move(literal));
+    if (pure == parts.size()) return folded;
+    // Only a prefix of the filters could be applied: keep the rest.
+    parts.erase(parts.begin(), parts.begin() + pure);
+    parts.insert(parts.begin(), std::move(folded));
+    return nullptr;
+}
+
+inline std::shared_ptr<TemplateNode> SequenceNode::fold_constants(ConstantFolder & folder) {
+    std::vector<std::shared_ptr<TemplateNode>> folded;
+    auto append = [&](const std::shared_ptr<TemplateNode> & child) {
+        if (auto text = dynamic_cast<const TextNode *>(child.get())) {
+            if (text->get_text().empty()) return;
+            if (auto previous = folded.empty() ? nullptr : dynamic_cast<const TextNode *>(folded.back().get())) {
+                folded.back() = std::make_shared<TextNode>(previous->location(), previous->get_text() + text->get_text());
+                return;
+            }
+        }
+        folded.push_back(child);
+    };
+    for (auto & child : children) {
+        folder.fold_node(child);
+        if (auto sequence = dynamic_cast<const SequenceNode *>(child.get())) {
+            for (const auto & grandchild : sequence->children) append(grandchild);
+        } else {
+            append(child);
+        }
+    }
+    children = std::move(folded);
+    if (children.empty()) return std::make_shared<TextNode>(location(), std::string());
+    if (children.size() == 1) return children[0];
+    return nullptr;
+}
+
+inline ConstantFolder::ConstantFolder(std::unordered_set<std::string> && bound_names)
+    : bound_names_(std::move(bound_names)), context_(Context::make(Value::object())) {}
+
+inline bool ConstantFolder::evaluate(const Expression & expr, Value & result) const {
+    try {
+        result = expr.evaluate(context_);
+        return true;
+    } catch (const std::exception &) {
+        return false;
+    }
+}
+
+inline std::shared_ptr<Expression> ConstantFolder::literal(const Expression & expr) const {
+    Value result;
+    if (!evaluate(expr, result) || result.is_array() || result.is_object() || result.is_callable()) return nullptr;
+    return std::make_shared<LiteralExpr>(expr.location, result);
+}
+
+inline bool ConstantFolder::is_pure_filter(const Expression & part) const {
+    static const std::unordered_set<std::string> pure_filters {
+        "capitalize", "count", "default", "dictsort", "e", "escape", "first", "indent", "int", "items", "join", "last",
+        "length", "list", "lower", "safe", "string", "tojson", "trim", "unique", "upper",
+    };
+    auto name = FilterExpr::filter_name(part);
+    if (auto call = dynamic_cast<const CallExpr *>(&part)) {
+        if (!call->args.is_constant()) return false;
+    }
+    return name && pure_filters.count(name->get_name()) && !bound_names_.count(name->get_name());
+}
+
 class Parser {
 private:
     using CharIterator = std::string::const_iterator;
@@ -1728,11 +3040,29 @@ private:
 
     bool consumeSpaces(SpaceHandling space_handling = SpaceHandling::Strip) {
       if (space_handling == SpaceHandling::Strip) {
-        while (it != end && std::isspace(*it)) ++it;
+        while (it != end && std::isspace(static_cast<unsigned char>(*it))) ++it;
       }
       return true;
     }
 
+    // Hand-written scanners for the (regex-like) token grammar documented on each consume* method.
+    // Word characters (`\w`) are ASCII-only: bytes of multibyte UTF-8 sequences are never part of words.
+
+    static bool isWordChar(char c) {
+      return (c >= 'a' && c <= 'z') || (c >= 'A' && c <= 'Z') || (c >= '0' && c <= '9') || c == '_';
+    }
+
+    bool matchesAt(CharIterator pos, const std::string & symbol) const {
+      return std::distance(pos, end) >= (int64_t) symbol.size() && std::equal(symbol.begin(), symbol.end(), pos);
+    }
+
+    /** Length of the run of word characters (`\w*`) at pos. */
+    size_t wordLength(CharIterator pos) const {
+      auto word_end = pos;
+      while (word_end != end && isWordChar(*word_end)) ++word_end;
+      return std::distance(pos, word_end);
+    }
+
     std::unique_ptr<std::string> parseString() {
       auto doParse = [&](char quote) -> std::unique_ptr<std::string> {
         if (it == end || *it != quote) return nullptr;
@@ -1822,8 +3152,8 @@ private:
         auto str = parseString();
         if (str) return std::make_shared<Value>(*str);
       }
-      static std::regex prim_tok(R"(true\b|True\b|false\b|False\b|None\b)");
-      auto token = consumeToken(prim_tok);
+      static const std::vector<std::string> prim_toks { "true", "True", "false", "False", "None" };
+      auto token = consumeKeyword(prim_toks);
       if (!token.empty()) {
         if (token == "true" || token == "True") return std::make_shared<Value>(true);
         if (token == "false" || token == "False") return std::make_shared<Value>(false);
@@ -1850,59 +3180,88 @@ private:
 
     bool peekSymbols(const std::vector<std::string> & symbols) const {
         for (const auto & symbol : symbols) {
-            if (std::distance(it, end) >= (int64_t) symbol.size() && std::string(it, it + symbol.size()) == symbol) {
+            if (matchesAt(it, symbol)) {
                 return true;
             }
         }
         return false;
     }
 
-    std::vector<std::string> consumeTokenGroups(const std::regex & regex, SpaceHandling space_handling = SpaceHandling::Strip) {
+    std::string consumeToken(const std::string & token, SpaceHandling space_handling = SpaceHandling::Strip) {
         auto start = it;
         consumeSpaces(space_handling);
-        std::smatch match;
-        if (std::regex_search(it, end, match, regex, std::regex_constants::match_continuous) && match.position() == 0) {
-            it += match[0].length();
-            std::vector<std::string> ret;
-            for (size_t i = 0, n = match.size(); i < n; ++i) {
-                ret.push_back(match[i].str());
+        if (matchesAt(it, token)) {
+            it += token.size();
+            return token;
+        }
+        it = start;
+        return "";
+    }
+
+    /** Consumes the first of the operators that isn't directly followed by one of not_followed_by (e.g. `-(?![}%#]\})`). */
+    std::string consumeOperator(const std::vector<std::string> & ops, const std::vector<std::string> & not_followed_by = {}) {
+        auto start = it;
+        consumeSpaces();
+        for (const auto & op : ops) {
+            if (!matchesAt(it, op)) continue;
+            auto after = it + op.size();
+            if (std::none_of(not_followed_by.begin(), not_followed_by.end(), [&](const std::string & s) { return matchesAt(after, s); })) {
+                it = after;
+                return op;
             }
-            return ret;
         }
         it = start;
-        return {};
+        return "";
     }
-    std::string consumeToken(const std::regex & regex, SpaceHandling space_handling = SpaceHandling::Strip) {
+
+    /** Consumes a whole-word keyword (`keyword\b`). */
+    std::string consumeKeyword(const std::string & keyword, SpaceHandling space_handling = SpaceHandling::Strip) {
         auto start = it;
         consumeSpaces(space_handling);
-        std::smatch match;
-        if (std::regex_search(it, end, match, regex, std::regex_constants::match_continuous) && match.position() == 0) {
-            it += match[0].length();
-            return match[0].str();
+        if (wordLength(it) == keyword.size() && matchesAt(it, keyword)) {
+            it += keyword.size();
+            return keyword;
         }
         it = start;
         return "";
     }
 
-    std::string consumeToken(const std::string & token, SpaceHandling space_handling = SpaceHandling::Strip) {
+    /** Consumes the first matching whole-word keyword (`(kw1|kw2|...)\b`). */
+    std::string consumeKeyword(const std::vector<std::string> & keywords) {
         auto start = it;
-        consumeSpaces(space_handling);
-        if (std::distance(it, end) >= (int64_t) token.size() && std::string(it, it + token.size()) == token) {
-            it += token.size();
-            return token;
+        consumeSpaces();
+        auto length = wordLength(it);
+        for (const auto & keyword : keywords) {
+            if (length == keyword.size() && matchesAt(it, keyword)) {
+                it += length;
+                return keyword;
+            }
         }
         it = start;
         return "";
     }
 
+    /** Consumes a run of word characters (`\w+`). */
+    std::string consumeWord() {
+        auto start = it;
+        consumeSpaces();
+        auto length = wordLength(it);
+        if (length == 0) {
+            it = start;
+            return "";
+        }
+        std::string word(it, it + length);
+        it += length;
+        return word;
+    }
+
     std::shared_ptr<Expression> parseExpression(bool allow_if_expr = true) {
         auto left = parseLogicalOr();
         if (it == end) return left;
 
         if (!allow_if_expr) return left;
 
-        static std::regex if_tok(R"(if\b)");
-        if (consumeToken(if_tok).empty()) {
+        if (consumeKeyword("if").empty()) {
           return left;
         }
 
@@ -1919,9 +3278,8 @@ private:
         auto condition = parseLogicalOr();
         if (!condition) throw std::runtime_error("Expected condition expression");
 
-        static std::regex else_tok(R"(else\b)");
         std::shared_ptr<Expression> else_expr;
-        if (!consumeToken(else_tok).empty()) {
+        if (!consumeKeyword("else").empty()) {
           else_expr = parseExpression();
           if (!else_expr) throw std::runtime_error("Expected 'else' expression");
         }
@@ -1932,9 +3290,8 @@ private:
         auto left = parseLogicalAnd();
         if (!left) throw std::runtime_error("Expected left side of 'logical or' expression");
 
-        static std::regex or_tok(R"(or\b)");
         auto location = get_location();
-        while (!consumeToken(or_tok).empty()) {
+        while (!consumeKeyword("or").empty()) {
             auto right = parseLogicalAnd();
             if (!right) throw std::runtime_error("Expected right side of 'or' expression");
             left = std::make_shared<BinaryOpExpr>(location, std::move(left), std::move(right), BinaryOpExpr::Op::Or);
@@ -1943,10 +3300,9 @@ private:
     }
 
     std::shared_ptr<Expression> parseLogicalNot() {
-        static std::regex not_tok(R"(not\b)");
         auto location = get_location();
 
-        if (!consumeToken(not_tok).empty()) {
+        if (!consumeKeyword("not").empty()) {
           auto sub = parseLogicalNot();
           if (!sub) throw std::runtime_error("Expected expression after 'not' keyword");
           return std::make_shared<UnaryOpExpr>(location, std::move(sub), UnaryOpExpr::Op::LogicalNot);
@@ -1958,9 +3314,8 @@ private:
         auto left = parseLogicalNot();
         if (!left) throw std::runtime_error("Expected left side of 'logical and' expression");
 
-        static std::regex and_tok(R"(and\b)");
         auto location = get_location();
-        while (!consumeToken(and_tok).empty()) {
+        while (!consumeKeyword("and").empty()) {
             auto right = parseLogicalNot();
             if (!right) throw std::runtime_error("Expected right side of 'and' expression");
             left = std::make_shared<BinaryOpExpr>(location, std::move(left), std::move(right), BinaryOpExpr::Op::And);
@@ -1972,13 +3327,11 @@ private:
         auto left = parseStringConcat();
         if (!left) throw std::runtime_error("Expected left side of 'logical compare' expression");
 
-        static std::regex compare_tok(R"(==|!=|<=?|>=?|in\b|is\b|not\s+in\b)");
-        static std::regex not_tok(R"(not\b)");
         std::string op_str;
-        while (!(op_str = consumeToken(compare_tok)).empty()) {
+        while (!(op_str = consumeCompareOperator()).empty()) {
             auto location = get_location();
             if (op_str == "is") {
-              auto negated = !consumeToken(not_tok).empty();
+              auto negated = !consumeKeyword("not").empty();
 
               auto identifier = parseIdentifier();
               if (!identifier) throw std::runtime_error("Expected identifier after 'is' keyword");
@@ -1998,13 +3351,29 @@ private:
             else if (op_str == "<=") op = BinaryOpExpr::Op::Le;
             else if (op_str == ">=") op = BinaryOpExpr::Op::Ge;
             else if (op_str == "in") op = BinaryOpExpr::Op::In;
-            else if (op_str.substr(0, 3) == "not") op = BinaryOpExpr::Op::NotIn;
+            else if (op_str == "not in") op = BinaryOpExpr::Op::NotIn;
             else throw std::runtime_error("Unknown comparison operator: " + op_str);
             left = std::make_shared<BinaryOpExpr>(get_location(), std::move(left), std::move(right), op);
         }
         return left;
     }
 
+    /** `==|!=|<=?|>=?|in\b|is\b|not\s+in\b` */
+    std::string consumeCompareOperator() {
+        static const std::vector<std::string> compare_ops { "==", "!=", "<=", "<", ">=", ">" };
+        static const std::vector<std::string> compare_keywords { "in", "is" };
+        auto op = consumeOperator(compare_ops);
+        if (op.empty()) op = consumeKeyword(compare_keywords);
+        if (op.empty()) {
+            auto start = it;
+            if (!consumeKeyword("not").empty() && it != end && std::isspace(static_cast<unsigned char>(*it)) && !consumeKeyword("in").empty()) {
+                return "not in";
+            }
+            it = start;
+        }
+        return op;
+    }
+
     Expression::Parameters parseParameters() {
         consumeSpaces();
         if (consumeToken("(").empty()) throw std::runtime_error("Expected opening parenthesis in param list");
@@ -2074,11 +3443,15 @@ private:
     }
 
     std::shared_ptr<VariableExpr> parseIdentifier() {
-        static std::regex ident_regex(R"((?!(?:not|is|and|or|del)\b)[a-zA-Z_]\w*)");
+        static const std::vector<std::string> reserved_words { "not", "is", "and", "or", "del" };
         auto location = get_location();
-        auto ident = consumeToken(ident_regex);
-        if (ident.empty())
+        auto start = it;
+        auto ident = consumeWord();
+        if (ident.empty() || std::isdigit(static_cast<unsigned char>(ident[0]))
+            || std::find(reserved_words.begin(), reserved_words.end(), ident) != reserved_words.end()) {
+          it = start;
           return nullptr;
+        }
         return std::make_shared<VariableExpr>(location, ident);
     }
 
@@ -2086,8 +3459,9 @@ private:
         auto left = parseMathPow();
         if (!left) throw std::runtime_error("Expected left side of 'string concat' expression");
 
-        static std::regex concat_tok(R"(~(?!\}))");
-        if (!consumeToken(concat_tok).empty()) {
+        static const std::vector<std::string> concat_ops { "~" };
+        static const std::vector<std::string> concat_not_followed_by { "}" };
+        if (!consumeOperator(concat_ops, concat_not_followed_by).empty()) {
             auto right = parseLogicalAnd();
             if (!right) throw std::runtime_error("Expected right side of 'string concat' expression");
             left = std::make_shared<BinaryOpExpr>(get_location(), std::move(left), std::move(right), BinaryOpExpr::Op::StrConcat);
@@ -2108,12 +3482,10 @@ private:
     }
 
     std::shared_ptr<Expression> parseMathPlusMinus() {
-        static std::regex plus_minus_tok(R"(\+|-(?![}%#]\}))");
-
         auto left = parseMathMulDiv();
         if (!left) throw std::runtime_error("Expected left side of 'math plus/minus' expression");
         std::string op_str;
-        while (!(op_str = consumeToken(plus_minus_tok)).empty()) {
+        while (!(op_str = consumePlusMinus()).empty()) {
             auto right = parseMathMulDiv();
             if (!right) throw std::runtime_error("Expected right side of 'math plus/minus' expression");
             auto op = op_str == "+" ? BinaryOpExpr::Op::Add : BinaryOpExpr::Op::Sub;
@@ -2126,9 +3498,11 @@ private:
         auto left = parseMathUnaryPlusMinus();
         if (!left) throw std::runtime_error("Expected left side of 'math mul/div' expression");
 
-        static std::regex mul_div_tok(R"(\*\*?|//?|%(?!\}))");
+        static const std::vector<std::string> mul_div_ops { "**", "*", "//", "/" };
+        static const std::vector<std::string> mod_ops { "%" };
+        static const std::vector<std::string> mod_not_followed_by { "}" };
         std::string op_str;
-        while (!(op_str = consumeToken(mul_div_tok)).empty()) {
+        while (!(op_str = consumeOperator(mul_div_ops)).empty() || !(op_str = consumeOperator(mod_ops, mod_not_followed_by)).empty()) {
             auto right = parseMathUnaryPlusMinus();
             if (!right) throw std::runtime_error("Expected right side of 'math mul/div' expression");
             auto op = op_str == "*" ? BinaryOpExpr::Op::Mul
@@ -2158,9 +3532,17 @@ private:
         return std::make_shared<CallExpr>(get_location(), std::make_shared<VariableExpr>(get_location(), name), std::move(args));
     }
 
+    /** `\+|-(?![}%#]\})` (i.e. not the whitespace control of a closing tag) */
+    std::string consumePlusMinus() {
+        static const std::vector<std::string> plus_ops { "+" };
+        static const std::vector<std::string> minus_ops { "-" };
+        static const std::vector<std::string> closing_tags { "}}", "%}", "#}" };
+        auto op = consumeOperator(plus_ops);
+        return op.empty() ? consumeOperator(minus_ops, closing_tags) : op;
+    }
+
     std::shared_ptr<Expression> parseMathUnaryPlusMinus() {
-        static std::regex unary_plus_minus_tok(R"(\+|-(?![}%#]\}))");
-        auto op_str = consumeToken(unary_plus_minus_tok);
+        auto op_str = consumePlusMinus();
         auto expr = parseExpansion();
         if (!expr) throw std::runtime_error("Expected expr of 'unary plus/minus/expansion' expression");
 
@@ -2172,8 +3554,8 @@ private:
     }
 
     std::shared_ptr<Expression> parseExpansion() {
-      static std::regex expansion_tok(R"(\*\*?)");
-      auto op_str = consumeToken(expansion_tok);
+      static const std::vector<std::string> expansion_ops { "**", "*" };
+      auto op_str = consumeOperator(expansion_ops);
       auto expr = parseValueExpression();
       if (op_str.empty()) return expr;
       if (!expr) throw std::runtime_error("Expected expr of 'expansion' expression");
@@ -2186,8 +3568,7 @@ private:
         auto constant = parseConstant();
         if (constant) return std::make_shared<LiteralExpr>(location, *constant);
 
-        static std::regex null_regex(R"(null\b)");
-        if (!consumeToken(null_regex).empty()) return std::make_shared<LiteralExpr>(location, Value());
+        if (!consumeKeyword("null").empty()) return std::make_shared<LiteralExpr>(location, Value());
 
         auto identifier = parseIdentifier();
         if (identifier) return identifier;
@@ -2357,20 +3738,60 @@ private:
     using TemplateTokenVector = std::vector<std::unique_ptr<TemplateToken>>;
     using TemplateTokenIterator = TemplateTokenVector::const_iterator;
 
+    /** `(\w+)(\s*,\s*(\w+))*\s*` */
     std::vector<std::string> parseVarNames() {
-      static std::regex varnames_regex(R"(((?:\w+)(?:\s*,\s*(?:\w+))*)\s*)");
-
-      std::vector<std::string> group;
-      if ((group = consumeTokenGroups(varnames_regex)).empty()) throw std::runtime_error("Expected variable names");
-      std::vector<std::string> varnames;
-      std::istringstream iss(group[1]);
-      std::string varname;
-      while (std::getline(iss, varname, ',')) {
-        varnames.push_back(strip(varname));
+      auto varname = consumeWord();
+      if (varname.empty()) throw std::runtime_error("Expected variable names");
+      std::vector<std::string> varnames { varname };
+      while (true) {
+        auto before = it;
+        if (consumeToken(",").empty() || (varname = consumeWord()).empty()) {
+          it = before;
+          break;
+        }
+        varnames.push_back(varname);
       }
+      consumeSpaces();
       return varnames;
     }
 
+    /** Consumes a tag opening (e.g. `{{`) and its optional whitespace control (`[-~]?`). */
+    std::optional<SpaceHandling> consumeTagOpen(const std::string & open) {
+      if (!matchesAt(it, open)) return std::nullopt;
+      it += open.size();
+      if (it != end && (*it == '-' || *it == '~')) {
+        return parsePreSpace(std::string(1, *(it++)));
+      }
+      return SpaceHandling::Keep;
+    }
+
+    /** Consumes spaces, an optional whitespace control (`[-~]?`) and a tag closing (e.g. `%}`). */
+    std::optional<SpaceHandling> consumeTagClose(const std::string & close) {
+      auto start = it;
+      consumeSpaces();
+      if (it != end && (*it == '-' || *it == '~') && matchesAt(it + 1, close)) {
+        auto post_space = parsePostSpace(std::string(1, *it));
+        it += 1 + close.size();
+        return post_space;
+      }
+      if (matchesAt(it, close)) {
+        it += close.size();
+        return SpaceHandling::Keep;
+      }
+      it = start;
+      return std::nullopt;
+    }
+
+    /** Position of the next `{{`, `{%` or `{#` (or end). */
+    CharIterator findNonTextOpen() const {
+      for (auto pos = it; pos != end; ++pos) {
+        if (*pos == '{' && pos + 1 != end && (*(pos + 1) == '{' || *(pos + 1) == '%' || *(pos + 1) == '#')) {
+          return pos;
+        }
+      }
+      return end;
+    }
+
     std::runtime_error unexpected(const TemplateToken & token) const {
       return std::runtime_error("Unexpected " + TemplateToken::typeToString(token.type)
         + error_location_suffix(*template_str, token.location.pos));
@@ -2380,50 +3801,66 @@ private:
         + error_location_suffix(*template_str, token.location.pos));
     }
 
+    /** `\{#([-~]?)([\s\S]*?)([-~]?)#\}` */
+    bool consumeComment(SpaceHandling & pre_space, std::string & content, SpaceHandling & post_space) {
+      static const std::string comment_close = "#}";
+      if (!matchesAt(it, "{#")) return false;
+      auto content_start = it + 2;
+      pre_space = SpaceHandling::Keep;
+      if (content_start != end && (*content_start == '-' || *content_start == '~')) {
+        pre_space = parsePreSpace(std::string(1, *(content_start++)));
+      }
+      auto close = std::search(content_start, end, comment_close.begin(), comment_close.end());
+      if (close == end) return false;
+      auto content_end = close;
+      post_space = SpaceHandling::Keep;
+      if (content_end != content_start && (*(content_end - 1) == '-' || *(content_end - 1) == '~')) {
+        post_space = parsePostSpace(std::string(1, *(--content_end)));
+      }
+      content = std::string(content_start, content_end);
+      it = close + comment_close.size();
+      return true;
+    }
+
     TemplateTokenVector tokenize() {
-      static std::regex comment_tok(R"(\{#([-~]?)([\s\S]*?)([-~]?)#\})");
-      static std::regex expr_open_regex(R"(\{\{([-~])?)");
-      static std::regex block_open_regex(R"(^\{%([-~])?\s*)");
-      static std::regex block_keyword_tok(R"((if|else|elif|endif|for|endfor|generation|endgeneration|set|endset|block|endblock|macro|endmacro|filter|endfilter|break|continue|call|endcall)\b)");
-      static std::regex non_text_open_regex(R"(\{\{|\{%|\{#)");
-      static std::regex expr_close_regex(R"(\s*([-~])?\}\})");
-      static std::regex block_close_regex(R"(\s*([-~])?%\})");
+      static const std::vector<std::string> block_keywords {
+        "if", "else", "elif", "endif", "for", "endfor", "generation", "endgeneration", "set", "endset", "block", "endblock",
+        "macro", "endmacro", "filter", "endfilter", "break", "continue", "call", "endcall",
+      };
 
       TemplateTokenVector tokens;
-      std::vector<std::string> group;
       std::string text;
-      std::smatch match;
+      SpaceHandling comment_pre_space, comment_post_space;
+      std::optional<SpaceHandling> tag_space;
 
       try {
         while (it != end) {
           auto location = get_location();
 
-          if (!(group = consumeTokenGroups(comment_tok, SpaceHandling::Keep)).empty()) {
-            auto pre_space = parsePreSpace(group[1]);
-            auto content = group[2];
-            auto post_space = parsePostSpace(group[3]);
-            tokens.push_back(std::make_unique<CommentTemplateToken>(location, pre_space, post_space, content));
-          } else if (!(group = consumeTokenGroups(expr_open_regex, SpaceHandling::Keep)).empty()) {
-            auto pre_space = parsePreSpace(group[1]);
+          if (consumeComment(comment_pre_space, text, comment_post_space)) {
+            tokens.push_back(std::make_unique<CommentTemplateToken>(location, comment_pre_space, comment_post_space, text));
+          } else if ((tag_space = consumeTagOpen("{{"))) {
+            auto pre_space = *tag_space;
             auto expr = parseExpression();
 
-            if ((group = consumeTokenGroups(expr_close_regex)).empty()) {
+            if (!(tag_space = consumeTagClose("}}"))) {
               throw std::runtime_error("Expected closing expression tag");
             }
 
-            auto post_space = parsePostSpace(group[1]);
+            auto post_space = *tag_space;
             tokens.push_back(std::make_unique<ExpressionTemplateToken>(location, pre_space, post_space, std::move(expr)));
-          } else if (!(group = consumeTokenGroups(block_open_regex, SpaceHandling::Keep)).empty()) {
-            auto pre_space = parsePreSpace(group[1]);
+          } else if ((tag_space = consumeTagOpen("{%"))) {
+            auto pre_space = *tag_space;
+            consumeSpaces();
 
             std::string keyword;
 
             auto parseBlockClose = [&]() -> SpaceHandling {
-              if ((group = consumeTokenGroups(block_close_regex)).empty()) throw std::runtime_error("Expected closing block tag");
-              return parsePostSpace(group[1]);
+              if (!(tag_space = consumeTagClose("%}"))) throw std::runtime_error("Expected closing block tag");
+              return *tag_space;
             };
 
-            if ((keyword = consumeToken(block_keyword_tok)).empty()) throw std::runtime_error("Expected block keyword");
+            if ((keyword = consumeKeyword(block_keywords)).empty()) throw std::runtime_error("Expected block keyword");
 
             if (keyword == "if") {
               auto condition = parseExpression();
@@ -2444,20 +3881,16 @@ private:
               auto post_space = parseBlockClose();
               tokens.push_back(std::make_unique<EndIfTemplateToken>(location, pre_space, post_space));
             } else if (keyword == "for") {
-              static std::regex recursive_tok(R"(recursive\b)");
-              static std::regex if_tok(R"(if\b)");
-
               auto varnames = parseVarNames();
-              static std::regex in_tok(R"(in\b)");
-              if (consumeToken(in_tok).empty()) throw std::runtime_error("Expected 'in' keyword in for block");
+              if (consumeKeyword("in").empty()) throw std::runtime_error("Expected 'in' keyword in for block");
               auto iterable = parseExpression(/* allow_if_expr = */ false);
               if (!iterable) throw std::runtime_error("Expected iterable in for block");
 
               std::shared_ptr<Expression> condition;
-              if (!consumeToken(if_tok).empty()) {
+              if (!consumeKeyword("if").empty()) {
                 condition = parseExpression();
               }
-              auto recursive = !consumeToken(recursive_tok).empty();
+              auto recursive = !consumeKeyword("recursive").empty();
 
               auto post_space = parseBlockClose();
               tokens.push_back(std::make_unique<ForTemplateToken>(location, pre_space, post_space, std::move(varnames), std::move(iterable), std::move(condition), recursive));
@@ -2471,20 +3904,22 @@ private:
               auto post_space = parseBlockClose();
               tokens.push_back(std::make_unique<EndGenerationTemplateToken>(location, pre_space, post_space));
             } else if (keyword == "set") {
-              static std::regex namespaced_var_regex(R"((\w+)\s*\.\s*(\w+))");
-
               std::string ns;
               std::vector<std::string> var_names;
               std::shared_ptr<Expression> value;
-              if (!(group = consumeTokenGroups(namespaced_var_regex)).empty()) {
-                ns = group[1];
-                var_names.push_back(group[2]);
+              // `(\w+)\s*\.\s*(\w+)`
+              auto before_ns = it;
+              std::string var_name;
+              if (!(ns = consumeWord()).empty() && !consumeToken(".").empty() && !(var_name = consumeWord()).empty()) {
+                var_names.push_back(var_name);
 
                 if (consumeToken("=").empty()) throw std::runtime_error("Expected equals sign in set block");
 
                 value = parseExpression();
                 if (!value) throw std::runtime_error("Expected value in set block");
               } else {
+                ns.clear();
+                it = before_ns;
                 var_names = parseVarNames();
 
                 if (!consumeToken("=").empty()) {
@@ -2531,20 +3966,16 @@ private:
             } else {
               throw std::runtime_error("Unexpected block: " + keyword);
             }
-          } else if (std::regex_search(it, end, match, non_text_open_regex)) {
-            if (!match.position()) {
-                if (match[0] != "{#")
+          } else {
+            auto text_end = findNonTextOpen();
+            if (text_end == it) {
+                if (!matchesAt(it, "{#"))
                     throw std::runtime_error("Internal error: Expected a comment");
                 throw std::runtime_error("Missing end of comment tag");
             }
-            auto text_end = it + match.position();
             text = std::string(it, text_end);
             it = text_end;
             tokens.push_back(std::make_unique<TextTemplateToken>(location, SpaceHandling::Keep, SpaceHandling::Keep, text));
-          } else {
-            text = std::string(it, end);
-            it = end;
-            tokens.push_back(std::make_unique<TextTemplateToken>(location, SpaceHandling::Keep, SpaceHandling::Keep, text));
           }
         }
         return tokens;
@@ -2690,6 +4121,22 @@ private:
         }
     }
 
+    /** Names assigned by the template's set, for & macro tags, or macro parameters. */
+    static std::unordered_set<std::string> bound_names(const TemplateTokenVector & tokens) {
+        std::unordered_set<std::string> names;
+        for (const auto & token : tokens) {
+            if (auto set = dynamic_cast<const SetTemplateToken *>(token.get())) {
+                if (set->ns.empty()) names.insert(set->var_names.begin(), set->var_names.end());
+            } else if (auto for_token = dynamic_cast<const ForTemplateToken *>(token.get())) {
+                names.insert(for_token->var_names.begin(), for_token->var_names.end());
+            } else if (auto macro = dynamic_cast<const MacroTemplateToken *>(token.get())) {
+                if (macro->name) names.insert(macro->name->get_name());
+                for (const auto & param : macro->params) names.insert(param.first);
+            }
+        }
+        return names;
+    }
+
 public:
 
     static std::shared_ptr<TemplateNode> parse(const std::string& template_str, const Options & options) {
@@ -2698,7 +4145,350 @@ public:
         TemplateTokenIterator begin = tokens.begin();
         auto it = begin;
         TemplateTokenIterator end = tokens.end();
-        return parser.parseTemplate(begin, it, end, /* fully= */ true);
+        // Before parseTemplate moves the tokens' contents into the nodes.
+        ConstantFolder folder(bound_names(tokens));
+        auto root = parser.parseTemplate(begin, it, end, /* fully= */ true);
+        folder.fold_node(root);
+        VariableResolver resolver;
+        root->resolve_variables(resolver);
+        return root;
+    }
+};
+
+/*
+  Thread-safe LRU cache of parsed templates, keyed by (template source, Options).
+
+  Parsed roots are shared by all the callers, and must be treated as immutable (rendering them is fine,
+  including concurrently). Eviction is bounded by the total size of the cached sources (the ASTs are roughly
+  proportional to them); templates bigger than the bound are parsed but not cached.
+*/
+class TemplateCache {
+  public:
+    struct Stats {
+        size_t hits;
+        size_t misses;
+        size_t entries;
+        size_t bytes;
+        size_t max_bytes;
+    };
+
+    explicit TemplateCache(size_t max_bytes = 64 * 1024 * 1024) : max_bytes_(max_bytes) {}
+
+    /** Process-wide cache (used by chat_template). */
+    static TemplateCache & global() {
+        static TemplateCache cache;
+        return cache;
+    }
+
+    std::shared_ptr<TemplateNode> get_or_parse(const std::string & source, const Options & options) {
+        auto hash = hash_key(source, options);
+        {
+            std::lock_guard<std::mutex> lock(mutex_);
+            if (auto entry = find(hash, source, options); entry != entries_.end()) {
+                hits_++;
+                entries_.splice(entries_.begin(), entries_, entry);
+                return entry->root;
+            }
+            misses_++;
+        }
+        // Parse outside of the lock: concurrent misses on the same source may parse it twice, but only one copy is kept.
+        auto root = Parser::parse(source, options);
+        if (source.size() > max_bytes_) return root;
+
+        std::lock_guard<std::mutex> lock(mutex_);
+        if (auto entry = find(hash, source, options); entry != entries_.end()) {
+            return entry->root;
+        }
+        entries_.push_front({hash, source, options, root});
+        index_.emplace(hash, entries_.begin());
+        bytes_ += source.size();
+        evict();
+        return root;
+    }
+
+    void set_max_bytes(size_t max_bytes) {
+        std::lock_guard<std::mutex> lock(mutex_);
+        max_bytes_ = max_bytes;
+        evict();
+    }
+
+    void clear() {
+        std::lock_guard<std::mutex> lock(mutex_);
+        entries_.clear();
+        index_.clear();
+        bytes_ = 0;
+    }
+
+    Stats stats() const {
+        std::lock_guard<std::mutex> lock(mutex_);
+        return {hits_, misses_, entries_.size(), bytes_, max_bytes_};
+    }
+
+  private:
+    struct Entry {
+        size_t hash;
+        std::string source;
+        Options options;
+        std::shared_ptr<TemplateNode> root;
+    };
+    using EntryList = std::list<Entry>;
+
+    mutable std::mutex mutex_;
+    EntryList entries_;  // Most recently used first
+    std::unordered_multimap<size_t, EntryList::iterator> index_;
+    size_t max_bytes_;
+    size_t bytes_ = 0;
+    size_t hits_ = 0;
+    size_t misses_ = 0;
+
+    static size_t hash_key(const std::string & source, const Options & options) {
+        auto flags = (options.trim_blocks ? 1 : 0) | (options.lstrip_blocks ? 2 : 0) | (options.keep_trailing_newline ? 4 : 0);
+        return std::hash<std::string>()(source) ^ (static_cast<size_t>(flags) * 0x9e3779b97f4a7c15ull);
+    }
+
+    EntryList::iterator find(size_t hash, const std::string & source, const Options & options) {
+        auto range = index_.equal_range(hash);
+        for (auto it = range.first; it != range.second; ++it) {
+            const auto & entry = *it->second;
+            if (entry.options.trim_blocks == options.trim_blocks
+                && entry.options.lstrip_blocks == options.lstrip_blocks
+                && entry.options.keep_trailing_newline == options.keep_trailing_newline
+                && entry.source == source) {
+                return it->second;
+            }
+        }
+        return entries_.end();
+    }
+
+    void evict() {
+        while (bytes_ > max_bytes_ && !entries_.empty()) {
+            auto last = std::prev(entries_.end());
+            auto range = index_.equal_range(last->hash);
+            for (auto it = range.first; it != range.second; ++it) {
+                if (it->second == last) {
+                    index_.erase(it);
+                    break;
+                }
+            }
+            bytes_ -= last->source.size();
+            entries_.erase(last);
+        }
+    }
+};
+
+/*
+  Saves parsed templates to a compact, versioned binary blob, and loads them back without parsing
+  (e.g. to ship precompiled templates alongside the models).
+
+  Layout: "MNJA" magic, varint format version, flags byte (bit 0: the template source follows), [source], root node.
+  Each node is written as its AstTag, the offset of its location, then its fields (see the serialize overrides).
+  The source is only needed for the location of error messages: w/o it, all the offsets are 0. Offsets are checked
+  against the source on load.
+*/
+class TemplateSerializer {
+  public:
+    static constexpr uint64_t format_version = 1;
+
+    static std::string save(const TemplateNode & root, bool include_source = true) {
+        auto & source = root.location().source;
+        AstWriter out(/* locations= */ include_source && source);
+        out.write_bytes(magic);
+        out.write_varint(format_version);
+        out.write_u8(include_source && source ? 1 : 0);
+        if (include_source && source) out.write_string(*source);
+        root.serialize(out);
+        return out.str();
+    }
+
+    static std::shared_ptr<TemplateNode> load(const std::string & blob) {
+        if (blob.compare(0, magic.size(), magic) != 0) throw std::runtime_error("Not a minja template blob");
+        AstReader in(blob);
+        in.read_bytes(magic.size());
+        auto version = in.read_varint();
+        if (version != format_version) {
+            throw std::runtime_error("Unsupported template blob version " + std::to_string(version) + " (expected " + std::to_string(format_version) + ")");
+        }
+        if (in.read_u8() & 1) {
+            in.source = std::make_shared<std::string>(in.read_string());
+        }
+        auto root = read_node(in);
+        if (!root) throw std::runtime_error("Template blob has no root node");
+        if (!in.at_end()) throw std::runtime_error("Trailing data in template blob");
+        VariableResolver resolver;
+        root->resolve_variables(resolver);
+        return root;
+    }
+
+  private:
+    static inline const std::string magic = "MNJA";
+
+    template <typename E>
+    static E read_enum(AstReader & in, E last) {
+        auto v = in.read_u8();
+        if (v > static_cast<uint8_t>(last)) throw std::runtime_error("Invalid enum value in template blob");
+        return static_cast<E>(v);
+    }
+
+    static std::vector<std::shared_ptr<Expression>> read_expressions(AstReader & in) {
+        std::vector<std::shared_ptr<Expression>> exprs(in.read_size());
+        for (auto & expr : exprs) expr = read_expression(in);
+        return exprs;
+    }
+
+    static Expression::Parameters read_named_expressions(AstReader & in) {
+        Expression::Parameters exprs(in.read_size());
+        for (auto & [name, expr] : exprs) {
+            name = in.read_string();
+            expr = read_expression(in);
+        }
+        return exprs;
+    }
+
+    static std::shared_ptr<VariableExpr> read_variable(AstReader & in) {
+        auto expr = read_expression(in);
+        auto var = std::dynamic_pointer_cast<VariableExpr>(expr);
+        if (expr && !var) throw std::runtime_error("Expected a variable in template blob");
+        return var;
+    }
+
+    static ArgumentsExpression read_arguments(AstReader & in) {
+        ArgumentsExpression args;
+        args.args = read_expressions(in);
+        args.kwargs = read_named_expressions(in);
+        return args;
+    }
+
+    static std::shared_ptr<Expression> read_expression(AstReader & in) {
+        auto tag = in.read_tag();
+        if (tag == AstTag::Null) return nullptr;
+        auto loc = in.read_location();
+        // Fields are read into locals in order: the evaluation order of constructor arguments is unspecified.
+        switch (tag) {
+            case AstTag::VariableExpr: {
+                auto name = in.read_string();
+                return std::make_shared<VariableExpr>(loc, name);
+            }
+            case AstTag::IfExpr: {
+                auto condition = read_expression(in);
+                auto then_expr = read_expression(in);
+                auto else_expr = read_expression(in);
+                return std::make_shared<IfExpr>(loc, std::move(condition), std::move(then_expr), std::move(else_expr));
+            }
+            case AstTag::LiteralExpr:
+                return std::make_shared<LiteralExpr>(loc, in.read_value());
+            case AstTag::ArrayExpr:
+                return std::make_shared<ArrayExpr>(loc, read_expressions(in));
+            case AstTag::DictExpr: {
+                std::vector<std::pair<std::shared_ptr<Expression>, std::shared_ptr<Expression>>> elements(in.read_size());
+                for (auto & [key, value] : elements) {
+                    key = read_expression(in);
+                    value = read_expression(in);
+                }
+                return std::make_shared<DictExpr>(loc, std::move(elements));
+            }
+            case AstTag::SliceExpr: {
+                auto start = read_expression(in);
+                auto end = read_expression(in);
+                auto step = read_expression(in);
+                return std::make_shared<SliceExpr>(loc, std::move(start), std::move(end), std::move(step));
+            }
+            case AstTag::SubscriptExpr: {
+                auto base = read_expression(in);
+                auto index = read_expression(in);
+                return std::make_shared<SubscriptExpr>(loc, std::move(base), std::move(index));
+            }
+            case AstTag::UnaryOpExpr: {
+                auto expr = read_expression(in);
+                auto op = read_enum(in, UnaryOpExpr::Op::ExpansionDict);
+                return std::make_shared<UnaryOpExpr>(loc, std::move(expr), op);
+            }
+            case AstTag::BinaryOpExpr: {
+                auto left = read_expression(in);
+                auto right = read_expression(in);
+                auto op = read_enum(in, BinaryOpExpr::Op::IsNot);
+                return std::make_shared<BinaryOpExpr>(loc, std::move(left), std::move(right), op);
+            }
+            case AstTag::MethodCallExpr: {
+                auto object = read_expression(in);
+                auto method = read_variable(in);
+                auto args = read_arguments(in);
+                return std::make_shared<MethodCallExpr>(loc, std::move(object), std::move(method), std::move(args));
+            }
+            case AstTag::CallExpr: {
+                auto object = read_expression(in);
+                auto args = read_arguments(in);
+                return std::make_shared<CallExpr>(loc, std::move(object), std::move(args));
+            }
+            case AstTag::FilterExpr:
+                return std::make_shared<FilterExpr>(loc, read_expressions(in));
+            default:
+                throw std::runtime_error("Unexpected expression tag in template blob: " + std::to_string(static_cast<int>(tag)));
+        }
+    }
+
+    static std::shared_ptr<TemplateNode> read_node(AstReader & in) {
+        auto tag = in.read_tag();
+        if (tag == AstTag::Null) return nullptr;
+        auto loc = in.read_location();
+        switch (tag) {
+            case AstTag::SequenceNode: {
+                std::vector<std::shared_ptr<TemplateNode>> children(in.read_size());
+                for (auto & child : children) child = read_node(in);
+                return std::make_shared<SequenceNode>(loc, std::move(children));
+            }
+            case AstTag::TextNode:
+                return std::make_shared<TextNode>(loc, in.read_string());
+            case AstTag::ExpressionNode:
+                return std::make_shared<ExpressionNode>(loc, read_expression(in));
+            case AstTag::IfNode: {
+                std::vector<std::pair<std::shared_ptr<Expression>, std::shared_ptr<TemplateNode>>> cascade(in.read_size());
+                for (auto & [condition, body] : cascade) {
+                    condition = read_expression(in);
+                    body = read_node(in);
+                }
+                return std::make_shared<IfNode>(loc, std::move(cascade));
+            }
+            case AstTag::LoopControlNode:
+                return std::make_shared<LoopControlNode>(loc, read_enum(in, LoopControlType::Continue));
+            case AstTag::ForNode: {
+                auto var_names = in.read_strings();
+                auto iterable = read_expression(in);
+                auto condition = read_expression(in);
+                auto body = read_node(in);
+                auto recursive = in.read_bool();
+                auto else_body = read_node(in);
+                return std::make_shared<ForNode>(loc, std::move(var_names), std::move(iterable), std::move(condition), std::move(body), recursive, std::move(else_body));
+            }
+            case AstTag::MacroNode: {
+                auto name = read_variable(in);
+                auto params = read_named_expressions(in);
+                auto body = read_node(in);
+                return std::make_shared<MacroNode>(loc, std::move(name), std::move(params), std::move(body));
+            }
+            case AstTag::FilterNode: {
+                auto filter = read_expression(in);
+                auto body = read_node(in);
+                return std::make_shared<FilterNode>(loc, std::move(filter), std::move(body));
+            }
+            case AstTag::SetNode: {
+                auto ns = in.read_string();
+                auto var_names = in.read_strings();
+                auto value = read_expression(in);
+                return std::make_shared<SetNode>(loc, ns, var_names, std::move(value));
+            }
+            case AstTag::SetTemplateNode: {
+                auto name = in.read_string();
+                auto template_value = read_node(in);
+                return std::make_shared<SetTemplateNode>(loc, name, std::move(template_value));
+            }
+            case AstTag::CallNode: {
+                auto expr = read_expression(in);
+                auto body = read_node(in);
+                return std::make_shared<CallNode>(loc, std::move(expr), std::move(body));
+            }
+            default:
+                throw std::runtime_error("Unexpected node tag in template blob: " + std::to_string(static_cast<int>(tag)));
+        }
     }
 };
 
@@ -2730,7 +4520,7 @@ static Value simple_function(const std::string & fn_name, const std::vector<std:
   });
 }
 
-inline std::shared_ptr<Context> Context::builtins() {
+inline std::shared_ptr<Context> Context::make_builtins() {
   auto globals = Value::object();
 
   globals.set("raise_exception", simple_function("raise_exception", { "message" }, [](const std::shared_ptr<Context> &, Value & args) -> Value {
@@ -3088,7 +4878,16 @@ inline std::shared_ptr<Context> Context::builtins() {
     return res;
   }));
 
-  return std::make_shared<Context>(std::move(globals));
+  return std::make_shared<ImmutableContext>(std::move(globals));
+}
+
+inline const std::shared_ptr<Context> & Context::shared_builtins() {
+  static const std::shared_ptr<Context> builtins = make_builtins();
+  return builtins;
+}
+
+inline std::shared_ptr<Context> Context::builtins() {
+  return std::make_shared<Context>(Value::object(), shared_builtins());
 }
 
 inline std::shared_ptr<Context> Context::make(Value && values, const std::shared_ptr<Context> & parent) {
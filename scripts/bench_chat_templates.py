@@ -0,0 +1,158 @@
+# Copyright 2024 Google LLC
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+#
+# SPDX-License-Identifier: MIT
+'''
+  Differential throughput benchmark of minja vs. the official Python jinja2 library on chat templates.
+
+  Replays every {template, context} pair generated by fetch_templates_and_goldens.py (i.e. every
+  <output_folder>/<model>.jinja that has a <model>-<context>.txt golden) through both
+  minja::chat_template::apply (tests/bench-chat-template.cpp) and the Python chat_template.apply,
+  and prints a CSV table with renders/sec, p50/p99 latency and peak RSS per model, engine & context.
+
+  Runs fully offline: it only reads the files previously generated in the output folder.
+  Each model is benchmarked in a separate process per engine, so that peak RSS is per model.
+
+  Usage:
+    python scripts/bench_chat_templates.py --minja-bench build/tests/bench-chat-template build/tests tests/contexts/*.json
+
+  Example (only a few models, as JSON lines):
+    python scripts/bench_chat_templates.py --minja-bench build/tests/bench-chat-template --iterations 200 --filter Qwen --format jsonl build/tests tests/contexts/*.json
+'''
+
+import argparse
+import csv
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+CSV_COLUMNS = [
+    'model', 'context', 'engine', 'iterations', 'load_ms', 'renders_per_sec', 'p50_us', 'p99_us', 'output_size', 'peak_rss_kb', 'speedup_vs_jinja2',
+]
+
+
+def peak_rss_kb() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def percentile_us(sorted_us: list, p: float) -> float:
+    if not sorted_us:
+        return 0
+    return sorted_us[min(int(p * (len(sorted_us) - 1) + 0.5), len(sorted_us) - 1)]
+
+
+def run_jinja2_worker(iterations: int, template_file: str, context_files: list):
+    '''Runs in a subprocess: benchmarks the Python chat_template.apply on one template, prints JSON lines.'''
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from fetch_templates_and_goldens import chat_template, raise_exception, strftime_now
+
+    template_src = Path(template_file).read_text(encoding='utf-8')
+    for context_file in context_files:
+        bindings = json.loads(Path(context_file).read_text(encoding='utf-8'))
+
+        load_start = time.perf_counter()
+        # Same setup as fetch_templates_and_goldens.handle_chat_template
+        template = chat_template(template_src,
+                                 filters={'safe': lambda x: x},
+                                 global_functions={'raise_exception': raise_exception, 'strftime_now': strftime_now})
+        load_end = time.perf_counter()
+
+        durations_us = []
+        output_size = 0
+        total_start = time.perf_counter()
+        for _ in range(iterations):
+            start = time.perf_counter()
+            output_size = len(template.apply(bindings).encode('utf-8'))
+            durations_us.append((time.perf_counter() - start) * 1e6)
+        total_s = time.perf_counter() - total_start
+        durations_us.sort()
+
+        print(json.dumps({
+            'engine': 'jinja2',
+            'template': template_file,
+            'context': context_file,
+            'iterations': iterations,
+            'load_ms': (load_end - load_start) * 1e3,
+            'renders_per_sec': iterations / total_s if total_s > 0 else 0,
+            'p50_us': percentile_us(durations_us, 0.50),
+            'p99_us': percentile_us(durations_us, 0.99),
+            'output_size': output_size,
+            'peak_rss_kb': peak_rss_kb(),
+        }), flush=True)
+
+
+def find_cases(output_folder: str, context_files: list, name_filter: str):
+    '''Yields (model_name, template_file, [context_files]) for every generated template that has goldens.'''
+    for template_file in sorted(Path(output_folder).glob('*.jinja')):
+        model_name = template_file.stem
+        if name_filter and name_filter not in model_name:
+            continue
+        contexts = [
+            context_file for context_file in context_files
+            if (template_file.parent / f'{model_name}-{Path(context_file).stem}.txt').exists()
+        ]
+        if contexts:
+            yield model_name, str(template_file), contexts
+
+
+def run_engine(cmd: list, model_name: str):
+    result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
+    if result.returncode != 0:
+        print(f'Benchmark of {model_name} failed ({" ".join(cmd[:2])}...): {result.stderr.strip()}', file=sys.stderr)
+        return []
+    return [json.loads(line) for line in result.stdout.splitlines() if line.startswith('{')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark minja vs. jinja2 on the generated chat template test cases.")
+    parser.add_argument("output_folder", help="Folder previously populated by fetch_templates_and_goldens.py")
+    parser.add_argument("context_files", nargs="+", help="Context JSON files (e.g. tests/contexts/*.json)")
+    parser.add_argument("--minja-bench", help="Path to the bench-chat-template binary (skips minja if not set)")
+    parser.add_argument("--no-jinja2", action="store_true", help="Skip the Python jinja2 side")
+    parser.add_argument("--iterations", type=int, default=100, help="Renders per {template, context} pair")
+    parser.add_argument("--filter", default="", help="Only benchmark models whose name contains this string")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default="csv", help="Output format")
+    parser.add_argument("--jinja2-worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.jinja2_worker:
+        # Internal mode: output_folder is the template file here.
+        run_jinja2_worker(args.iterations, args.output_folder, args.context_files)
+        return
+
+    writer = csv.DictWriter(sys.stdout, fieldnames=CSV_COLUMNS, extrasaction='ignore') if args.format == 'csv' else None
+    if writer:
+        writer.writeheader()
+
+    for model_name, template_file, contexts in find_cases(args.output_folder, args.context_files, args.filter):
+        print(f'Benchmarking {model_name}...', file=sys.stderr)
+        rows = []
+        if args.minja_bench:
+            rows += run_engine([args.minja_bench, str(args.iterations), template_file] + contexts, model_name)
+        if not args.no_jinja2:
+            rows += run_engine([sys.executable, os.path.abspath(__file__), '--jinja2-worker', '--iterations', str(args.iterations),
+                                template_file] + contexts, model_name)
+
+        jinja2_rps = {row['context']: row['renders_per_sec'] for row in rows if row['engine'] == 'jinja2'}
+        for row in rows:
+            row['model'] = model_name
+            reference = jinja2_rps.get(row['context'])
+            row['speedup_vs_jinja2'] = row['renders_per_sec'] / reference if reference else None
+            row['context'] = Path(row['context']).stem
+            if writer:
+                writer.writerow({k: (f'{v:.2f}' if isinstance(v, float) else v) for k, v in row.items()})
+            else:
+                print(json.dumps(row))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
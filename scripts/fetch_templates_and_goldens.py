@@ -16,8 +16,17 @@
   Example:
     pip install -r requirements.txt
     python scripts/fetch_templates_and_goldens.py ./test_files tests/contexts/*.json CohereForAI/c4ai-command-r-plus mistralai/Mistral-Large-Instruct-2407 meetkai/functionary-medium-v3.1.jinja microsoft/Phi-3-medium-4k-instruct Qwen/Qwen2-7B-Instruct
+
+  Downloads from HuggingFace are cached on disk (--cache-dir, or $MINJA_HF_CACHE, default ~/.cache/minja/hf):
+  file contents are stored by sha256 under blobs/ and refs/<repo_id>/<filename>.json records the ETag & hash
+  of each file, which are revalidated w/ a conditional request (a 304 reply reuses the cached blob).
+
+  With --offline (or $MINJA_HF_OFFLINE=1 / $HF_HUB_OFFLINE=1), the network is never used: files are served
+  from the --mirror directory (or $MINJA_HF_MIRROR, laid out as <repo_id>/<filename>) or else from the cache.
+  A mirror can also be given when online, in which case it takes precedence over the network.
 '''
 
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 import logging
 import datetime
@@ -25,6 +34,7 @@ import os
 import sys
 import asyncio
 import aiofiles
+import contextlib
 from huggingface_hub import AsyncInferenceClient
 from huggingface_hub.utils import build_hf_headers
 import json
@@ -33,6 +43,8 @@ import jinja2.ext
 import re
 import argparse
 import aiohttp
+import hashlib
+import random
 import shutil
 
 logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -369,7 +381,114 @@ class Context:
     bindings: dict
 
 
-async def handle_chat_template(output_folder, model_id, variant, template_src, contexts: list[Context]):
+def generate_goldens(template_src: str, contexts: list[Context], base_name: str) -> tuple[TemplateCaps, list[tuple[Context, str]]]:
+    '''
+        Probes the capabilities of a template and renders it on each of the (relevant) contexts.
+        This is the CPU-bound part of the work: it is a top-level function so it can run in a worker process.
+    '''
+    template = chat_template(template_src,
+                             filters={
+                                    'safe': lambda x: x,
+                             },
+                             global_functions={
+                                    'raise_exception': raise_exception,
+                                    'strftime_now': strftime_now,
+                             })
+    caps = template.original_caps
+
+    goldens = []
+    for context in contexts:
+        assert isinstance(context, Context)
+        assert isinstance(context.bindings, dict)
+        if not caps.supports_tool_calls and context.bindings.get('tools') is not None:
+            print(f'Skipping {context.name} test as tools seem unsupported by template {base_name}', file=sys.stderr)
+            continue
+
+        needs_tools_in_system = len(context.bindings.get('tools', [])) > 0 and not caps.supports_tools
+        if not caps.supports_system_role and (any(m['role'] == 'system' for m in context.bindings['messages']) or needs_tools_in_system):
+            continue
+
+        goldens.append((context, template.apply(context.bindings)))
+    return caps, goldens
+
+
+def sha256_hex(data: str) -> str:
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+async def write_if_changed(path: str, content: str):
+    '''Writes a text file unless it already has the exact same content (keeps its mtime stable for CMake / ctest).'''
+    try:
+        async with aiofiles.open(path, 'r', encoding='utf-8', newline='') as f:
+            if await f.read() == content:
+                return
+    except (OSError, UnicodeDecodeError):
+        pass
+    async with aiofiles.open(path, 'w', encoding='utf-8', newline='\n') as f:
+        await f.write(content)
+
+
+class GoldensManifest:
+    '''
+        Records, for each generated template, the hashes of the inputs its outputs were generated from:
+        the template source, each context file, and the generator itself (this script's source, jinja2's version
+        and TEST_DATE). Goldens are only regenerated when one of these changes (or an output file went missing).
+
+        Format: {"generator": hash, "templates": {base_name: {"template": hash, "caps": caps_json,
+                 "contexts": {context_name: {"context": hash, "output": output hash, or null if skipped}}}}}
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(__file__, 'r', encoding='utf-8') as f:
+            self.generator_hash = sha256_hex(f'{f.read()}\n{jinja2.__version__}\n{TEST_DATE}')
+        self.previous = {}
+        self.templates = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('generator') == self.generator_hash:
+                self.previous = data.get('templates', {})
+        except (OSError, ValueError):
+            pass
+
+    def get(self, base_name: str, template_hash: str) -> dict:
+        entry = self.previous.get(base_name)
+        if entry is None or entry.get('template') != template_hash:
+            return {"template": template_hash, "caps": None, "contexts": {}}
+        return entry
+
+    def update(self, base_name: str, entry: dict):
+        self.templates[base_name] = entry
+
+    def save(self):
+        data = json.dumps({"generator": self.generator_hash, "templates": self.templates}, indent=2, sort_keys=True)
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                if f.read() == data:
+                    return
+        except OSError:
+            pass
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+
+def is_golden_up_to_date(recorded: dict, context_hash: str, output_file: str) -> bool:
+    if recorded is None or recorded.get('context') != context_hash:
+        return False
+    if recorded.get('output') is None:
+        return True
+    try:
+        with open(output_file, 'r', encoding='utf-8', newline='') as f:
+            return sha256_hex(f.read()) == recorded['output']
+    except (OSError, UnicodeDecodeError):
+        return False
+
+
+async def handle_chat_template(output_folder, model_id, variant, template_src, contexts: list[Context], executor=None,
+                               manifest: GoldensManifest = None):
     if '{% generation %}' in template_src:
         print('Removing {% generation %} blocks from template', file=sys.stderr)
         template_src = template_src.replace('{% generation %}', '').replace('{% endgeneration %}', '')
@@ -380,55 +499,192 @@ async def handle_chat_template(output_folder, model_id, variant, template_src, c
 
     caps_file = join_cmake_path(output_folder, f'{base_name}.caps.json')
 
-    async with aiofiles.open(template_file, 'w', encoding='utf-8', newline='\n') as f:
-        await f.write(template_src)
+    await write_if_changed(template_file, template_src)
 
-    template = chat_template(template_src, 
-                             filters={
-                                    'safe': lambda x: x,
-                             },
-                             global_functions={
-                                    'raise_exception': raise_exception,
-                                    'strftime_now': strftime_now,
-                             })
-    caps = template.original_caps
+    assert isinstance(contexts, list)
+    entry = manifest.get(base_name, sha256_hex(template_src)) if manifest else {"template": None, "caps": None, "contexts": {}}
+    context_hashes = {context.name: sha256_hex(json.dumps(context.bindings, sort_keys=True)) for context in contexts}
+    stale_contexts = [
+        context for context in contexts
+        if not is_golden_up_to_date(entry['contexts'].get(context.name), context_hashes[context.name],
+                                    join_cmake_path(output_folder, f'{base_name}-{context.name}.txt'))
+    ]
+    if entry['caps'] is None or stale_contexts:
+        if executor:
+            caps, goldens = await asyncio.get_running_loop().run_in_executor(
+                executor, generate_goldens, template_src, stale_contexts, base_name)
+        else:
+            caps, goldens = generate_goldens(template_src, stale_contexts, base_name)
+        generated = {context.name: output for context, output in goldens}
+        entry = {
+            "template": entry['template'],
+            "caps": caps.to_json(),
+            "contexts": {
+                **{name: recorded for name, recorded in entry['contexts'].items() if name in context_hashes},
+                **{
+                    context.name: {
+                        "context": context_hashes[context.name],
+                        "output": sha256_hex(generated[context.name]) if context.name in generated else None,
+                    }
+                    for context in stale_contexts
+                },
+            },
+        }
+    else:
+        generated = {}
+    if manifest:
+        manifest.update(base_name, entry)
 
     if not contexts:
         print(f"{template_file} {caps_file} n/a {template_file}")
         return
 
-    async with aiofiles.open(caps_file, 'w', encoding='utf-8', newline='\n') as f:
-        await f.write(caps.to_json())
+    await write_if_changed(caps_file, entry['caps'])
 
-    assert isinstance(contexts, list)
     for context in contexts:
-        assert isinstance(context, Context)
-        assert isinstance(context.bindings, dict)
-        if not caps.supports_tool_calls and context.bindings.get('tools') is not None:
-            print(f'Skipping {context.name} test as tools seem unsupported by template {template_file}', file=sys.stderr)
+        if entry['contexts'][context.name]['output'] is None:
             continue
+        output_file = join_cmake_path(output_folder, f'{base_name}-{context.name}.txt')
+        if context.name in generated:
+            await write_if_changed(output_file, generated[context.name])
 
-        needs_tools_in_system = len(context.bindings.get('tools', [])) > 0 and not caps.supports_tools
-        if not caps.supports_system_role and (any(m['role'] == 'system' for m in context.bindings['messages']) or needs_tools_in_system):
-            continue
+        print(f"{template_file} {caps_file} {context.file} {output_file}")
 
-        output_file = join_cmake_path(output_folder, f'{base_name}-{context.name}.txt')
+def env_flag(name: str) -> bool:
+    return os.environ.get(name, '').lower() in ('1', 'true', 'yes', 'on')
 
-        output = template.apply(context.bindings)
-        async with aiofiles.open(output_file, 'w', encoding='utf-8', newline='\n') as f:
-            await f.write(output)
 
-        print(f"{template_file} {caps_file} {context.file} {output_file}")
+class HFCache:
+    '''
+        Content-addressed on-disk cache of HuggingFace repo files, w/ an optional read-only mirror & offline mode.
 
-async def async_hf_download(repo_id: str, filename: str) -> str:
-    headers = build_hf_headers()
-    url = f"https://huggingface.co/{repo_id}/raw/main/{filename}"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            response.raise_for_status()
-            return await response.text()
+        Layout: blobs/<sha256> holds file contents, refs/<repo_id>/<filename>.json holds {"etag", "sha256"}.
 
-async def process_model(output_folder: str, model_id: str, contexts: list[Context]):
+        Network requests share a single pooled aiohttp session (see `session()`), at most `max_concurrency` of
+        them are in flight at any time, and transient failures (connection errors, 429, 5xx) are retried
+        `retries` times w/ exponential backoff (honouring Retry-After).
+    '''
+
+    RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+
+    def __init__(self, cache_dir: str = None, mirror_dir: str = None, offline: bool = False,
+                 max_concurrency: int = 16, retries: int = 4, backoff: float = 0.5):
+        self.cache_dir = cache_dir
+        self.mirror_dir = mirror_dir
+        self.offline = offline
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self._session = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        '''Keeps one pooled (keep-alive) HTTP session open for all the downloads made within this context.'''
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
+            self._session = session
+            try:
+                yield self
+            finally:
+                self._session = None
+
+    def _ref_path(self, repo_id: str, filename: str) -> str:
+        return os.path.join(self.cache_dir, 'refs', *repo_id.split('/'), f'{filename}.json')
+
+    def _blob_path(self, sha256: str) -> str:
+        return os.path.join(self.cache_dir, 'blobs', sha256)
+
+    async def _read_ref(self, repo_id: str, filename: str):
+        '''Returns (etag, content) for a cached file, or (None, None) if missing or corrupt.'''
+        if not self.cache_dir:
+            return None, None
+        try:
+            async with aiofiles.open(self._ref_path(repo_id, filename), 'r', encoding='utf-8') as f:
+                ref = json.loads(await f.read())
+            async with aiofiles.open(self._blob_path(ref['sha256']), 'rb') as f:
+                content = await f.read()
+        except (OSError, ValueError, KeyError):
+            return None, None
+        if hashlib.sha256(content).hexdigest() != ref['sha256']:
+            return None, None
+        return ref.get('etag'), content.decode('utf-8')
+
+    async def _write_atomic(self, path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        async with aiofiles.open(tmp_path, 'wb') as f:
+            await f.write(data)
+        os.replace(tmp_path, path)
+
+    async def _write_ref(self, repo_id: str, filename: str, etag: str, content: str):
+        if not self.cache_dir:
+            return
+        data = content.encode('utf-8')
+        sha256 = hashlib.sha256(data).hexdigest()
+        if not os.path.exists(self._blob_path(sha256)):
+            await self._write_atomic(self._blob_path(sha256), data)
+        await self._write_atomic(self._ref_path(repo_id, filename),
+                                 json.dumps({"etag": etag, "sha256": sha256}).encode('utf-8'))
+
+    async def download(self, repo_id: str, filename: str) -> str:
+        if self.mirror_dir:
+            mirror_file = os.path.join(self.mirror_dir, *repo_id.split('/'), filename)
+            if os.path.isfile(mirror_file):
+                async with aiofiles.open(mirror_file, 'r', encoding='utf-8') as f:
+                    return await f.read()
+
+        etag, cached = await self._read_ref(repo_id, filename)
+        if self.offline:
+            if cached is None:
+                raise FileNotFoundError(f"{repo_id}/{filename} is neither in the mirror nor in the cache (offline mode)")
+            return cached
+
+        headers = build_hf_headers()
+        if cached is not None and etag:
+            headers['If-None-Match'] = etag
+        url = f"{os.environ.get('HF_ENDPOINT', 'https://huggingface.co')}/{repo_id}/raw/main/{filename}"
+        if self._session is None:
+            async with self.session():
+                status, response_etag, content = await self._get(url, headers)
+        else:
+            status, response_etag, content = await self._get(url, headers)
+        if status == 304 and cached is not None:
+            return cached
+        await self._write_ref(repo_id, filename, response_etag, content)
+        return content
+
+    async def _get(self, url: str, headers: dict):
+        '''Returns (status, etag, text) of a 200 or 304 response, retrying transient failures.'''
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            try:
+                async with self._semaphore:
+                    async with self._session.get(url, headers=headers) as response:
+                        if response.status == 304:
+                            return response.status, response.headers.get('ETag'), None
+                        if response.status not in self.RETRYABLE_STATUSES or attempt == self.retries:
+                            response.raise_for_status()
+                            return response.status, response.headers.get('ETag'), await response.text()
+                        retry_after = response.headers.get('Retry-After')
+                        error = f"HTTP {response.status}"
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                error = f"{type(e).__name__}: {e}"
+
+            delay = self.backoff * (2 ** attempt) * (1 + random.random())
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            logger.info(f"  Retrying {url} in {delay:.1f}s ({error})")
+            await asyncio.sleep(delay)
+
+
+async def async_hf_download(repo_id: str, filename: str, cache: HFCache = None) -> str:
+    return await (cache or HFCache()).download(repo_id, filename)
+
+async def process_model(output_folder: str, model_id: str, contexts: list[Context], cache: HFCache = None, executor=None,
+                        manifest: GoldensManifest = None):
     try:
         print(f"Processing model {model_id}...", file=sys.stderr)
 
@@ -438,10 +694,10 @@ async def process_model(output_folder: str, model_id: str, contexts: list[Contex
                 chat_template = await f.read()
             # Use filename without extension as model_id for output naming
             synthetic_id = os.path.basename(model_id).replace('.jinja', '')
-            await handle_chat_template(output_folder, synthetic_id, None, chat_template, contexts)
+            await handle_chat_template(output_folder, synthetic_id, None, chat_template, contexts, executor, manifest)
             return
 
-        config_str = await async_hf_download(model_id, "tokenizer_config.json")
+        config_str = await async_hf_download(model_id, "tokenizer_config.json", cache)
 
         try:
             config = json.loads(config_str)
@@ -450,7 +706,7 @@ async def process_model(output_folder: str, model_id: str, contexts: list[Contex
 
         if 'chat_template' not in config:
             try:
-                chat_template = await async_hf_download(model_id, "chat_template.jinja")
+                chat_template = await async_hf_download(model_id, "chat_template.jinja", cache)
                 config.update({'chat_template': chat_template})
             except Exception as e:
                 logger.error(f"Failed to fetch chat_template.jinja for model {model_id}: {e}")
@@ -459,17 +715,17 @@ async def process_model(output_folder: str, model_id: str, contexts: list[Contex
         assert 'chat_template' in config, 'No "chat_template" entry in tokenizer_config.json or no chat_template.jinja file found!'
         chat_template = config['chat_template']
         if isinstance(chat_template, str):
-            await handle_chat_template(output_folder, model_id, None, chat_template, contexts)
+            await handle_chat_template(output_folder, model_id, None, chat_template, contexts, executor, manifest)
         else:
             await asyncio.gather(*[
-                handle_chat_template(output_folder, model_id, ct['name'], ct['template'], contexts)
+                handle_chat_template(output_folder, model_id, ct['name'], ct['template'], contexts, executor, manifest)
                 for ct in chat_template
             ])
     except Exception as e:
         logger.error(f"Error processing model {model_id}: {e}")
         # import traceback
         # traceback.print_exc()
-        await handle_chat_template(output_folder, model_id, None, str(e), [])
+        await handle_chat_template(output_folder, model_id, None, str(e), [], executor, manifest)
 
 async def async_copy_file(src: str, dst: str):
     async with aiofiles.open(src, 'rb') as fsrc:
@@ -480,7 +736,20 @@ async def main():
     parser = argparse.ArgumentParser(description="Generate chat templates and output test arguments.")
     parser.add_argument("output_folder", help="Folder to store all output files")
     parser.add_argument("json_context_files_or_model_ids", nargs="+", help="List of context JSON files or HuggingFace model IDs")
+    parser.add_argument("--cache-dir", default=os.environ.get('MINJA_HF_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'minja', 'hf')),
+                        help="Directory of the HuggingFace download cache (empty string to disable)")
+    parser.add_argument("--mirror", default=os.environ.get('MINJA_HF_MIRROR'), help="Local mirror directory laid out as <repo_id>/<filename>")
+    parser.add_argument("--offline", action="store_true", default=env_flag('MINJA_HF_OFFLINE') or env_flag('HF_HUB_OFFLINE'),
+                        help="Never access the network, only serve files from the mirror or the cache")
+    parser.add_argument("--max-concurrency", type=int, default=int(os.environ.get('MINJA_HF_MAX_CONCURRENCY', '16')),
+                        help="Max number of concurrent HTTP requests")
+    parser.add_argument("--retries", type=int, default=4, help="Number of retries of failed HTTP requests")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes probing templates & rendering goldens (1 to run in-process)")
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    cache = HFCache(args.cache_dir or None, args.mirror, args.offline, max_concurrency=args.max_concurrency, retries=args.retries)
 
     contexts: list[Context] = []
     model_ids = []
@@ -500,10 +769,14 @@ async def main():
 
     # for model_id in model_ids:
     #     await process_model(output_folder, model_id, contexts)
-    await asyncio.gather(*[
-        process_model(output_folder, model_id, contexts)
-        for model_id in model_ids
-    ])
+    manifest = GoldensManifest(os.path.join(output_folder, 'goldens-manifest.json'))
+    with ProcessPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else contextlib.nullcontext() as executor:
+        async with cache.session():
+            await asyncio.gather(*[
+                process_model(output_folder, model_id, contexts, cache, executor, manifest)
+                for model_id in model_ids
+            ])
+    manifest.save()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -5,17 +5,196 @@
 # https://opensource.org/licenses/MIT.
 #
 # SPDX-License-Identifier: MIT
+'''
+  Renders a Jinja2 template with the official Python library, as a reference for minja's C++ tests.
+
+  Usage:
+    python -m scripts.render input.json output.txt
+    python -m scripts.render < input.json > output.txt
+    python -m scripts.render --server [--cache-size 128]
+    python -m scripts.render --batch cases.jsonl outputs.jsonl [--jobs 8]
+
+  The input is a JSON object {"template": ..., "bindings": {...}, "options": {...}} where options are
+  jinja2.Environment keyword arguments (trim_blocks, lstrip_blocks, keep_trailing_newline).
+  The input (resp. output) file defaults to stdin (resp. stdout), which can also be requested explicitly w/ "-".
+
+  In --server mode, requests are read as newline-delimited JSON objects from stdin and a single line
+  {"output": "..."} or {"error": "..."} is written to stdout for each of them, until stdin is closed.
+  This lets test harnesses keep a single interpreter (and jinja2 import) alive for a whole test suite.
+
+  In --batch mode, each line of the input JSONL file is a request, rendered across a pool of worker
+  processes; the output JSONL file gets one {"output": ...} or {"error": ...} line per request, in input order.
+
+  Compiled templates are kept in an LRU cache keyed by the template's sha256 and the environment options,
+  so rendering the same template with many contexts only compiles it once.
+
+  If a request has "timing": true (or --timing is passed), its response also gets a "timing" record with
+  the (one-off) jinja2 import, compile (from_string, 0-ish on cache hits) and render durations in nanoseconds, and
+  the output size in bytes. In single-render mode, the timing record is printed to stderr; in --server mode with
+  --timing, the template cache stats are printed to stderr on exit.
+'''
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import hashlib
 import sys
 import json
-from jinja2 import Environment
-import jinja2.ext
+import time
 from pathlib import Path
 
-input_file, output_file = sys.argv[1:3]
-data = json.loads(Path(input_file).read_text())
-# print(json.dumps(data, indent=2), file=sys.stderr)
+_import_start_ns = time.perf_counter_ns()
+from jinja2 import Environment, Template  # noqa: E402
+import jinja2.ext  # noqa: E402
+IMPORT_NS = time.perf_counter_ns() - _import_start_ns
+
+ENVIRONMENT_OPTIONS = ('trim_blocks', 'lstrip_blocks', 'keep_trailing_newline')
+
+
+class TemplateCache:
+    '''
+      LRU cache of compiled jinja2 templates, keyed by (sha256 of the source, environment options).
+    '''
+
+    def __init__(self, max_size: int = 128):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._templates: OrderedDict[tuple, Template] = OrderedDict()
+        self._environments: dict[tuple, Environment] = {}
+
+    def get(self, template: str, options: dict) -> Template:
+        unknown_options = set(options) - set(ENVIRONMENT_OPTIONS)
+        if unknown_options:
+            raise ValueError(f'Unsupported options: {sorted(unknown_options)}')
+        options_key = tuple(bool(options.get(name, False)) for name in ENVIRONMENT_OPTIONS)
+        key = (hashlib.sha256(template.encode('utf-8')).hexdigest(), options_key)
+
+        tmpl = self._templates.get(key)
+        if tmpl is not None:
+            self.hits += 1
+            self._templates.move_to_end(key)
+            return tmpl
+
+        self.misses += 1
+        env = self._environments.get(options_key)
+        if env is None:
+            env = Environment(**dict(zip(ENVIRONMENT_OPTIONS, options_key)), extensions=[jinja2.ext.loopcontrols])
+            self._environments[options_key] = env
+        tmpl = env.from_string(template)
+        if self.max_size > 0:
+            self._templates[key] = tmpl
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+        return tmpl
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._templates), 'max_size': self.max_size}
+
+
+def render(data: dict, cache: TemplateCache, timing=None) -> str:
+    '''
+      Renders a request. If a timing dict is given, it is filled with import_ns, compile_ns, render_ns,
+      output_size and cache_hit.
+    '''
+    misses = cache.misses
+    start = time.perf_counter_ns()
+    tmpl = cache.get(data['template'], data['options'])
+    compiled = time.perf_counter_ns()
+    output = tmpl.render(data['bindings'])
+    end = time.perf_counter_ns()
+    if timing is not None:
+        timing.update({
+            'import_ns': IMPORT_NS,
+            'compile_ns': compiled - start,
+            'render_ns': end - compiled,
+            'output_size': len(output.encode('utf-8')),
+            'cache_hit': cache.misses == misses,
+        })
+    return output
+
+
+def respond(line: str, cache: TemplateCache, timing: bool = False) -> dict:
+    try:
+        data = json.loads(line)
+        timing_record = {} if timing or data.get('timing') else None
+        response = {'output': render(data, cache, timing_record)}
+        if timing_record is not None:
+            response['timing'] = timing_record
+        return response
+    except Exception as e:
+        return {'error': f'{type(e).__name__}: {e}'}
+
+
+def serve(fin, fout, cache: TemplateCache, timing: bool = False):
+    for line in fin:
+        if not line.strip():
+            continue
+        fout.write(json.dumps(respond(line, cache, timing)) + '\n')
+        fout.flush()
+
+
+_worker_cache = None
+_worker_timing = False
+
+
+def _init_worker(cache_size: int, timing: bool):
+    global _worker_cache, _worker_timing
+    _worker_cache = TemplateCache(cache_size)
+    _worker_timing = timing
+
+
+def _respond_in_worker(line: str) -> str:
+    return json.dumps(respond(line, _worker_cache, _worker_timing))
+
+
+def render_batch(input_file: str, output_file: str, cache_size: int, jobs=None, chunksize: int = 16, timing: bool = False):
+    with open(input_file, encoding='utf-8') as f:
+        lines = [line for line in f if line.strip()]
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(cache_size, timing)) as executor, \
+            open(output_file, 'w', encoding='utf-8', newline='\n') as out:
+        for response in executor.map(_respond_in_worker, lines, chunksize=chunksize):
+            out.write(response + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render Jinja2 templates with the reference Python implementation.")
+    parser.add_argument("input_file", nargs="?", default="-", help="JSON file with the template, bindings and options (default: stdin)")
+    parser.add_argument("output_file", nargs="?", default="-", help="File to write the rendered output to (default: stdout)")
+    parser.add_argument("--server", action="store_true", help="Serve newline-delimited JSON requests from stdin")
+    parser.add_argument("--batch", action="store_true", help="Render a JSONL file of requests into a JSONL file of results")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of worker processes in --batch mode (defaults to the CPU count)")
+    parser.add_argument("--cache-size", type=int, default=128, help="Max number of compiled templates to keep (0 to disable)")
+    parser.add_argument("--timing", action="store_true", help="Report import / compile / render durations for every request")
+    args = parser.parse_args()
+
+    if args.batch:
+        if args.input_file == '-' or args.output_file == '-':
+            parser.error("--batch requires input_file and output_file")
+        render_batch(args.input_file, args.output_file, args.cache_size, args.jobs, timing=args.timing)
+        return
+
+    cache = TemplateCache(args.cache_size)
+    sys.stdin.reconfigure(encoding='utf-8')
+    sys.stdout.reconfigure(encoding='utf-8', newline='\n')
+
+    if args.server:
+        serve(sys.stdin, sys.stdout, cache, args.timing)
+        if args.timing:
+            print(f'Template cache: {json.dumps(cache.stats())}', file=sys.stderr)
+        return
+
+    data = json.loads(sys.stdin.read() if args.input_file == '-' else Path(args.input_file).read_text())
+    # print(json.dumps(data, indent=2), file=sys.stderr)
+    timing = {} if args.timing or data.get('timing') else None
+    output = render(data, cache, timing)
+    if timing is not None:
+        print(json.dumps(timing), file=sys.stderr)
+    if args.output_file == '-':
+        sys.stdout.write(output)
+    else:
+        Path(args.output_file).write_text(output)
+
 
-env = Environment(**data['options'], extensions=[jinja2.ext.loopcontrols])
-tmpl = env.from_string(data['template'])
-output = tmpl.render(data['bindings'])
-Path(output_file).write_text(output)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+/*
+    Copyright 2024 Google LLC
+
+    Use of this source code is governed by an MIT-style
+    license that can be found in the LICENSE file or at
+    https://opensource.org/licenses/MIT.
+*/
+// SPDX-License-Identifier: MIT
+//
+// Measures minja::chat_template::apply throughput for one template on a set of contexts.
+// Prints one JSON object per context on stdout. Driven by scripts/bench_chat_templates.py.
+#include "minja/chat-template.hpp"
+
+#include <algorithm>
+#include <chrono>
+#include <ctime>
+#include <fstream>
+#include <iomanip>
+#include <iostream>
+#include <sstream>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+#include <sys/resource.h>
+
+#define TEST_DATE (getenv("TEST_DATE") ? getenv("TEST_DATE") : "2024-07-26")
+
+using json = nlohmann::ordered_json;
+using clock_type = std::chrono::steady_clock;
+
+static std::string read_file(const std::string &path) {
+    std::ifstream fs(path, std::ios_base::binary);
+    if (!fs.is_open()) {
+        throw std::runtime_error("Failed to open file: " + path);
+    }
+    fs.seekg(0, std::ios_base::end);
+    auto size = fs.tellg();
+    fs.seekg(0);
+    std::string out;
+    out.resize(static_cast<size_t>(size));
+    fs.read(&out[0], static_cast<std::streamsize>(size));
+    return out;
+}
+
+static int64_t peak_rss_kb() {
+    struct rusage usage {};
+    getrusage(RUSAGE_SELF, &usage);
+#ifdef __APPLE__
+    return usage.ru_maxrss / 1024;
+#else
+    return usage.ru_maxrss;
+#endif
+}
+
+static double percentile_us(const std::vector<double> & sorted_us, double p) {
+    if (sorted_us.empty()) return 0;
+    auto i = static_cast<size_t>(p * (sorted_us.size() - 1) + 0.5);
+    return sorted_us[std::min(i, sorted_us.size() - 1)];
+}
+
+int main(int argc, char *argv[]) {
+    if (argc < 4) {
+        std::cerr << "Usage: " << argv[0] << " <iterations> <template_file.jinja> <context_file.json> [<context_file.json>...]\n";
+        return 1;
+    }
+    try {
+        auto iterations = std::stoi(argv[1]);
+        std::string tmpl_file = argv[2];
+        auto tmpl_str = read_file(tmpl_file);
+
+        std::istringstream ss(TEST_DATE);
+        std::tm tm = {};
+        ss >> std::get_time(&tm, "%Y-%m-%d");
+        auto now = std::chrono::system_clock::from_time_t(std::mktime(&tm));
+
+        for (int i = 3; i < argc; i++) {
+            std::string ctx_file = argv[i];
+            auto ctx = json::parse(read_file(ctx_file));
+
+            auto load_start = clock_type::now();
+            minja::chat_template tmpl(tmpl_str, ctx.at("bos_token"), ctx.at("eos_token"));
+            // Caps are probed lazily: count them in the load time, not in the first render.
+            tmpl.original_caps();
+            auto load_end = clock_type::now();
+
+            minja::chat_template_inputs inputs;
+            inputs.messages = ctx.at("messages");
+            ctx.erase("messages");
+            if (ctx.contains("tools")) {
+                inputs.tools = ctx.at("tools");
+                ctx.erase("tools");
+            }
+            inputs.add_generation_prompt = ctx.at("add_generation_prompt");
+            ctx.erase("add_generation_prompt");
+            inputs.now = now;
+            inputs.extra_context = ctx;
+
+            std::vector<double> durations_us;
+            durations_us.reserve(iterations);
+            size_t output_size = 0;
+            auto total_start = clock_type::now();
+            for (int it = 0; it < iterations; it++) {
+                auto start = clock_type::now();
+                output_size = tmpl.apply(inputs).size();
+                durations_us.push_back(std::chrono::duration<double, std::micro>(clock_type::now() - start).count());
+            }
+            auto total_s = std::chrono::duration<double>(clock_type::now() - total_start).count();
+            std::sort(durations_us.begin(), durations_us.end());
+
+            std::cout << json {
+                {"engine", "minja"},
+                {"template", tmpl_file},
+                {"context", ctx_file},
+                {"iterations", iterations},
+                {"load_ms", std::chrono::duration<double, std::milli>(load_end - load_start).count()},
+                {"renders_per_sec", total_s > 0 ? iterations / total_s : 0},
+                {"p50_us", percentile_us(durations_us, 0.50)},
+                {"p99_us", percentile_us(durations_us, 0.99)},
+                {"output_size", output_size},
+                {"peak_rss_kb", peak_rss_kb()},
+            }.dump() << std::endl;
+        }
+        return 0;
+    } catch (const std::exception &e) {
+        std::cerr << "Benchmark failed: " << e.what() << "\n";
+        return 1;
+    }
+}
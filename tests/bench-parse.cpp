@@ -0,0 +1,94 @@
+/*
+    Copyright 2024 Google LLC
+
+    Use of this source code is governed by an MIT-style
+    license that can be found in the LICENSE file or at
+    https://opensource.org/licenses/MIT.
+*/
+// SPDX-License-Identifier: MIT
+//
+// Measures minja::Parser::parse time over a set of templates (e.g. the fetched corpus in build/tests/*.jinja),
+// vs. loading the same templates from their minja::TemplateSerializer blobs.
+// Prints a CSV line per template, and a total line.
+#include "minja/minja.hpp"
+
+#include <algorithm>
+#include <chrono>
+#include <fstream>
+#include <functional>
+#include <iostream>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+using clock_type = std::chrono::steady_clock;
+
+static std::string read_file(const std::string &path) {
+    std::ifstream fs(path, std::ios_base::binary);
+    if (!fs.is_open()) {
+        throw std::runtime_error("Failed to open file: " + path);
+    }
+    fs.seekg(0, std::ios_base::end);
+    auto size = fs.tellg();
+    fs.seekg(0);
+    std::string out;
+    out.resize(static_cast<size_t>(size));
+    fs.read(&out[0], static_cast<std::streamsize>(size));
+    return out;
+}
+
+int main(int argc, char *argv[]) {
+    if (argc < 3) {
+        std::cerr << "Usage: " << argv[0] << " <iterations> <template_file.jinja> [<template_file.jinja>...]\n";
+        return 1;
+    }
+    auto iterations = std::max(1, std::stoi(argv[1]));
+    minja::Options options {
+        /* .trim_blocks = */ true,
+        /* .lstrip_blocks = */ true,
+        /* .keep_trailing_newline = */ false,
+    };
+
+    auto time_us = [&](const std::function<void()> & fn) {
+        std::vector<double> durations_us;
+        durations_us.reserve(iterations);
+        for (int it = 0; it < iterations; it++) {
+            auto start = clock_type::now();
+            fn();
+            durations_us.push_back(std::chrono::duration<double, std::micro>(clock_type::now() - start).count());
+        }
+        std::sort(durations_us.begin(), durations_us.end());
+        return durations_us;
+    };
+
+    std::cout << "template,size_bytes,iterations,parse_us_min,parse_us_p50,blob_bytes,load_us_min,load_us_p50\n";
+    double total_p50_us = 0;
+    double total_load_p50_us = 0;
+    size_t total_size = 0;
+    size_t total_blob_size = 0;
+    for (int i = 2; i < argc; i++) {
+        std::string tmpl_file = argv[i];
+        auto tmpl_str = read_file(tmpl_file);
+        std::vector<double> durations_us;
+        std::string blob;
+        std::vector<double> load_durations_us;
+        try {
+            durations_us = time_us([&]() { minja::Parser::parse(tmpl_str, options); });
+            blob = minja::TemplateSerializer::save(*minja::Parser::parse(tmpl_str, options));
+            load_durations_us = time_us([&]() { minja::TemplateSerializer::load(blob); });
+        } catch (const std::exception & e) {
+            std::cerr << "Skipping " << tmpl_file << ": " << e.what() << "\n";
+            continue;
+        }
+        auto p50 = durations_us[durations_us.size() / 2];
+        auto load_p50 = load_durations_us[load_durations_us.size() / 2];
+        total_p50_us += p50;
+        total_load_p50_us += load_p50;
+        total_size += tmpl_str.size();
+        total_blob_size += blob.size();
+        std::cout << tmpl_file << "," << tmpl_str.size() << "," << iterations << "," << durations_us.front() << "," << p50
+                  << "," << blob.size() << "," << load_durations_us.front() << "," << load_p50 << "\n";
+    }
+    std::cout << "TOTAL," << total_size << "," << iterations << ",," << total_p50_us << "," << total_blob_size << ",," << total_load_p50_us << "\n";
+    return 0;
+}
@@ -0,0 +1,134 @@
+/*
+    Copyright 2024 Google LLC
+
+    Use of this source code is governed by an MIT-style
+    license that can be found in the LICENSE file or at
+    https://opensource.org/licenses/MIT.
+*/
+// SPDX-License-Identifier: MIT
+//
+// Micro-benchmarks of minja::Value on JSON documents (e.g. the test contexts in tests/contexts/*.json):
+// building from JSON, copying / comparing / to_str() of every leaf, and dump().
+// Also reports the heap usage of the built Value (bytes & allocations, counted by a replaced global operator new).
+// Prints a CSV line per document.
+#include "minja/minja.hpp"
+
+#include <algorithm>
+#include <chrono>
+#include <cstdlib>
+#include <fstream>
+#include <functional>
+#include <iostream>
+#include <new>
+#include <stdexcept>
+#include <string>
+#include <vector>
+
+using json = nlohmann::ordered_json;
+using clock_type = std::chrono::steady_clock;
+
+static bool counting = false;
+static size_t allocated_bytes = 0;
+static size_t allocations = 0;
+
+// GCC can't tell these malloc / free calls are the (replaced) global allocation functions themselves.
+#if defined(__GNUC__) && !defined(__clang__)
+#pragma GCC diagnostic push
+#pragma GCC diagnostic ignored "-Wmismatched-new-delete"
+#endif
+void * operator new(size_t size) {
+    if (counting) {
+        allocated_bytes += size;
+        allocations++;
+    }
+    if (auto ptr = std::malloc(size ? size : 1)) return ptr;
+    throw std::bad_alloc();
+}
+void operator delete(void * ptr) noexcept { std::free(ptr); }
+void operator delete(void * ptr, size_t) noexcept { std::free(ptr); }
+#if defined(__GNUC__) && !defined(__clang__)
+#pragma GCC diagnostic pop
+#endif
+
+static std::string read_file(const std::string &path) {
+    std::ifstream fs(path, std::ios_base::binary);
+    if (!fs.is_open()) {
+        throw std::runtime_error("Failed to open file: " + path);
+    }
+    fs.seekg(0, std::ios_base::end);
+    auto size = fs.tellg();
+    fs.seekg(0);
+    std::string out;
+    out.resize(static_cast<size_t>(size));
+    fs.read(&out[0], static_cast<std::streamsize>(size));
+    return out;
+}
+
+static void collect_leaves(const minja::Value & value, std::vector<const minja::Value *> & leaves) {
+    if (value.is_array()) {
+        value.for_each([&](minja::Value & item) { collect_leaves(item, leaves); });
+    } else if (value.is_object()) {
+        value.for_each([&](minja::Value & key) { collect_leaves(value.at(key), leaves); });
+    } else {
+        leaves.push_back(&value);
+    }
+}
+
+int main(int argc, char *argv[]) {
+    if (argc < 3) {
+        std::cerr << "Usage: " << argv[0] << " <iterations> <file.json> [<file.json>...]\n";
+        return 1;
+    }
+    auto iterations = std::max(1, std::stoi(argv[1]));
+
+    auto p50_us = [&](const std::function<void()> & fn) {
+        std::vector<double> durations_us;
+        durations_us.reserve(iterations);
+        for (int it = 0; it < iterations; it++) {
+            auto start = clock_type::now();
+            fn();
+            durations_us.push_back(std::chrono::duration<double, std::micro>(clock_type::now() - start).count());
+        }
+        std::sort(durations_us.begin(), durations_us.end());
+        return durations_us[durations_us.size() / 2];
+    };
+
+    std::cout << "file,sizeof_value,leaves,heap_bytes,heap_allocs,from_json_us,copy_us,compare_us,to_str_us,dump_us\n";
+    for (int i = 2; i < argc; i++) {
+        std::string file = argv[i];
+        auto doc = json::parse(read_file(file));
+
+        allocated_bytes = allocations = 0;
+        counting = true;
+        minja::Value value(doc);
+        counting = false;
+        auto heap_bytes = allocated_bytes;
+        auto heap_allocs = allocations;
+
+        minja::Value other(doc);
+        std::vector<const minja::Value *> leaves, other_leaves;
+        collect_leaves(value, leaves);
+        collect_leaves(other, other_leaves);
+
+        size_t sink = 0;
+        auto from_json_us = p50_us([&]() { sink += minja::Value(doc).size(); });
+        auto copy_us = p50_us([&]() {
+            std::vector<minja::Value> copies;
+            copies.reserve(leaves.size());
+            for (const auto * leaf : leaves) copies.push_back(*leaf);
+            sink += copies.size();
+        });
+        auto compare_us = p50_us([&]() {
+            for (size_t j = 0; j < leaves.size(); j++) sink += *leaves[j] == *other_leaves[j];
+        });
+        auto to_str_us = p50_us([&]() {
+            for (const auto * leaf : leaves) sink += leaf->to_str().size();
+        });
+        auto dump_us = p50_us([&]() { sink += value.dump(-1, /* to_json= */ true).size(); });
+        if (sink == 0) std::cerr << "(nothing measured)\n";
+
+        std::cout << file << "," << sizeof(minja::Value) << "," << leaves.size() << "," << heap_bytes << "," << heap_allocs
+                  << "," << from_json_us << "," << copy_us << "," << compare_us << "," << to_str_us << "," << dump_us << "\n";
+    }
+    return 0;
+}
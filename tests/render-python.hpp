@@ -0,0 +1,160 @@
+/*
+    Copyright 2024 Google LLC
+
+    Use of this source code is governed by an MIT-style
+    license that can be found in the LICENSE file or at
+    https://opensource.org/licenses/MIT.
+*/
+// SPDX-License-Identifier: MIT
+#pragma once
+
+// Renders templates w/ the official Python jinja2 library (see scripts/render.py), to compare against minja.
+//
+// A single `python -m scripts.render --server` child process is kept alive for the whole test suite and
+// fed newline-delimited JSON requests through pipes, so we only pay for the interpreter startup & jinja2
+// import once, and never touch the filesystem (test shards can run concurrently in the same directory).
+
+#include <nlohmann/json.hpp>
+
+#include <cstdio>
+#include <cstdlib>
+#include <stdexcept>
+#include <string>
+
+#ifdef _WIN32
+#ifndef NOMINMAX
+#define NOMINMAX
+#endif
+#ifndef WIN32_LEAN_AND_MEAN
+#define WIN32_LEAN_AND_MEAN
+#endif
+#include <fcntl.h>
+#include <io.h>
+#include <windows.h>
+#else
+#include <csignal>
+#include <sys/wait.h>
+#include <unistd.h>
+#endif
+
+static std::string python_executable() {
+    auto pyExeEnv = getenv("PYTHON_EXECUTABLE");
+    return pyExeEnv ? pyExeEnv : "python3";
+}
+
+class jinja2_render_server {
+#ifdef _WIN32
+    HANDLE process_ = nullptr;
+#else
+    pid_t pid_ = -1;
+#endif
+    FILE * to_child_ = nullptr;
+    FILE * from_child_ = nullptr;
+
+  public:
+    jinja2_render_server(const std::string & python_exe) {
+#ifdef _WIN32
+        SECURITY_ATTRIBUTES sa {};
+        sa.nLength = sizeof(sa);
+        sa.bInheritHandle = TRUE;
+        HANDLE child_in_read, child_in_write, child_out_read, child_out_write;
+        if (!CreatePipe(&child_in_read, &child_in_write, &sa, 0) || !CreatePipe(&child_out_read, &child_out_write, &sa, 0)) {
+            throw std::runtime_error("Failed to create pipes for the jinja2 render server");
+        }
+        // Only the child's ends of the pipes should be inherited.
+        SetHandleInformation(child_in_write, HANDLE_FLAG_INHERIT, 0);
+        SetHandleInformation(child_out_read, HANDLE_FLAG_INHERIT, 0);
+
+        STARTUPINFOA si {};
+        si.cb = sizeof(si);
+        si.dwFlags = STARTF_USESTDHANDLES;
+        si.hStdInput = child_in_read;
+        si.hStdOutput = child_out_write;
+        si.hStdError = GetStdHandle(STD_ERROR_HANDLE);
+        PROCESS_INFORMATION pi {};
+        std::string cmd = "\"" + python_exe + "\" -m scripts.render --server";
+        if (!CreateProcessA(nullptr, &cmd[0], nullptr, nullptr, TRUE, 0, nullptr, nullptr, &si, &pi)) {
+            throw std::runtime_error("Failed to start the jinja2 render server: " + cmd);
+        }
+        CloseHandle(pi.hThread);
+        CloseHandle(child_in_read);
+        CloseHandle(child_out_write);
+        process_ = pi.hProcess;
+        to_child_ = _fdopen(_open_osfhandle((intptr_t) child_in_write, _O_WRONLY | _O_BINARY), "wb");
+        from_child_ = _fdopen(_open_osfhandle((intptr_t) child_out_read, _O_RDONLY | _O_BINARY), "rb");
+#else
+        int requests[2], responses[2];
+        if (pipe(requests) != 0 || pipe(responses) != 0) {
+            throw std::runtime_error("Failed to create pipes for the jinja2 render server");
+        }
+        pid_ = fork();
+        if (pid_ < 0) {
+            throw std::runtime_error("Failed to fork the jinja2 render server");
+        }
+        if (pid_ == 0) {
+            dup2(requests[0], STDIN_FILENO);
+            dup2(responses[1], STDOUT_FILENO);
+            close(requests[0]);
+            close(requests[1]);
+            close(responses[0]);
+            close(responses[1]);
+            execlp(python_exe.c_str(), python_exe.c_str(), "-m", "scripts.render", "--server", (char *) nullptr);
+            _exit(127);
+        }
+        close(requests[0]);
+        close(responses[1]);
+        // Don't get killed if the server dies: we'll get an error writing / reading instead.
+        signal(SIGPIPE, SIG_IGN);
+        to_child_ = fdopen(requests[1], "w");
+        from_child_ = fdopen(responses[0], "r");
+#endif
+        if (!to_child_ || !from_child_) {
+            throw std::runtime_error("Failed to open pipes to the jinja2 render server");
+        }
+    }
+    jinja2_render_server(const jinja2_render_server &) = delete;
+    jinja2_render_server & operator=(const jinja2_render_server &) = delete;
+
+    ~jinja2_render_server() {
+        // Closing the server's stdin makes it exit.
+        if (to_child_) fclose(to_child_);
+        if (from_child_) fclose(from_child_);
+#ifdef _WIN32
+        if (process_) {
+            WaitForSingleObject(process_, INFINITE);
+            CloseHandle(process_);
+        }
+#else
+        if (pid_ > 0) waitpid(pid_, nullptr, 0);
+#endif
+    }
+
+    nlohmann::ordered_json request(const nlohmann::ordered_json & data) {
+        auto line = data.dump() + "\n";
+        if (fwrite(line.data(), 1, line.size(), to_child_) != line.size() || fflush(to_child_) != 0) {
+            throw std::runtime_error("Failed to send request to the jinja2 render server");
+        }
+        std::string response;
+        char buf[4096];
+        while (response.empty() || response.back() != '\n') {
+            if (!fgets(buf, sizeof(buf), from_child_)) {
+                throw std::runtime_error("jinja2 render server exited unexpectedly");
+            }
+            response += buf;
+        }
+        return nlohmann::ordered_json::parse(response);
+    }
+};
+
+// If timing is non-null, it receives the reference renderer's timing record (import_ns, compile_ns, render_ns, output_size, cache_hit).
+static std::string render_with_jinja2(const nlohmann::ordered_json & data, nlohmann::ordered_json * timing = nullptr) {
+    static jinja2_render_server server(python_executable());
+    auto request = data;
+    if (timing) request["timing"] = true;
+    auto response = server.request(request);
+    if (response.contains("error")) {
+        throw std::runtime_error("Failed to render with jinja2 (" + response.at("error").get<std::string>() + ") with data: " + data.dump(2));
+    }
+    if (timing) *timing = response.at("timing");
+    return response.at("output");
+}
@@ -8,6 +8,7 @@
 */
 // SPDX-License-Identifier: MIT
 #include "minja/chat-template.hpp"
+#include "render-python.hpp"
 #include "gtest/gtest.h"
 #include <gtest/gtest.h>
 #include <gmock/gmock-matchers.h>
@@ -33,24 +34,7 @@ static std::string render_python(const std::string & template_str, const chat_te
             {"keep_trailing_newline", false},
         }},
     };
-    {
-        std::ofstream of("data.json");
-        of << data.dump(2);
-        of.close();
-    }
-
-    auto pyExeEnv = getenv("PYTHON_EXECUTABLE");
-    std::string pyExe = pyExeEnv ? pyExeEnv : "python3";
-
-    std::remove("out.txt");
-    auto res = std::system((pyExe + " -m scripts.render data.json out.txt").c_str());
-    if (res != 0) {
-        throw std::runtime_error("Failed to run python script with data: " + data.dump(2));
-    }
-
-    std::ifstream f("out.txt");
-    std::string out((std::istreambuf_iterator<char>(f)), std::istreambuf_iterator<char>());
-    return out;
+    return render_with_jinja2(data);
 }
 
 static std::string render(const std::string & template_str, const chat_template_inputs & inputs, const chat_template_options & opts) {
@@ -67,3 +51,201 @@ static std::string render(const std::string & template_str, const chat_template_
 TEST(ChatTemplateTest, SimpleCases) {
     EXPECT_THAT(render("{{ strftime_now('%Y-%m-%d %H:%M:%S') }}", {}, {}), MatchesRegex(R"([0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2})"));
 }
+
+TEST(ChatTemplateTest, StreamingApply) {
+    chat_template tmpl("{% for message in messages %}<{{ message.role }}>{{ message.content }}{% endfor %}", "", "");
+    chat_template_inputs inputs;
+    inputs.messages = json::array({
+        {{"role", "user"}, {"content", std::string(5000, 'q')}},
+        {{"role", "assistant"}, {"content", "a"}},
+    });
+    std::string streamed;
+    size_t chunks = 0;
+    tmpl.apply(inputs, [&](std::string_view chunk) { streamed += chunk; chunks++; });
+    EXPECT_EQ(tmpl.apply(inputs), streamed);
+    EXPECT_EQ(3u, chunks);
+}
+
+TEST(ChatTemplateTest, ExportedCaps) {
+    // No tools support: the tools polyfill uses the tool call example, which is exported along w/ the caps.
+    const std::string source =
+        "{% for message in messages %}<{{ message.role }}>{{ message.content }}"
+        "{% for tool_call in message.tool_calls or [] %}[{{ tool_call.function.name }}({{ tool_call.function.arguments }})]{% endfor %}{% endfor %}"
+        "{% if add_generation_prompt %}<assistant>{% endif %}";
+    chat_template probed(source, "", "</s>");
+    auto exported = probed.export_caps();
+    EXPECT_EQ(probed.caps_key(), exported["key"]);
+    EXPECT_TRUE(exported["caps"]["supports_tool_calls"]);
+    EXPECT_FALSE(exported["caps"]["supports_tools"]);
+    EXPECT_NE("", exported["tool_call_example"]);
+
+    chat_template_inputs inputs;
+    inputs.messages = json::array({{{"role", "user"}, {"content", "Hi"}}});
+    inputs.tools = json::parse(R"([{"type": "function", "function": {"name": "f", "parameters": {}}}])");
+
+    chat_template imported(source, "", "</s>");
+    EXPECT_TRUE(imported.import_caps(exported));
+    EXPECT_EQ(exported, imported.export_caps());
+    EXPECT_EQ(probed.apply(inputs), imported.apply(inputs));
+    // Already imported (or probed).
+    EXPECT_FALSE(imported.import_caps(exported));
+    EXPECT_FALSE(probed.import_caps(exported));
+
+    // Exported by other templates (or w/ other special tokens), or malformed.
+    EXPECT_FALSE(chat_template(source + " ", "", "</s>").import_caps(exported));
+    EXPECT_FALSE(chat_template(source, "", "<eos>").import_caps(exported));
+    auto malformed = exported;
+    malformed["caps"].erase("supports_tools");
+    EXPECT_FALSE(chat_template(source, "", "</s>").import_caps(malformed));
+}
+
+TEST(ChatTemplateTest, CachedPolyfills) {
+    // Supports neither tools, tool calls nor tool responses: all their polyfills apply (and get cached).
+    chat_template tmpl("{% for message in messages %}<{{ message.role }}>{{ message.content }}{% endfor %}", "", "");
+    auto tool_call = [](const std::string & arguments) {
+        return json {
+            {"role", "assistant"},
+            {"tool_calls", json::array({{{"id", "call_1"}, {"type", "function"}, {"function", {{"name", "f"}, {"arguments", arguments}}}}})},
+        };
+    };
+    chat_template_inputs inputs;
+    inputs.tools = json::parse(R"([{"type": "function", "function": {"name": "f", "parameters": {}}}])");
+    inputs.messages = json::array({
+        {{"role", "user"}, {"content", "Hi"}},
+        tool_call(R"({"x": 1})"),
+        {{"role", "tool"}, {"tool_call_id", "call_1"}, {"content", "1"}},
+    });
+    auto prompt = tmpl.apply(inputs);
+    EXPECT_THAT(prompt, testing::HasSubstr("\"x\": 1"));
+    EXPECT_THAT(prompt, testing::HasSubstr("\"tool_response\""));
+    EXPECT_EQ(prompt, tmpl.apply(inputs));
+
+    // Rewrites are only reused for identical messages & tools.
+    inputs.messages[1] = tool_call(R"({"x": 2})");
+    inputs.tools[0]["function"]["name"] = "g";
+    auto changed = tmpl.apply(inputs);
+    EXPECT_THAT(changed, testing::HasSubstr("\"x\": 2"));
+    EXPECT_THAT(changed, testing::HasSubstr("\"name\": \"g\""));
+    EXPECT_THAT(changed, testing::Not(testing::HasSubstr("\"x\": 1")));
+}
+
+TEST(ChatTemplateTest, ApplyBatch) {
+    // Exercises concurrent renders of the same template (run under -DMINJA_SANITIZER=thread to check for data races).
+    chat_template tmpl(
+        "{% for message in messages %}{{ loop.index }}<{{ message.role }}>{{ message.content | trim | upper }}{% endfor %}"
+        "{% if tools %}{{ tools | tojson }}{% endif %}{{ strftime_now('%Y') }}{% if add_generation_prompt %}<assistant>{% endif %}", "", "");
+    auto tools = json::parse(R"([{"type": "function", "function": {"name": "f", "parameters": {}}}])");
+    std::vector<chat_template_inputs> batch(200);
+    for (size_t i = 0; i < batch.size(); i++) {
+        auto & inputs = batch[i];
+        inputs.messages = json::array({{{"role", "system"}, {"content", " sys "}}});
+        for (size_t j = 0; j < i % 7; j++) {
+            inputs.messages.push_back({{"role", j % 2 ? "assistant" : "user"}, {"content", "message " + std::to_string(i) + "." + std::to_string(j)}});
+        }
+        if (i % 3 == 0) inputs.tools = tools;
+        inputs.add_generation_prompt = i % 2 == 0;
+    }
+
+    std::vector<std::string> expected;
+    for (const auto & inputs : batch) expected.push_back(tmpl.apply(inputs));
+    EXPECT_EQ(expected, tmpl.apply_batch(batch, {}, 8));
+    EXPECT_EQ(expected, tmpl.apply_batch(batch, {}, 1));
+    EXPECT_EQ(expected, tmpl.apply_batch(batch));
+
+    batch[5].messages = json::array({{{"role", "user"}}});
+    chat_template strict("{{ messages[0].content.strip() }}", "", "");
+    EXPECT_THROW(strict.apply_batch(batch, {}, 4), std::runtime_error);
+}
+
+TEST(ChatTemplateTest, IncrementalApply) {
+    chat_template_options windowed;
+    windowed.windowed_incremental = true;
+
+    auto check = [&](const std::string & source, bool renders_locally) {
+        chat_template tmpl(source, "", "");
+        EXPECT_EQ(renders_locally, tmpl.renders_locally()) << source;
+
+        chat_template_inputs inputs;
+        inputs.messages = json::array({{{"role", "system"}, {"content", "sys"}}});
+        chat_template_conversation conversation;
+        for (int turn = 1; turn <= 12; turn++) {
+            if (turn > 1) {
+                inputs.messages.push_back({{"role", "assistant"}, {"content", "answer " + std::to_string(turn - 1)}});
+            }
+            inputs.messages.push_back({{"role", "user"}, {"content", "question " + std::to_string(turn)}});
+            auto previous = conversation.prompt;
+            auto delta = tmpl.apply_incremental(inputs, conversation, windowed);
+            auto full = tmpl.apply(inputs);
+            EXPECT_EQ(full, conversation.prompt) << source;
+            EXPECT_EQ(full, previous.substr(0, delta.prefix_size) + delta.suffix) << source;
+            if (renders_locally) {
+                EXPECT_EQ(previous.size(), delta.prefix_size) << source;
+            }
+        }
+    };
+    check("{% for message in messages %}<{{ message.role }}>{{ message.content }}{% endfor %}"
+          "{% if add_generation_prompt %}<assistant>{% endif %}", true);
+    // Rewrites the previous turns.
+    check("{% for message in messages %}{% if loop.last %}<{{ message.role }}>{{ message.content }}{% else %}.{% endif %}{% endfor %}", false);
+    // Depends on the number of preceding messages.
+    check("{% for message in messages %}{{ loop.index }}:{{ message.content }}\n{% endfor %}", false);
+
+    // Changes of the other inputs are rendered in full, even for templates that render locally.
+    chat_template tmpl(
+        "{{ tools | tojson }}{{ strftime_now('%Y') }}{{ greeting }}{% for message in messages %}<{{ message.role }}>{{ message.content }}{% endfor %}", "", "");
+    EXPECT_TRUE(tmpl.renders_locally());
+    auto tool = [](const std::string & name) {
+        return json::array({{{"type", "function"}, {"function", {{"name", name}, {"parameters", json::object()}}}}});
+    };
+    chat_template_inputs inputs;
+    inputs.messages = json::array({{{"role", "user"}, {"content", "q1"}}});
+    inputs.tools = tool("a");
+    inputs.extra_context = {{"greeting", "hi"}};
+    inputs.now = std::chrono::system_clock::from_time_t(0);
+    chat_template_conversation conversation;
+    tmpl.apply_incremental(inputs, conversation, windowed);
+    auto next_turn = [&]() {
+        inputs.messages.push_back({{"role", "assistant"}, {"content", "a"}});
+        inputs.messages.push_back({{"role", "user"}, {"content", "q"}});
+        auto previous = conversation.prompt;
+        auto delta = tmpl.apply_incremental(inputs, conversation, windowed);
+        EXPECT_EQ(tmpl.apply(inputs), conversation.prompt);
+        return previous.size() - delta.prefix_size;
+    };
+    EXPECT_EQ(0u, next_turn());
+    inputs.tools = tool("b");
+    EXPECT_NE(0u, next_turn());
+    inputs.now = std::chrono::system_clock::from_time_t(400 * 24 * 3600);
+    EXPECT_NE(0u, next_turn());
+    inputs.extra_context = {{"greeting", "hello"}};
+    EXPECT_NE(0u, next_turn());
+    EXPECT_EQ(0u, next_turn());
+
+    // Depends on the length of the conversation, beyond that of the probe: only the default full renders stay exact.
+    chat_template long_history(
+        "{% if messages | length > 20 %}[LONG]{% endif %}{% for m in messages %}<{{ m.role }}>{{ m.content }}</s>{% endfor %}"
+        "{% if add_generation_prompt %}<assistant>{% endif %}", "", "");
+    EXPECT_TRUE(long_history.renders_locally());
+    for (const auto & opts : {chat_template_options(), windowed}) {
+        chat_template_inputs history;
+        history.messages = json::array({{{"role", "system"}, {"content", "sys"}}});
+        history.add_generation_prompt = true;
+        chat_template_conversation history_conversation;
+        size_t mismatches = 0;
+        for (int turn = 1; turn <= 30; turn++) {
+            if (turn > 1) {
+                history.messages.push_back({{"role", "assistant"}, {"content", "answer " + std::to_string(turn - 1)}});
+            }
+            history.messages.push_back({{"role", "user"}, {"content", "question " + std::to_string(turn)}});
+            auto previous = history_conversation.prompt;
+            auto delta = long_history.apply_incremental(history, history_conversation, opts);
+            auto full = long_history.apply(history);
+            if (!opts.windowed_incremental) {
+                EXPECT_EQ(full, history_conversation.prompt);
+                EXPECT_EQ(full, previous.substr(0, delta.prefix_size) + delta.suffix);
+            }
+            mismatches += full != history_conversation.prompt;
+        }
+        EXPECT_EQ(opts.windowed_incremental, mismatches > 0);
+    }
+}
@@ -7,11 +7,16 @@
 */
 // SPDX-License-Identifier: MIT
 #include "minja/minja.hpp"
+#include "render-python.hpp"
 #include <gtest/gtest.h>
 #include <gmock/gmock-matchers.h>
 
+#include <chrono>
 #include <fstream>
+#include <iostream>
 #include <string>
+#include <thread>
+#include <vector>
 
 static std::string render_python(const std::string & template_str, const json & bindings, const minja::Options & options) {
     json data {
@@ -23,23 +28,31 @@ static std::string render_python(const std::string & template_str, const json &
             {"keep_trailing_newline", options.keep_trailing_newline},
         }},
     };
-    {
-        std::ofstream of("data.json");
-        of << data.dump(2);
-        of.close();
+    if (!getenv("LOG_TIMINGS")) {
+        return render_with_jinja2(data);
     }
 
-    auto pyExeEnv = getenv("PYTHON_EXECUTABLE");
-    std::string pyExe = pyExeEnv ? pyExeEnv : "python3";
-
-    std::remove("out.txt");
-    auto res = std::system((pyExe + " -m scripts.render data.json out.txt").c_str());
-    if (res != 0) {
-        throw std::runtime_error("Failed to run python script with data: " + data.dump(2));
+    json timing;
+    auto out = render_with_jinja2(data, &timing);
+
+    // Side-by-side w/ minja (which may fail on cases only jinja2 supports).
+    using clock = std::chrono::steady_clock;
+    auto us = [](clock::duration d) { return std::chrono::duration_cast<std::chrono::microseconds>(d).count(); };
+    std::string minja_timing;
+    try {
+        auto t0 = clock::now();
+        auto root = minja::Parser::parse(template_str, options);
+        auto t1 = clock::now();
+        root->render(minja::Context::make(bindings));
+        auto t2 = clock::now();
+        minja_timing = "parse=" + std::to_string(us(t1 - t0)) + "us render=" + std::to_string(us(t2 - t1)) + "us";
+    } catch (const std::exception &) {
+        minja_timing = "(failed)";
     }
-
-    std::ifstream f("out.txt");
-    std::string out((std::istreambuf_iterator<char>(f)), std::istreambuf_iterator<char>());
+    auto excerpt = json(template_str.substr(0, 40)).dump(-1, ' ', false, json::error_handler_t::replace);
+    std::cerr << "[timing] jinja2 compile=" << timing.at("compile_ns").get<int64_t>() / 1000 << "us"
+              << " render=" << timing.at("render_ns").get<int64_t>() / 1000 << "us"
+              << " size=" << timing.at("output_size") << " | minja " << minja_timing << " | " << excerpt << "\n";
     return out;
 }
 
@@ -655,3 +668,356 @@ TEST(SyntaxTest, SimpleCases) {
     // expect_throws_with_message_substr([]() { render("{{ a.b }}", {}, {}); }, "'a' is not defined");
     // expect_throws_with_message_substr([]() { render("{{ raise_exception('hey') }}", {}, {}); }, "hey");
 }
+
+TEST(SyntaxTest, Tokenization) {
+    // Whitespace control vs. minus / modulo / concat operators
+    EXPECT_EQ("1x", render("{{ 1 -}} x", {}, {}));
+    EXPECT_EQ("2|3|12|3|ab", render("{{ 3 - 1 }}|{{ 7 % 4 }}|{{ 6 * 2 }}|{{ 7 // 2 }}|{{ 'a' ~ 'b' }}", {}, {}));
+    EXPECT_EQ("x", render("{%- if 1 -%} x {%- endif -%}", {}, {}));
+
+    // Keywords only match whole words
+    EXPECT_EQ("1 2 3 4", render("{{ island }} {{ not_x }} {{ in_ }} {{ nothing }}",
+        {{"island", 1}, {"not_x", 2}, {"in_", 3}, {"nothing", 4}}, {}));
+    EXPECT_EQ("True,False", render("{{ 1 not  in [2] }},{{ 1 not\nin [1] }}", {}, {}));
+    EXPECT_EQ("True", render("{{ none is none }}", {}, {}));
+
+    // Comments end at the first closing tag
+    EXPECT_EQ(" #} -#}x", render("{#- a #} #} -#}x", {}, {}));
+    EXPECT_EQ("{x}", render("{{ '{' }}x}", {}, {}));
+
+    // Variable names
+    EXPECT_EQ("12", render("{% for a ,b in [[1, 2]] %}{{ a }}{{ b }}{% endfor %}", {}, {}));
+    EXPECT_EQ("2", render("{% set ns = namespace(v=1) %}{% set ns . v = 2 %}{{ ns.v }}", {}, {}));
+}
+
+TEST(SyntaxTest, SharedBuiltins) {
+    auto ThrowsWithSubstr = [](const std::string & expected_substr) {
+        return testing::Throws<std::runtime_error>(Property(&std::runtime_error::what, testing::HasSubstr(expected_substr)));
+    };
+
+    EXPECT_EQ(minja::Context::shared_builtins(), minja::Context::shared_builtins());
+    EXPECT_THAT([]() { minja::Context::shared_builtins()->set("x", json(1)); }, ThrowsWithSubstr("immutable context"));
+
+    // Overrides are layered on top of the shared builtins, and don't leak into other contexts.
+    auto builtins = minja::Context::builtins();
+    builtins->set("range", json(1));
+    EXPECT_EQ(1, builtins->get("range").get<int>());
+    EXPECT_TRUE(minja::Context::shared_builtins()->get("range").is_callable());
+
+    EXPECT_EQ("1", render("{% set range = 1 %}{{ range }}", {}, {}));
+    EXPECT_EQ("[0, 1]", render("{{ range(2) | list }}", {}, {}));
+    if (!getenv("USE_JINJA2")) {
+        EXPECT_THAT([]() { render("{% set range.x = 1 %}", {}, {}); }, ThrowsWithSubstr("Namespace 'range' is not an object"));
+    }
+}
+
+TEST(SyntaxTest, TemplateCache) {
+    minja::TemplateCache cache(/* max_bytes= */ 20);
+    minja::Options trimming {true, true, false};
+
+    auto a = cache.get_or_parse("{{ a }}", {});
+    EXPECT_EQ(a, cache.get_or_parse("{{ a }}", {}));
+    EXPECT_NE(a, cache.get_or_parse("{{ a }}", trimming));
+    auto stats = cache.stats();
+    EXPECT_EQ(1u, stats.hits);
+    EXPECT_EQ(2u, stats.misses);
+    EXPECT_EQ(2u, stats.entries);
+    EXPECT_EQ(14u, stats.bytes);
+
+    // Least recently used entries are evicted once the cached sources exceed max_bytes.
+    cache.get_or_parse("{{ a }}", {});
+    cache.get_or_parse("{{ b }}", {});
+    EXPECT_EQ(2u, cache.stats().entries);
+    EXPECT_EQ(a, cache.get_or_parse("{{ a }}", {}));
+    cache.get_or_parse("{{ a }}", trimming);
+    EXPECT_EQ(4u, cache.stats().misses);
+
+    // Templates bigger than the bound are parsed but not cached.
+    auto big = cache.get_or_parse("{{ a }}{{ b }}{{ c }}{{ d }}", {});
+    EXPECT_EQ("1234", big->render(minja::Context::make(json({{"a", 1}, {"b", 2}, {"c", 3}, {"d", 4}}))));
+    EXPECT_NE(big, cache.get_or_parse("{{ a }}{{ b }}{{ c }}{{ d }}", {}));
+
+    cache.clear();
+    EXPECT_EQ(0u, cache.stats().entries);
+    EXPECT_NE(a, cache.get_or_parse("{{ a }}", {}));
+
+    // Concurrent lookups all get a usable root, and only one copy ends up cached.
+    minja::TemplateCache shared;
+    std::vector<std::thread> threads;
+    std::vector<std::string> outputs(8);
+    for (size_t i = 0; i < outputs.size(); i++) {
+        threads.emplace_back([&, i]() {
+            for (int j = 0; j < 100; j++) {
+                outputs[i] = shared.get_or_parse("{{ x }}", {})->render(minja::Context::make(json({{"x", i}})));
+            }
+        });
+    }
+    for (auto & thread : threads) thread.join();
+    for (size_t i = 0; i < outputs.size(); i++) {
+        EXPECT_EQ(std::to_string(i), outputs[i]);
+    }
+    EXPECT_EQ(1u, shared.stats().entries);
+    EXPECT_EQ(800u, shared.stats().hits + shared.stats().misses);
+}
+
+TEST(SyntaxTest, BinarySerialization) {
+    auto ThrowsWithSubstr = [](const std::string & expected_substr) {
+        return testing::Throws<std::runtime_error>(Property(&std::runtime_error::what, testing::HasSubstr(expected_substr)));
+    };
+
+    // Covers every node & expression type.
+    const std::vector<std::string> templates {
+        "Hello {{ name }}!",
+        "{% if x > 1 and not y %}a{% elif x in [1, 2] %}b{% else %}c{% endif %}",
+        "{{ 'yes' if x is defined else 'no' }} {{ -x + 2 * 3.5 - x // 2 }} {{ 'a' ~ name | upper }}",
+        "{% for k, v in d | dictsort if v != 2 %}{{ loop.index }}:{{ k }}={{ v }},{% else %}none{% endfor %}",
+        "{% for i in range(10) %}{% if i == 2 %}{% continue %}{% endif %}{% if i > 4 %}{% break %}{% endif %}{{ i }}{% endfor %}",
+        "{% macro greet(who, punct='!') %}Hi {{ who }}{{ punct }}{% endmacro %}{{ greet('a') }}{{ greet(who='b', punct='?') }}",
+        "{% macro wrap(who) %}<{{ who }}:{{ caller() }}>{% endmacro %}{% call wrap('c') %}body{% endcall %}",
+        "{% filter upper %}shout {{ name }}{% endfilter %}",
+        "{% set ns = namespace(n=0) %}{% for i in [1, 2] %}{% set ns.n = ns.n + i %}{% endfor %}{{ ns.n }}",
+        "{% set a, b = [1, 2] %}{{ b }}{{ a }}{% set c %}block {{ a }}{% endset %}{{ c }}",
+        "{{ d['a'] }}{{ d.b }}{{ name[1:3] }}{{ name[::-1] }}{{ [1, 2, 3][-1] }}{{ {'k': [None, true, false, -5, 'é']} | tojson }}",
+        "{{ name.upper() }}{{ name.split('o') | join(', ') }}{{ d.items() | list | length }}{{ range(*[1, 3]) | list }}",
+        "{%- generation -%} {{ x }} {%- endgeneration -%}",
+    };
+    json bindings {{"name", "world"}, {"x", 3}, {"y", false}, {"d", {{"a", 1}, {"b", 2}, {"c", 3}}}};
+
+    for (const auto & tmpl : templates) {
+        SCOPED_TRACE(tmpl);
+        auto root = minja::Parser::parse(tmpl, lstrip_trim_blocks);
+        auto blob = minja::TemplateSerializer::save(*root);
+        auto loaded = minja::TemplateSerializer::load(blob);
+        EXPECT_EQ(root->render(minja::Context::make(bindings)), loaded->render(minja::Context::make(bindings)));
+        EXPECT_EQ(blob, minja::TemplateSerializer::save(*loaded));
+        EXPECT_LT(minja::TemplateSerializer::save(*root, /* include_source= */ false).size(), blob.size());
+
+        // Corrupted blobs are rejected (and never crash).
+        for (size_t i = 0; i < blob.size(); i++) {
+            EXPECT_THROW(minja::TemplateSerializer::load(blob.substr(0, i)), std::runtime_error);
+        }
+    }
+
+    // Error locations survive the round trip if the source is saved.
+    auto failing = minja::Parser::parse("{{ 1 }}\n{{ x.y.z }}", {});
+    auto loaded = minja::TemplateSerializer::load(minja::TemplateSerializer::save(*failing));
+    EXPECT_THAT([&]() { loaded->render(minja::Context::make(json::object())); }, ThrowsWithSubstr("at row 2, column"));
+
+    EXPECT_THAT([]() { minja::TemplateSerializer::load("{{ x }}"); }, ThrowsWithSubstr("Not a minja template blob"));
+    auto blob = minja::TemplateSerializer::save(*minja::Parser::parse("{{ x }}", {}));
+    blob[4] = 99;
+    EXPECT_THAT([&]() { minja::TemplateSerializer::load(blob); }, ThrowsWithSubstr("Unsupported template blob version 99"));
+
+    // Locations must point into the saved source (and be 0 w/o it).
+    auto located = minja::TemplateSerializer::save(*minja::Parser::parse("{{ x }}", {}));
+    // The variable's location is followed by its name ("x").
+    ASSERT_EQ(2, located[located.size() - 3]);
+    located[located.size() - 3] = 0x7f;
+    EXPECT_THAT([&]() { minja::TemplateSerializer::load(located); }, ThrowsWithSubstr("Invalid location in template blob"));
+    auto unlocated = minja::TemplateSerializer::save(*minja::Parser::parse("{{ x }}", {}), /* include_source= */ false);
+    EXPECT_EQ(unlocated, minja::TemplateSerializer::save(*minja::TemplateSerializer::load(unlocated)));
+    unlocated[unlocated.size() - 3] = 1;
+    EXPECT_THAT([&]() { minja::TemplateSerializer::load(unlocated); }, ThrowsWithSubstr("Invalid location in template blob"));
+
+    // Values stored as JSON (e.g. unsigned integers beyond int64) are checked too.
+    auto big = minja::TemplateSerializer::save(*minja::Parser::parse("{% set x = 18446744073709551615 %}{{ x }}", {}), /* include_source= */ false);
+    auto digit = big.find("18446744073709551615");
+    ASSERT_NE(std::string::npos, digit);
+    big[digit] = 'x';
+    EXPECT_THAT([&]() { minja::TemplateSerializer::load(big); }, ThrowsWithSubstr("Malformed JSON value in template blob"));
+}
+
+TEST(SyntaxTest, VariableScopes) {
+    // Variables bound by for loops & macros are read from slots resolved at parse time.
+    EXPECT_EQ(
+        "131,142,1;231,242,2;",
+        render("{% for i in [1, 2] %}{% for j in [3, 4] %}{{ i }}{{ j }}{{ loop.index }},{% endfor %}{{ loop.index }};{% endfor %}", {}, {}));
+    EXPECT_EQ(
+        "[1][2]",
+        render("{% macro wrap() %}[{{ caller() }}]{% endmacro %}{% for i in [1, 2] %}{% call wrap() %}{{ i }}{% endcall %}{% endfor %}", {}, {}));
+    EXPECT_EQ(
+        "01|a2|",
+        render("{% macro f(a, b=x) %}{{ a }}{{ b }}{% endmacro %}{% set x = 1 %}{{ f(0) }}|{% for x in ['a'] %}{{ f(x, 2) }}{% endfor %}|", {}, {}));
+    EXPECT_EQ(
+        "[1, 2]y",
+        render("{% for x in [[1, 2]] %}{% macro g() %}{{ x }}{% endmacro %}{{ g() }}{% endfor %}{{ y }}", {{"y", "y"}}, {}));
+
+    if (!getenv("USE_JINJA2")) {
+        // Assignments in a loop body persist across iterations, and until then fall back to the outer variable.
+        EXPECT_EQ("012", render("{% set x = 0 %}{% for i in [1, 2, 3] %}{{ x }}{% set x = i %}{% endfor %}", {}, {}));
+        // Loop variables are also assigned in the enclosing context.
+        EXPECT_EQ("6", render("{% for a in [1] %}{% for b in [5, 6] if b > 5 %}{% endfor %}{{ b }}{% endfor %}", {}, {}));
+
+        // Scoped variables are visible through the Context API too.
+        auto root = minja::Parser::parse("{% for i in [1] %}{{ f() }}{% endfor %}", {});
+        auto context = minja::Context::make(json::object());
+        context->set("f", minja::Value::callable([](const std::shared_ptr<minja::Context> & ctx, minja::ArgumentsValue &) {
+            return minja::Value(std::to_string(ctx->get("i").get<int64_t>()) + (ctx->contains("loop") ? "+loop" : ""));
+        }));
+        EXPECT_EQ("1+loop", root->render(context));
+    }
+}
+
+TEST(SyntaxTest, ValueSemantics) {
+    // Short strings are stored inline and long ones shared, which must not be observable.
+    EXPECT_EQ(
+        "True|30|True",
+        render("{% set a = 'x' * 30 %}{% set b = 'x' * 10 %}{{ a == b * 3 }}|{{ a | length }}|{{ {'x': 1, a: 2}[b * 3] == 2 }}", {}, {}));
+    EXPECT_EQ(
+        "{'k': 'a\\tb', 'a key that does not fit inline': [1, 2.5, True, \"it's\"]}",
+        render("{{ {'k': 'a\\tb', 'a key that does not fit inline': [1, 2.5, true, \"it's\"]} }}", {}, {}));
+    EXPECT_EQ(
+        "True|a",
+        render("{{ 1 == 1.0 }}|{{ {1: 'a'}[1.0] }}", {}, {}));
+
+    // JSON round trip.
+    auto doc = json::parse(R"({"s": "short", "l": "a string that is longer than the inline buffer", "i": -3, "f": 0.5, "b": false, "n": null, "a": [1, "é\n"]})");
+    minja::Value value(doc);
+    EXPECT_EQ(doc, value.get<json>());
+    EXPECT_EQ(
+        R"({"s": "short", "l": "a string that is longer than the inline buffer", "i": -3, "f": 0.5, "b": false, "n": null, "a": [1, "é\n"]})",
+        value.dump(-1, /* to_json= */ true));
+    EXPECT_EQ("short", value.at("s").get<std::string>());
+    EXPECT_EQ(doc.at("l").get<std::string>(), value.at("l").to_str());
+    EXPECT_EQ(0.5f, value.at("f").get<float>());
+
+    // Unsigned integers beyond int64 stay exact.
+    auto big = json::parse(R"({"n": 18446744073709551615, "xs": [9223372036854775808]})");
+    EXPECT_EQ(big, minja::Value(big).get<json>());
+    EXPECT_TRUE(minja::Value(big.at("n")).is_number_integer());
+    auto big_tmpl = "{{ n }}|{{ n | tojson }}|{{ xs }}|{{ xs[0] | tojson }}|{{ xs | tojson }}|{{ n == 18446744073709551615 }}|{{ n is integer }}";
+    auto big_expected = "18446744073709551615|18446744073709551615|[9223372036854775808]|9223372036854775808|[9223372036854775808]|True|True";
+    EXPECT_EQ(big_expected, render(big_tmpl, big, {}));
+    EXPECT_EQ(big_expected, minja::Parser::parse(big_tmpl, {})->render(minja::Context::make(minja::Value::borrowed(big))));
+    EXPECT_EQ("18446744073709551615", minja::TemplateSerializer::load(minja::TemplateSerializer::save(*minja::Parser::parse("{% set x = 18446744073709551615 %}{{ x }}", {})))->render(minja::Context::make(json::object())));
+    EXPECT_TRUE(minja::Value(int64_t(1)) == minja::Value(1.0));
+    EXPECT_FALSE(minja::Value(true) == minja::Value(int64_t(1)));
+    EXPECT_THROW(value.at("s").get<int>(), json::type_error);
+}
+
+TEST(SyntaxTest, BorrowedValues) {
+    auto doc = json::parse(R"({
+        "messages": [{"role": "user", "content": "a message too long to be stored inline"}, {"role": "assistant", "content": "hi"}],
+        "tools": [{"name": "f", "parameters": {"a": 1.5, "b": [true, null]}}]
+    })");
+    auto original = doc;
+
+    // Borrowed values render the same as converted ones.
+    for (const auto & tmpl : {
+        "{% for m in messages %}{{ m.role }}: {{ m['content'] }}{{ loop.index }}{% endfor %}{{ messages | length }}",
+        "{{ tools | tojson }}{{ tools | tojson(indent=2) }}{{ tools }}{{ tools[0].parameters.b }}",
+        "{{ messages == messages }}{{ 'tools' in messages[0] }}{{ messages[0].content[:7] }}{{ tools | map(attribute='name') | list }}",
+    }) {
+        auto root = minja::Parser::parse(tmpl, {});
+        EXPECT_EQ(root->render(minja::Context::make(minja::Value(doc))), root->render(minja::Context::make(minja::Value::borrowed(doc)))) << tmpl;
+    }
+
+    // Updates are shared by all the references to a borrowed array / object, but don't touch the json.
+    auto root = minja::Parser::parse(
+        "{% set m = messages[1] %}{% set _ = m.pop('content') %}{% set _ = messages.append(1) %}{{ messages | tojson }}", {});
+    auto expected = R"([{"role": "user", "content": "a message too long to be stored inline"}, {"role": "assistant"}, 1])";
+    EXPECT_EQ(expected, root->render(minja::Context::make(minja::Value::borrowed(doc))));
+    EXPECT_EQ(expected, root->render(minja::Context::make(minja::Value::borrowed(doc))));
+    EXPECT_EQ(original, doc);
+}
+
+TEST(SyntaxTest, RenderSink) {
+    auto big = std::string(10000, 'x');
+    auto root = minja::Parser::parse("{% for i in range(3) %}{{ i }},{% endfor %}" + big + "{{ s }}|{% filter upper %}{{ s }}{% endfilter %}", {});
+    auto context = minja::Context::make(json {{"s", "abc"}});
+
+    std::vector<std::string> chunks;
+    root->render([&](std::string_view chunk) { chunks.emplace_back(chunk); }, context);
+    std::string streamed;
+    for (const auto & chunk : chunks) streamed += chunk;
+    EXPECT_EQ(root->render(context), streamed);
+    // Small writes are coalesced, large ones are passed through as is.
+    EXPECT_EQ((std::vector<std::string> {"0,1,2,", big, "abc|ABC"}), chunks);
+
+    // Errors from the sink are propagated.
+    EXPECT_THROW(root->render([](std::string_view) { throw std::runtime_error("sink closed"); }, context), std::runtime_error);
+}
+
+TEST(SyntaxTest, ErrorLocations) {
+    auto ThrowsWithSubstr = [](const std::string & expected_substr) {
+        return testing::Throws<std::runtime_error>(Property(&std::runtime_error::what, testing::HasSubstr(expected_substr)));
+    };
+    auto root = minja::Parser::parse("{% for x in [1] %}\n{% if x %}{{ x.y.z() }}{% endif %}\n{% endfor %}", {});
+    try {
+        root->render(minja::Context::make(json::object()));
+        FAIL() << "Expected an exception";
+    } catch (const minja::TemplateRuntimeError & e) {
+        std::string what = e.what();
+        EXPECT_EQ("Trying to call method 'z' on null", e.message());
+        EXPECT_EQ(what.find(" at row "), what.rfind(" at row "));
+        EXPECT_THAT(what, testing::HasSubstr("on null at row 2, column 18:\n"));
+        // Innermost first: the method call, the expression node, the if, the loop & the enclosing sequence.
+        EXPECT_GE(e.stack().size(), 4u);
+        EXPECT_EQ(e.stack().front().pos, 36u);
+    }
+    EXPECT_THAT([]() { minja::Parser::parse("a\n{% break %}", {})->render(minja::Context::make(json::object())); },
+                ThrowsWithSubstr("break outside of a loop at row 2, column 1"));
+}
+
+TEST(SyntaxTest, ConstantFolding) {
+    auto save = [](const std::string & tmpl) {
+        return minja::TemplateSerializer::save(*minja::Parser::parse(tmpl, {}), /* include_source= */ false);
+    };
+    auto context = minja::Context::make(json::object());
+
+    // Dead branches, literal expressions & the text around them are folded into a single text node.
+    auto folded = "{% if false %}{{ x }}{% elif 1 > 2 %}b{% else %}a{{ 'B' ~ (1 + 1) }}{% endif %}{{ None }}c";
+    EXPECT_EQ("aB2c", minja::Parser::parse(folded, {})->render(context));
+    EXPECT_EQ(save("aB2c").size(), save(folded).size());
+
+    // Arrays & dicts are still built on each render (they can be mutated).
+    auto root = minja::Parser::parse("{% set xs = [1] %}{{ xs.append(2) }}{{ xs | length }}{{ {'a': 1} }}", {});
+    EXPECT_EQ("2{'a': 1}", root->render(context));
+    EXPECT_EQ("2{'a': 1}", root->render(context));
+
+    // Filters & variables bound by the template aren't folded.
+    EXPECT_EQ("<x>", minja::Parser::parse("{% macro upper(s) %}<{{ s }}>{% endmacro %}{{ 'x' | upper }}", {})->render(context));
+    EXPECT_EQ("1", minja::Parser::parse("{% set x = 1 %}{{ x if true }}", {})->render(context));
+
+    // Folded filters still give way to context overrides, whether or not their operand is constant.
+    auto overridden = minja::Parser::parse("{{ 'a' | tojson }}{{ v | tojson }}{{ 'x' | upper | trim }}{{ ['a', 'b'] | join('-') }}", {});
+    EXPECT_EQ("\"a\"\"b\"Xa-b", overridden->render(minja::Context::make(json({{"v", "b"}}))));
+    auto overriding = minja::Context::make(json({{"v", "b"}}));
+    overriding->set("tojson", minja::Value::callable([](const std::shared_ptr<minja::Context> &, minja::ArgumentsValue &) {
+        return minja::Value("OVERRIDDEN");
+    }));
+    overriding->set("upper", minja::Value("not a filter"));
+    EXPECT_THROW(overridden->render(overriding), minja::TemplateRuntimeError);
+    overriding->set("upper", minja::Context::shared_builtins()->get("lower"));
+    EXPECT_EQ("OVERRIDDENOVERRIDDENxa-b", overridden->render(overriding));
+    EXPECT_EQ("OVERRIDDENOVERRIDDENxa-b", minja::TemplateSerializer::load(minja::TemplateSerializer::save(*overridden))->render(overriding));
+
+    // Failures are left to render time, w/ their location.
+    auto failing = minja::Parser::parse("{% if false %}{{ 1 // 0 }}{% endif %}{{ 'a' | int(1, 2, 3) }}", {});
+    EXPECT_THROW(failing->render(context), minja::TemplateRuntimeError);
+}
+
+TEST(SyntaxTest, LoopObject) {
+    EXPECT_EQ(
+        "-1-2|2True3;1-2-3|1False3;2-3-|0False3;",
+        render("{% for x in xs %}{{ loop.previtem }}-{{ x }}-{{ loop.nextitem }}|{{ loop.revindex0 }}{{ loop.first }}{{ loop.length }};{% endfor %}", {{"xs", {1, 2, 3}}}, {}));
+    EXPECT_EQ(
+        "[1[2[3]]][4]",
+        render("{% for x in xs recursive %}[{{ x.n }}{% if x.c %}{{ loop(x.c) }}{% endif %}]{% endfor %}",
+               json::parse(R"({"xs": [{"n": 1, "c": [{"n": 2, "c": [{"n": 3}]}]}, {"n": 4}]})"), {}));
+    // Lists are iterated in place: shrinking them ends the loop early.
+    EXPECT_EQ("32", render("{% for x in xs %}{{ xs.pop() }}{% endfor %}", {{"xs", {1, 2, 3}}}, {}));
+    EXPECT_EQ(
+        "1:False 2:True ",
+        render("{% for x in xs %}{{ x }}:{{ loop.last }} {% if x == 1 %}{% set _ = xs.pop() %}{% endif %}{% endfor %}", {{"xs", {1, 2, 3}}}, {}));
+
+    if (!getenv("USE_JINJA2")) {
+        // The loop object is a plain dict, whose per-iteration attributes survive changes to its other keys.
+        EXPECT_EQ(
+            "1False12False13True1",
+            render("{% for x in [1, 2, 3] %}{% set loop.foo = 1 %}{{ loop.index }}{{ loop.last }}{{ loop.foo }}{% endfor %}", {}, {}));
+        EXPECT_EQ(
+            "21323",
+            render("{% for x in [1, 2, 3] %}{{ loop.pop('nextitem') }}{% set loop.z = 2 %}{{ loop.nextitem }}{{ loop.index }}{% endfor %}", {}, {}));
+    }
+}